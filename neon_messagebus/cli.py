@@ -52,3 +52,70 @@ def run():
     click.echo("Starting Messagebus Service")
     main()
     click.echo("Messagebus Service Shutdown")
+
+
+@neon_messagebus_cli.command(help="Profile traffic on a running messagebus")
+@click.option("--duration", "-d", default=10.0, type=float,
+              help="Seconds to profile for (0 to run until interrupted)")
+@click.option("--interval", "-i", default=1.0, type=float,
+              help="Seconds between live view updates")
+@click.option("--top", "-n", default=10, type=int,
+              help="Number of entries in each table")
+@click.option("--json", "json_path", default=None,
+              help="Write the final report as JSON to a file ('-' for "
+                   "stdout) instead of showing the live view")
+@click.option("--service", "-s", is_flag=True, default=False,
+              help="Sample messages in the bus service instead of receiving "
+                   "them here; reports senders and byte counts exactly")
+@click.option("--sample-every", default=1, type=int,
+              help="With --service, record every Nth routed message")
+def profile(duration, interval, top, json_path, service, sample_every):
+    import json
+    from time import monotonic, sleep
+    from ovos_bus_client import Message
+    from neon_messagebus.service.profiler import format_report
+    from neon_messagebus.util.message_utils import get_messagebus
+    from neon_messagebus.util.profiler import BusProfiler
+
+    init_config_dir()
+    bus = get_messagebus()
+    if service:
+        def get_report(msg_type="neon.messagebus.profile.get"):
+            response = bus.wait_for_response(
+                Message(msg_type, {"top": top, "sample_every": sample_every}),
+                timeout=5)
+            if not response or not response.data.get("profile"):
+                raise click.ClickException("No profile from the bus service")
+            return response.data["profile"]
+        get_report("neon.messagebus.profile.start")
+    else:
+        profiler = BusProfiler(bus, top)
+        profiler.start()
+        get_report = profiler.get_report
+
+    end = monotonic() + duration if duration else None
+    try:
+        while end is None or monotonic() < end:
+            sleep(max(0, min(interval, end - monotonic())) if end
+                  else interval)
+            if not json_path:
+                report = get_report()
+                click.clear()
+                click.echo(format_report(report))
+    except KeyboardInterrupt:
+        pass
+    if service:
+        report = get_report("neon.messagebus.profile.stop")
+    else:
+        profiler.stop()
+        report = profiler.get_report()
+    bus.close()
+    if json_path == "-":
+        click.echo(json.dumps(report, indent=2))
+    elif json_path:
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        click.echo(f"Wrote profile to {json_path}")
+    else:
+        click.clear()
+        click.echo(format_report(report))
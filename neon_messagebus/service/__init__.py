@@ -27,25 +27,60 @@
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import asyncio
+import secrets
 import sys
 import tornado.options
 
-from time import sleep
+from concurrent.futures import Future
+from copy import deepcopy
+from functools import partial
+from time import monotonic, sleep
 from os.path import expanduser, isfile
-from threading import Thread, Event
+from threading import Thread, Event, Lock, current_thread
+from typing import List, Optional
 
 from ovos_bus_client import MessageBusClient, Message
+from ovos_bus_client.conf import MessageBusClientConf
 from ovos_utils.process_utils import StatusCallbackMap, ProcessStatus
 from tornado import web, ioloop
+from tornado.httpserver import HTTPServer
 from ovos_utils.log import LOG
 from ovos_config.config import Configuration
-from ovos_messagebus.event_handler import MessageBusEventHandler
 from ovos_messagebus.load_config import load_message_bus_config
 
-from neon_messagebus.util.mq_connector import start_mq_connector
+from neon_messagebus.service.admission import AdmissionControl
+from neon_messagebus.service.event_handler import BusContext, \
+    DEFAULT_FILTER_LOGS, NeonBusEventHandler, get_send_metrics
+from neon_messagebus.service.federation import Federation
+from neon_messagebus.service.flight_recorder import FlightRecorder
+from neon_messagebus.service.namespaces import DEFAULT_NAMESPACE, Namespaces
+from neon_messagebus.service.profiler import TrafficProfiler
+from neon_messagebus.service.router import Router, get_router
+from neon_messagebus.service.scheduler import FairScheduler, RateLimits
+from neon_messagebus.service.send_queue import CoalesceRules, PriorityRules
+from neon_messagebus.service.spool import OversizePolicy
+from neon_messagebus.service.tracing import Tracer
+from neon_messagebus.service.validation import MessageValidator
+from neon_messagebus.util.executor import HandlerExecutor
+from neon_messagebus.util.message_utils import NeonMessageBusClient
+from neon_messagebus.util.mq_connector import MQConnectorSupervisor, \
+    create_mq_connector
+from neon_messagebus.util.signal_snapshot import SignalSnapshot
+from neon_messagebus.util.signal_table import SharedSignalTable
 from neon_messagebus.util.signal_utils import SignalManager
 
 
+def _get_supported_languages() -> dict:
+    """
+    Get languages supported by Neon Core; runs in the handler CPU pool
+    """
+    from neon_utils.language_utils import get_supported_languages
+    supported_langs = get_supported_languages()
+    return {"stt": list(supported_langs.stt),
+            "tts": list(supported_langs.tts),
+            "skills": list(supported_langs.skills)}
+
+
 def on_ready():
     LOG.info('Messagebus is ready.')
 
@@ -66,6 +101,13 @@ def on_started():
     LOG.debug("Messagebus client started")
 
 
+# Configuration sections `NeonBusService.reload_config` applies
+_RELOADABLE_SECTIONS = ("websocket", "signal", "MQ")
+# Listener settings that can only be changed by opening a new socket
+_SOCKET_SETTINGS = ("host", "port", "ssl_options", "max_buffer_size",
+                    "backlog")
+
+
 class NeonBusService(Thread):
     def __init__(self, ready_hook=on_ready, error_hook=on_error,
                  stopping_hook=on_stopping, alive_hook=on_alive,
@@ -89,10 +131,33 @@ class NeonBusService(Thread):
 
         self._bus = None
         self._app = None
+        # Not reloadable; pools are sized once per service
+        self._executor = HandlerExecutor(**self.config.get("handlers", {}))
         self._loop = None
         self._loop_thread = None
         self._signal_manager = None
-        self._mq_connector = None
+        self._signal_table = None
+        self._mq_supervisor = None
+        self._scheduler = None
+        self._admission = None
+        self._oversize = None
+        self._validator = None
+        self._recorder = None
+        self._recorder_config = None
+        self._profiler = None
+        self._tracer = None
+        self._tracer_config = None
+        self._router: Optional[Router] = None
+        self._federation = None
+        self._connections = list()
+        self._namespaces: Optional[Namespaces] = None
+        # Authenticates this service's own client into the default namespace
+        self._service_token = secrets.token_urlsafe()
+        self._handler_kwargs = None
+        self._listener = None
+        self._loaded = dict()
+        self._reload_lock = Lock()
+        self._start_time = None
 
     @property
     def started(self) -> Event:
@@ -103,27 +168,56 @@ class NeonBusService(Thread):
         self._stopping.clear()
 
         LOG.info('Starting message bus service...')
+        self._loaded = self._get_reloadable_config()
+        self._start_time = monotonic()
         self._init_tornado()
         self._listen()
-        self._loop_thread = Thread(target=ioloop.IOLoop.instance().start)
+        self._loop_thread = Thread(target=self._run_loop,
+                                   args=(ioloop.IOLoop.instance(),))
         self._loop_thread.start()
 
-        self._bus = self._init_bus_client()
-        self._init_signal_manager()
-        self._init_mq_connector()
+        try:
+            self._bus = self._init_bus_client()
+            self._init_signal_manager()
+            self._init_mq_connector()
+        except Exception:
+            self.dump_flight_recorder("crash")
+            raise
 
         self.status.set_ready()
         self._running.set()
         LOG.info('Message bus service started!')
         self._stopping.wait()
 
+    def _run_loop(self, loop: ioloop.IOLoop):
+        try:
+            loop.start()
+        except BaseException:
+            LOG.exception("Messagebus event loop crashed")
+            self.dump_flight_recorder("crash")
+            raise
+
     def _init_bus_client(self) -> MessageBusClient:
         config_dict = {k: v for k, v in self.config.get("websocket", {}).items()
                        if k in ("host", "port", "route", "ssl")}
         config_dict['host'] = "0.0.0.0"
-        bus = MessageBusClient(**config_dict)
+        bus = NeonMessageBusClient(token=self._service_token, **config_dict)
         bus.run_in_thread()
-        bus.on('neon.languages.get', self._handle_get_languages)
+        wrap = self._executor.wrap
+        # Waits for `_get_supported_languages` in the CPU pool
+        bus.on('neon.languages.get', wrap(self._handle_get_languages))
+        bus.on('neon.messagebus.get_metrics', wrap(self._handle_get_metrics))
+        bus.on('neon.messagebus.reload_config',
+               wrap(self._handle_reload_config))
+        bus.on('neon.messagebus.dump_flight_recorder',
+               wrap(self._handle_dump_flight_recorder))
+        profile = wrap(self._handle_profile)
+        bus.on('neon.messagebus.profile.start', profile)
+        bus.on('neon.messagebus.profile.get', profile)
+        bus.on('neon.messagebus.profile.stop', profile)
+        federation = wrap(self._handle_federation)
+        bus.on('neon.federation.subscribe', federation)
+        bus.on('neon.federation.unsubscribe', federation)
 
         return bus
 
@@ -132,34 +226,184 @@ class NeonBusService(Thread):
         Handle a request to get languages supported by Neon Core.
         @param message: neon.languages.get Message
         """
-        from neon_utils.language_utils import get_supported_languages
-        supported_langs = get_supported_languages()
-        self._bus.emit(message.response({"stt": list(supported_langs.stt),
-                                         "tts": list(supported_langs.tts),
-                                         "skills": list(supported_langs.skills)
-                                         }))
+        self._bus.emit(message.response(
+            self._executor.submit_cpu(_get_supported_languages).result()))
+
+    def _handle_get_metrics(self, message: Message):
+        """
+        Handle a request to get messagebus server metrics.
+        @param message: neon.messagebus.get_metrics Message
+        """
+        self._bus.emit(message.response(self.get_metrics()))
+
+    def _handle_reload_config(self, message: Message):
+        """
+        Handle a request to reload configuration.
+        @param message: neon.messagebus.reload_config Message
+        """
+        try:
+            changed = self.reload_config()
+            self._bus.emit(message.response({"changed": changed}))
+        except Exception as e:
+            LOG.exception(f"Failed to reload configuration: {e}")
+            self._bus.emit(message.response({"error": repr(e)}))
+
+    def _handle_dump_flight_recorder(self, message: Message):
+        """
+        Handle a request to write recently routed messages to disk.
+        @param message: neon.messagebus.dump_flight_recorder Message
+        """
+        self._bus.emit(message.response(
+            {"path": self.dump_flight_recorder("requested")}))
+
+    def dump_flight_recorder(self, reason: str = "requested") -> Optional[str]:
+        """
+        Write the most recently routed messages to a file
+        @param reason: why the dump was requested, saved in the file
+        @return: path to the written file, or None if nothing was written
+        """
+        if not self._recorder:
+            return None
+        return self._recorder.dump(reason)
+
+    def _handle_profile(self, message: Message):
+        """
+        Handle a request to start, read or stop traffic profiling.
+        @param message: neon.messagebus.profile.start, get or stop Message.
+            `start` accepts `sample_every`; all accept `top`
+        """
+        if message.msg_type == "neon.messagebus.profile.start":
+            self.start_profiling(message.data.get("sample_every", 1))
+        report = self.get_profile(message.data.get("top", 10))
+        if message.msg_type == "neon.messagebus.profile.stop":
+            self.stop_profiling()
+        self._bus.emit(message.response({"profile": report}))
+
+    def start_profiling(self, sample_every: int = 1, timeout: int = 5):
+        """
+        Start sampling routed messages, replacing any running profile
+        @param sample_every: record every Nth routed message
+        @param timeout: seconds to wait for the server event loop
+        """
+        self._profiler = TrafficProfiler(sample_every)
+        self._run_on_loop(self._set_context, self._handler_kwargs[
+            "context"]._replace(profiler=self._profiler)).result(timeout)
+
+    def stop_profiling(self, timeout: int = 5):
+        """
+        Stop sampling routed messages
+        @param timeout: seconds to wait for the server event loop
+        """
+        self._profiler = None
+        self._run_on_loop(self._set_context, self._handler_kwargs[
+            "context"]._replace(profiler=None)).result(timeout)
+
+    def get_profile(self, top: int = 10,
+                    timeout: int = 5) -> Optional[dict]:
+        """
+        Get the report of the running traffic profile
+        @param top: number of entries in each list
+        @param timeout: seconds to wait for the server event loop
+        @return: dict report, or None if not profiling
+        """
+        profiler = self._profiler
+        if not profiler:
+            return None
+        return self._run_on_loop(profiler.get_report, top).result(timeout)
+
+    def _run_on_loop(self, func, *args) -> Future:
+        async def _run():
+            return func(*args)
+        return asyncio.run_coroutine_threadsafe(_run(), self._loop)
+
+    def _handle_federation(self, message: Message):
+        """
+        Handle a request to change the message types received from
+        federated peers.
+        @param message: neon.federation.subscribe or unsubscribe Message
+            with a list of message types (or glob patterns) in `types`
+        """
+        if not self._federation:
+            return
+        types = message.data.get("types") or []
+        if message.msg_type == "neon.federation.subscribe":
+            self._loop.call_soon_threadsafe(self._federation.subscribe, types)
+        else:
+            self._loop.call_soon_threadsafe(self._federation.unsubscribe,
+                                            types)
+
+    def get_metrics(self, timeout: int = 5) -> dict:
+        """
+        Get routing and per-client metrics from the messagebus server, and
+        MQ bridge metrics if the MQ connector is running
+        @param timeout: seconds to wait for the server event loop
+        @return: dict metrics
+        """
+        async def _collect():
+            metrics = self._scheduler.get_metrics()
+            metrics.update(get_send_metrics(self._get_connections()))
+            metrics["handshakes"] = self._admission.get_metrics()
+            metrics["oversize"] = self._oversize.get_metrics()
+            if self._validator:
+                metrics["validation"] = self._validator.get_metrics()
+            metrics["router"] = self._router.get_metrics()
+            if self._namespaces:
+                metrics["namespaces"] = self._namespaces.get_metrics()
+            if self._recorder:
+                metrics["flight_recorder"] = self._recorder.get_metrics()
+            if self._tracer:
+                metrics["tracing"] = self._tracer.get_metrics()
+            if self._federation:
+                metrics["federation"] = self._federation.get_metrics()
+            return metrics
+        metrics = asyncio.run_coroutine_threadsafe(_collect(),
+                                                   self._loop).result(timeout)
+        if self._mq_supervisor:
+            metrics["mq"] = self._mq_supervisor.get_metrics()
+        if self._signal_manager:
+            metrics["signal_manager"] = self._signal_manager.get_metrics()
+        metrics["handlers"] = self._executor.get_metrics()
+        return metrics
 
     def _init_signal_manager(self):
-        self._signal_manager = SignalManager(self._bus)
+        self._signal_manager = SignalManager(
+            self._bus,
+            self.config.get("signal", {}).get("handle_files", True),
+            self._get_shared_signal_table(), self._get_signal_snapshot(),
+            self._executor)
         LOG.info("Signal Manager started")
 
+    def _get_signal_snapshot(self) -> Optional[SignalSnapshot]:
+        """
+        Get a SignalSnapshot if signal persistence is configured
+        """
+        snapshot_config = self.config.get("signal", {}).get("snapshot")
+        if not snapshot_config or not snapshot_config.get("path"):
+            return None
+        return SignalSnapshot(**snapshot_config)
+
+    def _get_shared_signal_table(self) -> Optional[SharedSignalTable]:
+        """
+        Create the shared memory signal table if one is configured
+        """
+        table_config = self.config.get("signal", {}).get("shared_memory")
+        if table_config:
+            if not isinstance(table_config, dict):
+                table_config = dict()
+            self._signal_table = SharedSignalTable(create=True,
+                                                   **table_config)
+        return self._signal_table
+
     def _init_mq_connector(self):
         if not self.config.get("MQ"):
             LOG.info("No MQ Configuration")
             return
-        try:
-            self._mq_connector = start_mq_connector(self.config)
-            if self._mq_connector:
-                LOG.info(f"MQ Connection Established to "
-                         f"{self._mq_connector.config.get('server')}:"
-                         f"{self._mq_connector.config.get('port')}")
-            else:
-                LOG.info("No MQ Credentials provided")
-        except ImportError as e:
-            LOG.warning(f"MQ Connector module not available: {e}")
-        except Exception as e:
-            LOG.error("Connector not started")
-            LOG.exception(e)
+        # Connect in the background so a missing broker doesn't block startup
+        self._mq_supervisor = MQConnectorSupervisor(
+            partial(create_mq_connector, self.config,
+                    token=self._service_token),
+            **self.config["MQ"].get("supervisor", {}))
+        self._mq_supervisor.start()
 
     def _init_tornado(self):
         # Disable all tornado logging so mycroft loglevel isn't overridden
@@ -169,11 +413,125 @@ class NeonBusService(Thread):
         asyncio.set_event_loop(self._loop)
 
     def _listen(self):
-        config = load_message_bus_config(**self.config.get('websocket', {}))
-        routes = [(config.route, MessageBusEventHandler)]
-        application = web.Application(routes, debug=self.debug)
+        ws_config = self.config.get('websocket', {})
+        self._scheduler = FairScheduler(
+            NeonBusEventHandler.route, RateLimits(ws_config.get('rate_limit')),
+            PriorityRules(ws_config.get('priority')),
+            **ws_config.get('scheduler', {}))
+        context = self._get_context(ws_config)
+        # Route kwargs are shared by every application this service creates,
+        # so a reloaded context applies to new connections on any listener
+        self._handler_kwargs = {"context": context}
+        if ws_config.get('federation'):
+            self._federation = Federation(context, **ws_config['federation'])
+        self._listener = self._get_listener_config(ws_config)
+        self._app = self._start_listener(self._get_application(ws_config))
+        if self._federation:
+            self._federation.start()
+
+    def _get_context(self, ws_config: dict) -> BusContext:
+        """
+        Build the per-bus context shared by all connections
+        @param ws_config: `websocket` configuration
+        """
+        self._admission = AdmissionControl(ws_config.get('max_connections'),
+                                           ws_config.get('handshake_rate'),
+                                           ws_config.get('warmup'),
+                                           self._start_time)
+        self._oversize = OversizePolicy(
+            int((ws_config.get('max_frame') or 0) * 1024 * 1024),
+            ws_config.get('oversize') == 'spool',
+            spool_dir=ws_config.get('spool_dir'))
+        # Keep recorded messages across reloads unless the recorder changed
+        recorder_config = ws_config.get('flight_recorder') or dict()
+        if self._recorder_config != recorder_config:
+            self._recorder_config = deepcopy(recorder_config)
+            self._recorder = FlightRecorder(**recorder_config) \
+                if recorder_config.get('size', 1024) else None
+        tracer_config = ws_config.get('tracing') or None
+        if self._tracer_config != tracer_config:
+            self._tracer_config = deepcopy(tracer_config)
+            self._tracer = Tracer(**tracer_config) if tracer_config else None
+        router = get_router(ws_config.get('router'))
+        if self._router is None or self._router.name != router.name:
+            if self._router:
+                # Send messages batched by the previous router first
+                self._router.flush()
+            self._router = router
+        self._namespaces = self._get_namespaces(ws_config.get('namespaces'))
+        self._validator = MessageValidator(ws_config['validate']) \
+            if ws_config.get('validate') else None
+        return BusContext(self._scheduler, self._connections,
+                          CoalesceRules(ws_config.get('coalesce')),
+                          self._admission,
+                          int(ws_config.get('max_msg_size', 10) *
+                              1024 * 1024), self._oversize, self._recorder,
+                          self._profiler, self._tracer, self._router,
+                          (ws_config.get('write_window_ms') or 0) / 1000,
+                          ws_config.get('write_batch_bytes', 64 * 1024),
+                          self._namespaces, self._validator,
+                          bool(ws_config.get('filter')),
+                          tuple(ws_config.get('filter_logs',
+                                              DEFAULT_FILTER_LOGS)))
+
+    def _get_namespaces(self, config: Optional[dict]) -> Optional[Namespaces]:
+        """
+        Get Namespaces for the `websocket.namespaces` configuration. Clients
+        connected to a namespace stay in it across reloads; token changes
+        apply to new connections.
+        @param config: `tokens`, `require_token`, and `bridge` configuration
+        @return: Namespaces, or None if namespaces are not configured
+        """
+        if not config:
+            if not self._namespaces or not len(self._namespaces):
+                return None
+            # Keep clients already connected to a namespace isolated
+            LOG.warning("Namespaces removed while clients are connected")
+            config = dict()
+        tokens = dict(config.get('tokens') or dict())
+        tokens[self._service_token] = DEFAULT_NAMESPACE
+        namespaces = Namespaces(tokens, config.get('require_token', False),
+                                config.get('bridge'))
+        if self._namespaces:
+            namespaces.connections = self._namespaces.connections
+            namespaces.rejected = self._namespaces.rejected
+        return namespaces
+
+    def _get_connections(self) -> list:
+        """
+        Get connected clients and subscribers in every namespace. Must be
+        called on the server event loop.
+        """
+        connections = list(self._connections)
+        if self._namespaces:
+            connections.extend(self._namespaces.get_all())
+        return connections
+
+    def _get_application(self, ws_config: dict) -> web.Application:
+        """
+        Build the tornado application serving bus (and federation) routes
+        @param ws_config: `websocket` configuration
+        """
+        routes = [(self._listener["route"], NeonBusEventHandler,
+                   self._handler_kwargs)]
+        if self._federation:
+            routes.extend(self._federation.get_routes())
+        settings = dict()
+        if ws_config.get('ping_interval'):
+            # Close connections that stop answering pings
+            settings['websocket_ping_interval'] = ws_config['ping_interval']
+            settings['websocket_ping_timeout'] = \
+                ws_config.get('ping_timeout') or ws_config['ping_interval']
+        return web.Application(routes, debug=self.debug, **settings)
+
+    @staticmethod
+    def _get_listener_config(ws_config: dict) -> dict:
+        """
+        Get the settings that require a new listening socket to change
+        @param ws_config: `websocket` configuration
+        """
+        config = load_message_bus_config(**ws_config)
         ssl_options = None
-        LOG.info(f"Starting Messagebus server with config: {config}")
         if config.ssl:
             cert = expanduser(config.ssl_cert)
             key = expanduser(config.ssl_key)
@@ -184,17 +542,158 @@ class NeonBusService(Thread):
                 LOG.info("using ssl key at " + key)
                 LOG.info("using ssl certificate at " + cert)
                 ssl_options = {"certfile": cert, "keyfile": key}
-        if ssl_options:
-            LOG.info("wss listener started")
-            self._app = application.listen(config.port, config.host,
-                                           ssl_options=ssl_options)
+        # tornado closes connections that buffer more than `max_buffer_size`
+        # (100 MiB by default) while reading a frame
+        max_buffer_size = max(100 * 1024 * 1024,
+                              int(ws_config.get('max_msg_size', 10) *
+                                  1024 * 1024) + 1024 * 1024)
+        return {"host": config.host, "port": config.port,
+                "route": config.route, "ssl": config.ssl,
+                "ssl_options": ssl_options,
+                "max_buffer_size": max_buffer_size,
+                "backlog": ws_config.get('accept_backlog') or 128}
+
+    def _get_reloadable_config(self) -> dict:
+        return deepcopy({section: self.config.get(section)
+                         for section in _RELOADABLE_SECTIONS})
+
+    def _start_listener(self, application: web.Application) -> HTTPServer:
+        listener = self._listener
+        LOG.info(f"Starting Messagebus server with config: {listener}")
+        # Connections beyond the backlog are dropped by the kernel and
+        # retried by clients after the TCP retransmission timeout
+        server = application.listen(listener["port"], listener["host"],
+                                    backlog=listener["backlog"],
+                                    ssl_options=listener["ssl_options"],
+                                    max_buffer_size=listener[
+                                        "max_buffer_size"])
+        LOG.info(f"{'wss' if listener['ssl_options'] else 'ws'} "
+                 f"listener started")
+        return server
+
+    def reload_config(self, config: Optional[dict] = None,
+                      timeout: int = 10) -> List[str]:
+        """
+        Apply changed `websocket`, `signal`, and `MQ` configuration without
+        dropping client connections. Listener changes start a new listener
+        before the old one stops accepting connections; connected clients
+        stay connected to the old socket.
+        @param config: new configuration, else configuration is reloaded
+        @param timeout: seconds to wait for the server event loop
+        @return: list of configuration sections that changed
+        """
+        with self._reload_lock:
+            if config is None:
+                if isinstance(self.config, Configuration):
+                    Configuration.reload()
+                    config = Configuration()
+                else:
+                    config = self.config
+            changed = [section for section in _RELOADABLE_SECTIONS
+                       if config.get(section) != self._loaded.get(section)]
+            LOG.info(f"Reloading configuration sections: {changed}")
+            self.config = config
+            if "websocket" in changed:
+                asyncio.run_coroutine_threadsafe(
+                    self._reload_websocket(config.get('websocket', {})),
+                    self._loop).result(timeout)
+            if "signal" in changed and self._signal_manager:
+                self._signal_manager.reload_config(
+                    self.config.get("signal", {}).get("handle_files", True))
+                old_signal = self._loaded.get("signal") or dict()
+                if config.get("signal", {}).get("shared_memory") != \
+                        old_signal.get("shared_memory"):
+                    # Readers use the bus until the new table is written
+                    self._signal_manager.set_shared_table(None)
+                    if self._signal_table:
+                        self._signal_table.close()
+                        self._signal_table = None
+                    self._signal_manager.set_shared_table(
+                        self._get_shared_signal_table())
+                if config.get("signal", {}).get("snapshot") != \
+                        old_signal.get("snapshot"):
+                    self._signal_manager.set_snapshot(
+                        self._get_signal_snapshot())
+            if "MQ" in changed:
+                if self._mq_supervisor:
+                    self._mq_supervisor.stop()
+                    self._mq_supervisor = None
+                self._init_mq_connector()
+            self._loaded = self._get_reloadable_config()
+            return changed
+
+    def _set_context(self, context: BusContext):
+        """
+        Apply a new context to new and existing connections. Must be called
+        on the server event loop.
+        @param context: context shared by all connections
+        """
+        self._handler_kwargs["context"] = context
+        for connection in self._get_connections():
+            connection.context = context
+        if self._federation:
+            self._federation.context = context
+
+    async def _reload_websocket(self, ws_config: dict):
+        """
+        Apply `websocket` configuration on the server event loop
+        @param ws_config: new `websocket` configuration
+        """
+        old_config = self._loaded.get("websocket") or dict()
+        self._scheduler.reconfigure(RateLimits(ws_config.get('rate_limit')),
+                                    PriorityRules(ws_config.get('priority')),
+                                    **ws_config.get('scheduler', {}))
+        context = self._get_context(ws_config)
+        self._set_context(context)
+        federation_changed = \
+            ws_config.get('federation') != old_config.get('federation')
+        if self._federation and federation_changed:
+            await self._federation.stop()
+            self._federation = None
+        if federation_changed and ws_config.get('federation'):
+            self._federation = Federation(context, **ws_config['federation'])
+
+        old_listener = self._listener
+        self._listener = self._get_listener_config(ws_config)
+        application = self._get_application(ws_config)
+        if all(self._listener[key] == old_listener[key]
+               for key in _SOCKET_SETTINGS):
+            # New connections are served by the new application; existing
+            # connections keep their handlers
+            self._app.request_callback = application
         else:
-            LOG.info("ws listener started")
-            self._app = application.listen(config.port, config.host)
+            old_app = self._app
+            same_address = self._listener["port"] == old_listener["port"] \
+                and self._listener["host"] == old_listener["host"]
+            if same_address:
+                # The port has to be released before it can be bound again
+                old_app.stop()
+            self._app = self._start_listener(application)
+            if not same_address:
+                old_app.stop()
+        if self._bus and self._listener != old_listener:
+            # Reconnect the service's own client to the new listener
+            self._bus.config = MessageBusClientConf(
+                "0.0.0.0", self._listener["port"], self._listener["route"],
+                self._listener["ssl"])
+        if self._federation and federation_changed:
+            self._federation.start()
 
     def shutdown(self):
         LOG.info("Messagebus Server shutting down.")
         self.status.set_stopping()
+        if self._federation:
+            try:
+                asyncio.run_coroutine_threadsafe(self._federation.stop(),
+                                                 self._loop).result(5)
+            except Exception as e:
+                LOG.warning(f"Failed to stop federation: {e}")
+        if self._tracer:
+            try:
+                asyncio.run_coroutine_threadsafe(self._tracer.flush(),
+                                                 self._loop).result(5)
+            except Exception as e:
+                LOG.warning(f"Failed to export spans: {e}")
         self._app.stop()
         loop = ioloop.IOLoop.instance()
         loop.add_callback(loop.stop)
@@ -209,13 +708,19 @@ class NeonBusService(Thread):
             sleep(1)
         self._loop.close()
         self._loop_thread.join()
-
-        if self._mq_connector:
-            from pika.exceptions import StreamLostError
-            try:
-                self._mq_connector.stop()
-            except StreamLostError:
-                pass
+        self._connections.clear()
+        if self._namespaces:
+            self._namespaces.connections.clear()
+
+        if self._mq_supervisor:
+            self._mq_supervisor.stop()
+        if self._signal_manager:
+            self._signal_manager.shutdown()
+        if self._signal_table:
+            self._signal_table.close()
+        self._executor.shutdown()
 
         self._stopping.set()
+        if self.is_alive() and current_thread() is not self:
+            self.join(5)
         LOG.info("Messagebus service stopped")
@@ -26,6 +26,9 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import signal
+
+from threading import Thread
 from ovos_utils import wait_for_exit_signal
 from ovos_utils.log import LOG
 from ovos_utils.process_utils import reset_sigint_handler, PIDLock as Lock
@@ -48,6 +51,14 @@ def main(**kwargs):
 
     service = NeonBusService(daemonic=True, **kwargs)
     service.start()
+    # Reload configuration in place on SIGHUP
+    signal.signal(signal.SIGHUP,
+                  lambda *_: Thread(target=service.reload_config,
+                                    daemon=True).start())
+    # Write recently routed messages to disk on SIGUSR1
+    signal.signal(signal.SIGUSR1,
+                  lambda *_: Thread(target=service.dump_flight_recorder,
+                                    args=("SIGUSR1",), daemon=True).start())
     LOG.debug("Waiting for exit signal")
     wait_for_exit_signal()
 
@@ -0,0 +1,106 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from time import monotonic
+from typing import Optional
+
+from neon_messagebus.service.scheduler import TokenBucket
+
+
+class AdmissionControl:
+    def __init__(self, max_connections: int = 0,
+                 handshake_rate: Optional[dict] = None,
+                 warmup: Optional[dict] = None,
+                 start_time: Optional[float] = None):
+        """
+        Decides whether new websocket handshakes are accepted.
+        :param max_connections: maximum open connections; 0 for no limit
+        :param handshake_rate: optional dict `rate` (handshakes per second)
+            and `burst` limiting how quickly new connections are accepted
+        :param warmup: optional dict `duration` in seconds, `rate` and
+            `burst` limiting handshakes for `duration` seconds after
+            `start_time`, in place of `handshake_rate`
+        :param start_time: `time.monotonic` value the service started at,
+            defaults to now
+        """
+        self.max_connections = max_connections or 0
+        self._bucket = self._get_bucket(handshake_rate)
+        self._warmup_bucket = self._get_bucket(warmup)
+        self._warmup_end = (start_time or monotonic()) + \
+            (warmup.get("duration") or 0) if self._warmup_bucket else 0
+        # Time until which rejected clients have been told to wait
+        self._reserved = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _get_bucket(limit: Optional[dict]) -> Optional[TokenBucket]:
+        if not limit or not limit.get("rate"):
+            return None
+        return TokenBucket(limit["rate"], limit.get("burst"))
+
+    @property
+    def warming_up(self) -> bool:
+        """
+        True while handshakes are limited by the warm-up rate
+        """
+        return monotonic() < self._warmup_end
+
+    def admit(self, open_connections: int) -> Optional[float]:
+        """
+        Check if a new connection may be accepted
+        :param open_connections: number of currently open connections
+        :returns: None if the connection is accepted, else seconds after
+            which the client should retry
+        """
+        if self.max_connections and open_connections >= self.max_connections:
+            self.rejected += 1
+            return 1.0
+        now = monotonic()
+        bucket = self._warmup_bucket if now < self._warmup_end else \
+            self._bucket
+        if bucket:
+            wait = bucket.consume(now)
+            if wait:
+                self.rejected += 1
+                # Give each rejected client its own slot at the handshake
+                # rate so they don't all retry at the same time
+                self._reserved = max(now + wait,
+                                     self._reserved + 1 / bucket.rate)
+                return self._reserved - now
+        self.accepted += 1
+        return None
+
+    def get_metrics(self) -> dict:
+        """
+        Get handshake counters
+        """
+        return {"max_connections": self.max_connections,
+                "warming_up": self.warming_up,
+                "accepted": self.accepted,
+                "rejected": self.rejected}
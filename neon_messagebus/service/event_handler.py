@@ -0,0 +1,548 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from math import ceil
+from typing import List, NamedTuple, Optional, Hashable
+from ovos_bus_client import Message
+from ovos_bus_client.session import SessionManager
+from ovos_messagebus.event_handler import MessageBusEventHandler, \
+    client_connections
+from ovos_utils.log import LOG
+from pyee import EventEmitter
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError, WebSocketHandler, \
+    WebSocketProtocol13
+
+from neon_messagebus.service.admission import AdmissionControl
+from neon_messagebus.service.flight_recorder import FlightRecorder
+from neon_messagebus.service.namespaces import DEFAULT_NAMESPACE, Namespaces
+from neon_messagebus.service.profiler import TrafficProfiler
+from neon_messagebus.service.router import BroadcastRouter, Router, \
+    encode_frame
+from neon_messagebus.service.scheduler import FairScheduler
+from neon_messagebus.service.send_queue import ClientSendQueue, \
+    CoalesceRules, PRIORITY_HIGH, PRIORITY_NORMAL
+from neon_messagebus.service.spool import OversizePolicy, SpooledMessage
+from neon_messagebus.service.tracing import Tracer
+from neon_messagebus.service.validation import MessageValidator
+from neon_messagebus.util.envelope import Envelope
+
+
+# Sent to every client on connect; serialized once
+_CONNECTED = Message("connected", context={
+    "session": {"session_id": "default"}}).serialize()
+
+# Message types `websocket.filter` does not log by default
+DEFAULT_FILTER_LOGS = ("gui.status.request", "gui.page.upload")
+
+
+class BusContext(NamedTuple):
+    """
+    Configuration and state shared by every connection to one bus service.
+    Handlers keep a single reference to this instead of per-connection copies.
+    """
+    scheduler: FairScheduler
+    connections: list
+    coalesce_rules: CoalesceRules = CoalesceRules()
+    admission: AdmissionControl = AdmissionControl()
+    max_message_size: int = 10 * 1024 * 1024
+    oversize: OversizePolicy = OversizePolicy()
+    recorder: Optional[FlightRecorder] = None
+    profiler: Optional[TrafficProfiler] = None
+    tracer: Optional[Tracer] = None
+    router: Router = BroadcastRouter()
+    write_window: float = 0.0
+    write_batch_bytes: int = 64 * 1024
+    namespaces: Optional[Namespaces] = None
+    validator: Optional[MessageValidator] = None
+    filter: bool = False
+    filter_logs: tuple = DEFAULT_FILTER_LOGS
+
+
+def get_send_metrics(connections: List["NeonBusEventHandler"]) -> dict:
+    """
+    Get send queue stats for connected clients
+    :param connections: list of connected NeonBusEventHandler objects and
+        other subscribers such as federation links
+    """
+    queues = [c._send_queue for c in list(connections)
+              if isinstance(c, NeonBusEventHandler)]
+    return {"connections": len(queues),
+            "send_queued": sum(len(q) for q in queues if q),
+            "coalesced": sum(q.coalesced for q in queues if q)}
+
+
+class NeonBusEventHandler(MessageBusEventHandler):
+    # Per-connection state; anything shared between connections belongs in
+    # `BusContext`. Buffers are only allocated once a client falls behind.
+    __slots__ = ("context", "_emitter", "_inbound", "_send_queue",
+                 "_write_future", "_flushing", "_batch_frames", "_namespace")
+
+    def __init__(self, application, request, **kwargs):
+        # MessageBusEventHandler.__init__ only adds an EventEmitter, which is
+        # created on demand by `emitter` here
+        WebSocketHandler.__init__(self, application, request, **kwargs)
+
+    def initialize(self, context: Optional[BusContext] = None):
+        """
+        Called by tornado with the route kwargs for each new connection
+        :param context: configuration and state shared by all connections
+        """
+        self.context = context or BusContext(
+            FairScheduler(NeonBusEventHandler.route), client_connections)
+        self._emitter = None
+        self._inbound = None
+        self._send_queue = None
+        self._write_future = None
+        self._flushing = False
+        self._batch_frames = False
+        self._namespace = DEFAULT_NAMESPACE
+
+    @property
+    def emitter(self) -> EventEmitter:
+        if self._emitter is None:
+            self._emitter = EventEmitter()
+        return self._emitter
+
+    @property
+    def filter(self) -> bool:
+        return self.context.filter
+
+    @property
+    def filter_logs(self) -> tuple:
+        return self.context.filter_logs
+
+    @property
+    def max_message_size(self) -> int:
+        return self.context.max_message_size
+
+    @property
+    def identity(self) -> str:
+        """
+        Client identity used for rate limits and metrics; clients may specify
+        a `client_id` query argument, else the remote address is used.
+        """
+        return self.get_query_argument("client_id", None) or \
+            self.request.remote_ip
+
+    @property
+    def namespace(self) -> str:
+        """
+        Namespace this client was authenticated into ("" for the default)
+        """
+        return self._namespace
+
+    def _get_token(self) -> Optional[str]:
+        """
+        Get the namespace token from a `token` query argument or a bearer
+        token in the Authorization header
+        """
+        token = self.get_query_argument("token", None)
+        if token is None:
+            auth = self.request.headers.get("Authorization", "")
+            if auth.startswith("Bearer "):
+                token = auth[7:].strip()
+        return token
+
+    def prepare(self):
+        namespaces = self.context.namespaces
+        if namespaces is not None:
+            namespace = namespaces.authenticate(self._get_token())
+            if namespace is None:
+                LOG.info(f"Rejecting unauthenticated connection from "
+                         f"{self.request.remote_ip}")
+                self.set_status(401)
+                self.finish()
+                return
+            self._namespace = namespace
+        retry_after = self.context.admission.admit(
+            len(self.context.connections) +
+            (len(namespaces) if namespaces is not None else 0))
+        if retry_after is not None:
+            LOG.debug(f"Rejecting connection from {self.request.remote_ip}")
+            self.set_status(503)
+            self.set_header("Retry-After", str(ceil(retry_after)))
+            self.finish()
+
+    def open(self):
+        self._inbound = self.context.scheduler.register(self, self.identity)
+        # Clients that can unpack a JSON array of messages ask for batches
+        self._batch_frames = self.get_query_argument("batch", None) == "1"
+        self.write_message(_CONNECTED)
+        if self._namespace == DEFAULT_NAMESPACE:
+            self.context.connections.append(self)
+        else:
+            self.context.namespaces.add(self, self._namespace)
+
+    def on_close(self):
+        self.context.scheduler.unregister(self)
+        if self.context.tracer is not None:
+            self.context.tracer.remove_client(self)
+        if self._namespace != DEFAULT_NAMESPACE:
+            if self.context.namespaces is not None:
+                self.context.namespaces.remove(self, self._namespace)
+        elif self in self.context.connections:
+            self.context.connections.remove(self)
+
+    def on_message(self, message: str):
+        oversize = self.context.oversize
+        if not oversize.spool and oversize.is_oversize(message):
+            LOG.warning(f"Rejecting {len(message)} byte message from "
+                        f"{self.identity}")
+            self.send(oversize.reject(message), priority=PRIORITY_HIGH)
+            return None
+        if self.context.validator is not None:
+            rejection = self.context.validator.check(message)
+            if rejection is not None:
+                LOG.debug(f"Rejecting invalid message from {self.identity}")
+                self.send(rejection, priority=PRIORITY_HIGH)
+                return None
+        if self.context.tracer is not None:
+            self.context.tracer.receive(message)
+        if self.filter:
+            try:
+                deserialized = Message.deserialize(message)
+            except Exception:
+                return None
+            if deserialized.msg_type not in self.filter_logs:
+                LOG.debug(f"{deserialized.msg_type} source: "
+                          f"{deserialized.context.get('source', [])} "
+                          f"destination: "
+                          f"{deserialized.context.get('destination', [])}\n"
+                          f"SESSION: "
+                          f"{SessionManager.get(deserialized).serialize()}")
+            self._emit_local(deserialized.msg_type, deserialized)
+        else:
+            self._emit_local(message)
+        return self.context.scheduler.submit(self._inbound, message)
+
+    def _emit_local(self, event: str, *args):
+        """
+        Emit a received message to handlers registered on this connection with
+        `on`, as MessageBusEventHandler.on_message does
+        :param event: event name to emit
+        :param args: arguments passed to registered handlers
+        """
+        if self._emitter is None:
+            # Nothing was registered, so there is nothing to call
+            return
+        try:
+            self._emitter.emit(event, *args)
+        except Exception as e:
+            LOG.exception(e)
+
+    def route(self, message: str, priority: int = PRIORITY_NORMAL):
+        """
+        Send a message received by this handler to all connected clients in
+        its namespace (and any namespaces the message type is bridged to)
+        :param message: serialized message
+        :param priority: priority class of the message
+        """
+        if self.context.recorder is not None:
+            self.context.recorder.record(message, self, priority,
+                                         len(self.context.connections))
+        if self.context.profiler is not None:
+            self.context.profiler.sample(message, self,
+                                         len(self.context.connections))
+        if self.context.namespaces is None:
+            targets = (self.context.connections,)
+        else:
+            targets = self.context.namespaces.get_targets(
+                message, self._namespace, self.context.connections)
+        if self.context.oversize.spool and \
+                self.context.oversize.is_oversize(message):
+            if self.context.tracer is not None:
+                self.context.tracer.discard(message)
+            IOLoop.current().spawn_callback(NeonBusEventHandler._route_spooled,
+                                            self.context, message, priority,
+                                            targets)
+            return
+        tracer = self.context.tracer
+        trace = None
+        if tracer is not None:
+            trace = tracer.start_route(message, self)
+            if trace is not None:
+                message = trace.message
+        coalesce_key = None
+        coalesce_rules = self.context.coalesce_rules
+        if coalesce_rules:
+            # Only `data` of coalesced message types is decoded
+            envelope = Envelope(message)
+            msg_type = envelope.msg_type
+            if msg_type and coalesce_rules.get(msg_type) is not None:
+                try:
+                    coalesce_key = coalesce_rules.get_key(
+                        {"type": msg_type, "data": envelope.data})
+                except ValueError:
+                    LOG.debug(f"Not coalescing unparsable message: "
+                              f"{message}")
+        if trace is None:
+            for connections in targets:
+                self.context.router.route(message, connections, coalesce_key,
+                                          priority)
+            return
+        # Traced messages are sent individually so each write is recorded
+        self.context.router.flush()
+        fanout = 0
+        for connections in targets:
+            for client in connections:
+                if isinstance(client, NeonBusEventHandler):
+                    tracer.queue_write(trace, client)
+                client.send(message, coalesce_key, priority)
+            fanout += len(connections)
+        tracer.end_route(trace, fanout)
+
+    @staticmethod
+    async def _route_spooled(context: BusContext, message: str,
+                             priority: int, targets: Optional[tuple] = None):
+        """
+        Spool an oversize message and queue it for every connected client.
+        Federation links and other subscribers do not receive spooled
+        messages.
+        :param context: context of the bus the message was received on
+        :param message: oversize serialized message
+        :param priority: priority class of the message
+        :param targets: lists of connections to send to, default all clients
+            in the default namespace
+        """
+        try:
+            spooled = await context.oversize.spool_message(message)
+        except OSError as e:
+            LOG.error(f"Failed to spool {len(message)} byte message: {e}")
+            return
+        del message
+        for connections in targets or (context.connections,):
+            for client in list(connections):
+                if isinstance(client, NeonBusEventHandler):
+                    client.send_spooled(spooled, priority)
+
+    @property
+    def _writing(self) -> bool:
+        """
+        True if previously written data has not been flushed to the socket
+        """
+        stream = getattr(self.ws_connection, "stream", None)
+        return stream is not None and stream.writing()
+
+    @property
+    def _raw_frames(self) -> bool:
+        """
+        True if frames may be written to this connection's stream without
+        going through `write_message`. tornado has no public API for this, so
+        it is only done for the uncompressed protocol it was written against;
+        anything else falls back to `write_message`.
+        """
+        protocol = self.ws_connection
+        return self._frame_protocol and \
+            getattr(protocol, "_compressor", True) is None
+
+    @property
+    def _frame_protocol(self) -> bool:
+        """
+        True if this connection uses the tornado protocol implementation
+        whose stream and `_write_frame` are used to write frames directly
+        """
+        protocol = self.ws_connection
+        return isinstance(protocol, WebSocketProtocol13) and \
+            hasattr(protocol, "_write_frame") and \
+            getattr(protocol, "stream", None) is not None and \
+            not protocol.is_closing()
+
+    @property
+    def can_write_frames(self) -> bool:
+        """
+        True if encoded frames may be written to this client now with
+        `write_frames`; nothing is queued or being written to it and the
+        connection does not use compression
+        """
+        return not self._flushing and not self._writing and self._raw_frames
+
+    def write_frames(self, data: bytes):
+        """
+        Write encoded text frames (see `encode_frame`) to this client with a
+        single socket write. Only valid while `can_write_frames` is True.
+        :param data: encoded frames
+        """
+        try:
+            self._write_future = self._write_raw(data)
+        except WebSocketClosedError:
+            LOG.debug("Dropping messages for closed connection")
+
+    def _write_raw(self, data: bytes) -> Optional[Future]:
+        """
+        Write encoded frames to the socket, behind any data already written
+        :param data: encoded frames
+        :returns: Future resolved once the data is flushed, if it is not yet
+        """
+        try:
+            future = self.ws_connection.stream.write(data)
+        except StreamClosedError:
+            raise WebSocketClosedError()
+        return future if self._writing else None
+
+    def send(self, message: str, coalesce_key: Optional[Hashable] = None,
+             priority: int = PRIORITY_NORMAL):
+        """
+        Send a serialized message to this client. If a previous write has not
+        been flushed to the socket yet, the message is queued in priority
+        order and may be replaced by a newer message with the same
+        `coalesce_key`. With a `write_window`, messages are always queued and
+        written together once the window has passed.
+        :param message: serialized message to send
+        :param coalesce_key: optional key identifying replaceable messages
+        :param priority: priority class of the message
+        """
+        window = self.context.write_window
+        if not window and not self._flushing and not self._writing:
+            try:
+                future = self.write_message(message)
+            except WebSocketClosedError:
+                LOG.debug("Dropping message for closed connection")
+                return
+            self._write_future = future if self._writing else None
+            if self.context.tracer is not None:
+                self.context.tracer.written(self, message, self._write_future)
+            return
+        if self._send_queue is None:
+            self._send_queue = ClientSendQueue()
+        replaced = self._send_queue.put(message, coalesce_key, priority)
+        if replaced is not None and self.context.tracer is not None:
+            self.context.tracer.dropped(self, replaced)
+        if not self._flushing:
+            self._flushing = True
+            if window:
+                IOLoop.current().call_later(window, self._flush_send_queue)
+            else:
+                IOLoop.current().add_callback(self._flush_send_queue)
+
+    def send_spooled(self, message: SpooledMessage,
+                     priority: int = PRIORITY_NORMAL):
+        """
+        Queue a spooled message to be written to this client in chunks
+        :param message: SpooledMessage to send
+        :param priority: priority class of the message
+        """
+        if self._send_queue is None:
+            self._send_queue = ClientSendQueue()
+        self._send_queue.put(message, None, priority)
+        if not self._flushing:
+            self._flushing = True
+            IOLoop.current().add_callback(self._flush_send_queue)
+
+    async def _flush_send_queue(self):
+        """
+        Write queued messages as earlier writes are flushed to the socket
+        """
+        try:
+            while self._send_queue:
+                if self._write_future is not None:
+                    await self._write_future
+                message = self._send_queue.pop()
+                if isinstance(message, SpooledMessage):
+                    self._write_future = None
+                    await self._write_spooled(message)
+                    continue
+                if self.context.write_window and self._send_queue and \
+                        not isinstance(self._send_queue.peek(),
+                                       SpooledMessage):
+                    self._write_batch(message)
+                    continue
+                future = self.write_message(message)
+                self._write_future = future if self._writing else None
+                if self.context.tracer is not None:
+                    self.context.tracer.written(self, message,
+                                                self._write_future)
+        except (WebSocketClosedError, StreamClosedError):
+            LOG.debug(f"Connection closed with {len(self._send_queue)} "
+                      f"messages queued")
+            self._send_queue.clear()
+        finally:
+            self._flushing = False
+
+    def _write_batch(self, message: str):
+        """
+        Write a message and the messages queued after it (up to
+        `write_batch_bytes`) with one socket write, as a single batch frame
+        (a JSON array of messages) if the client asked for batches
+        :param message: first message of the batch
+        """
+        messages = [message]
+        size = len(message)
+        while self._send_queue and size < self.context.write_batch_bytes \
+                and not isinstance(self._send_queue.peek(), SpooledMessage):
+            message = self._send_queue.pop()
+            messages.append(message)
+            size += len(message)
+        protocol = self.ws_connection
+        if protocol is None or protocol.is_closing():
+            raise WebSocketClosedError()
+        if self._batch_frames:
+            future = self.write_message("[" + ",".join(messages) + "]")
+            self._write_future = future if self._writing else None
+        elif self._raw_frames:
+            self._write_future = self._write_raw(
+                b"".join(encode_frame(message.encode("utf-8"))
+                         for message in messages))
+        else:
+            for message in messages:
+                future = self.write_message(message)
+            self._write_future = future if self._writing else None
+        if self.context.tracer is not None:
+            for message in messages:
+                self.context.tracer.written(self, message, self._write_future)
+
+    async def _write_spooled(self, message: SpooledMessage):
+        """
+        Write a spooled message as a fragmented websocket message, reading
+        one frame at a time from its file. Other messages queued meanwhile
+        are written after the last frame.
+        :param message: SpooledMessage to write
+        """
+        protocol = self.ws_connection
+        if protocol is None or protocol.is_closing():
+            raise WebSocketClosedError()
+        if not self._frame_protocol:
+            # Without access to frames the message is sent in one piece
+            await self.write_message(
+                message.read(0, message.size).decode("utf-8"))
+            return
+        chunk_size = self.context.oversize.chunk_size
+        offset = 0
+        opcode = 0x1  # text; following frames are continuation frames (0x0)
+        try:
+            while offset < message.size:
+                chunk = message.read(offset, chunk_size)
+                offset += len(chunk)
+                # tornado has no public API for writing fragmented messages
+                await protocol._write_frame(offset >= message.size, opcode,
+                                            chunk)
+                opcode = 0x0
+        except StreamClosedError:
+            raise WebSocketClosedError()
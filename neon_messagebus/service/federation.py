@@ -0,0 +1,454 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hmac
+import json
+import socket
+
+from asyncio import Future
+from typing import Callable, Iterable, List, Optional, Union
+from ovos_utils.log import LOG
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError, WebSocketHandler, \
+    websocket_connect
+
+from neon_messagebus.service.event_handler import BusContext
+from neon_messagebus.service.namespaces import DEFAULT_NAMESPACE
+from neon_messagebus.service.send_queue import MessageTypeRules, \
+    PRIORITY_NORMAL
+from neon_messagebus.util.backoff import get_backoff
+from neon_messagebus.util.envelope import Envelope, get_message_type
+
+# Message context key listing the nodes a federated message has passed
+PATH_KEY = "federation_path"
+
+
+def _get_rules(patterns: Optional[Iterable[str]]) -> MessageTypeRules:
+    return MessageTypeRules({pattern: True for pattern in patterns or ()})
+
+
+class FederationLink:
+    __slots__ = ("federation", "context", "remote_node", "remote_rules",
+                 "_write", "_close", "_batch", "_batch_bytes",
+                 "_flush_handle", "_write_future", "sent", "received",
+                 "frames", "dropped", "rejected", "_namespace", "_inbound")
+
+    def __init__(self, federation: "Federation", write: Callable,
+                 close: Callable):
+        """
+        Link to one peer bus. Local messages of the types the peer
+        subscribed to are sent in batches; messages from the peer are checked
+        and scheduled like those from a local client with the identity
+        `federation:<node_id>`, then routed in the default namespace.
+        :param federation: Federation this link belongs to
+        :param write: method to write a frame to the peer
+        :param close: method to close the connection to the peer
+        """
+        self.federation = federation
+        self.context = federation.context
+        self.remote_node = None
+        self.remote_rules = MessageTypeRules()
+        self._write = write
+        self._close = close
+        self._batch = list()
+        self._batch_bytes = 0
+        self._flush_handle = None
+        self._write_future = None
+        self.sent = 0
+        self.received = 0
+        self.frames = 0
+        self.dropped = 0
+        self.rejected = 0
+        # Read by `NeonBusEventHandler.route` for messages from the peer
+        self._namespace = DEFAULT_NAMESPACE
+        self._inbound = None
+
+    @property
+    def identity(self) -> str:
+        """
+        Identity used for rate limits and metrics of messages from the peer
+        """
+        return f"federation:{self.remote_node}"
+
+    def send(self, message: str, coalesce_key=None,
+             priority: int = PRIORITY_NORMAL):
+        """
+        Forward a message routed on the local bus if the peer subscribed to
+        its type and it has not already passed through the peer
+        """
+        if not self.remote_rules:
+            return
+        msg_type = get_message_type(message)
+        if not msg_type or not self.remote_rules.get(msg_type, False):
+            return
+        if PATH_KEY in message:
+            try:
+                path = Envelope(message).context.get(PATH_KEY) or []
+            except ValueError:
+                return
+            if self.remote_node in path or \
+                    len(path) >= self.federation.max_hops:
+                return
+        if len(self._batch) >= self.federation.max_pending:
+            self._batch.pop(0)
+            self.dropped += 1
+        self._batch.append(message)
+        self._batch_bytes += len(message)
+        if len(self._batch) >= self.federation.batch_size or \
+                self._batch_bytes >= self.federation.frame_size:
+            self.flush()
+        elif not self._flush_handle:
+            self._flush_handle = IOLoop.current().call_later(
+                self.federation.batch_interval, self.flush)
+
+    def flush(self):
+        """
+        Write batched messages to the peer in one frame. If the peer has not
+        read the previous frame yet, messages keep batching until it does.
+        """
+        if self._flush_handle:
+            IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        if not self._batch:
+            return
+        if self._write_future and not self._write_future.done():
+            self._flush_handle = IOLoop.current().call_later(
+                self.federation.batch_interval, self.flush)
+            return
+        frame = f"[{','.join(self._batch)}]"
+        self.sent += len(self._batch)
+        self.frames += 1
+        self._batch = list()
+        self._batch_bytes = 0
+        self._write_frame(frame)
+
+    def write_hello(self):
+        """
+        Identify this node and its subscriptions to the peer
+        """
+        self._write_frame(json.dumps({
+            "federation": "hello", "node_id": self.federation.node_id,
+            "token": self.federation.token,
+            "subscribe": self.federation.subscriptions}))
+
+    def write_subscriptions(self):
+        """
+        Update the message types this node receives from the peer
+        """
+        self._write_frame(json.dumps({
+            "federation": "subscribe",
+            "subscribe": self.federation.subscriptions}))
+
+    def on_frame(self, frame: Union[str, bytes]) -> Optional[Future]:
+        """
+        Handle a frame received from the peer
+        :returns: Future to await before reading more from the peer if its
+            scheduler queue is full, else None
+        """
+        if isinstance(frame, bytes):
+            frame = frame.decode()
+        try:
+            data = json.loads(frame)
+        except ValueError:
+            LOG.warning(f"Invalid federation frame from {self.remote_node}")
+            return
+        if isinstance(data, dict):
+            self._on_control(data)
+        elif self.remote_node:
+            waiter = None
+            for message in data:
+                waiter = self._route(message) or waiter
+            return waiter
+        return None
+
+    def close(self):
+        """
+        Stop forwarding messages and close the connection to the peer
+        """
+        if self._flush_handle:
+            IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        self.federation.on_link_close(self)
+        self._close()
+
+    def get_metrics(self) -> dict:
+        return {"sent": self.sent, "received": self.received,
+                "frames": self.frames, "dropped": self.dropped,
+                "rejected": self.rejected, "pending": len(self._batch)}
+
+    def _write_frame(self, frame: str):
+        try:
+            self._write_future = self._write(frame)
+        except WebSocketClosedError:
+            LOG.debug(f"Link to {self.remote_node} closed")
+
+    def _on_control(self, data: dict):
+        kind = data.get("federation")
+        if kind == "hello":
+            token = data.get("token")
+            if not isinstance(token, str) or not hmac.compare_digest(
+                    token.encode(), self.federation.token.encode()):
+                LOG.warning(f"Rejected federation peer "
+                            f"{data.get('node_id')}: invalid token")
+                self.close()
+            elif not data.get("node_id") or \
+                    data["node_id"] == self.federation.node_id:
+                LOG.warning(f"Rejected federation peer with node_id="
+                            f"{data.get('node_id')}")
+                self.close()
+            else:
+                self.remote_node = data["node_id"]
+                self.remote_rules = _get_rules(data.get("subscribe"))
+                self._inbound = self.context.scheduler.register(
+                    self, self.identity)
+                self.federation.on_link_open(self)
+        elif kind == "subscribe" and self.remote_node:
+            self.remote_rules = _get_rules(data.get("subscribe"))
+
+    def _route(self, message: dict) -> Optional[Future]:
+        if not isinstance(message, dict):
+            return None
+        msg_type = message.get("type")
+        if not isinstance(msg_type, str) or \
+                not self.federation.rules.get(msg_type, False):
+            return None
+        context = message.get("context") or dict()
+        if not isinstance(context, dict):
+            LOG.debug(f"Dropping invalid message from {self.identity}")
+            self.rejected += 1
+            return None
+        path = list(context.get(PATH_KEY) or [])
+        if self.federation.node_id in path:
+            # Returned to this node through a cycle
+            return None
+        path.append(self.remote_node)
+        context[PATH_KEY] = path
+        message["context"] = context
+        message = json.dumps(message)
+        # Peers get the same checks as local clients; rejections are counted
+        # here since there is no client to reply to
+        oversize = self.context.oversize
+        if len(message) > self.context.max_message_size or \
+                (not oversize.spool and oversize.is_oversize(message)):
+            LOG.warning(f"Dropping {len(message)} byte message from "
+                        f"{self.identity}")
+            oversize.reject(message)
+            self.rejected += 1
+            return None
+        if self.context.validator is not None and \
+                self.context.validator.check(message) is not None:
+            LOG.debug(f"Dropping invalid message from {self.identity}")
+            self.rejected += 1
+            return None
+        if self.context.tracer is not None:
+            self.context.tracer.receive(message)
+        self.received += 1
+        return self.context.scheduler.submit(self._inbound, message)
+
+
+class FederationHandler(WebSocketHandler):
+    """
+    Accepts links from peers dialing this node
+    """
+    def initialize(self, federation: "Federation"):
+        self.federation = federation
+        self.link = None
+
+    @property
+    def max_message_size(self) -> int:
+        return self.federation.max_frame_size
+
+    def get_compression_options(self) -> Optional[dict]:
+        return {} if self.federation.compress else None
+
+    def open(self):
+        self.link = FederationLink(self.federation, self.write_message,
+                                   self.close)
+        self.link.write_hello()
+
+    def on_message(self, message: Union[str, bytes]) -> Optional[Future]:
+        return self.link.on_frame(message)
+
+    def on_close(self):
+        if self.link:
+            self.federation.on_link_close(self.link)
+
+
+class Federation:
+    def __init__(self, context: BusContext, node_id: Optional[str] = None,
+                 peers: Optional[List[str]] = None,
+                 subscribe: Optional[List[str]] = None,
+                 token: Optional[str] = None, route: str = "/federation",
+                 batch_size: int = 100, batch_interval: float = 0.01,
+                 frame_size: int = 1024 * 1024, max_pending: int = 10000,
+                 compress: bool = True, max_hops: int = 1,
+                 min_delay: float = 1, max_delay: float = 60):
+        """
+        Links this bus to peer buses. Each node subscribes to message types
+        from its peers; a node forwards only the types a peer subscribed to,
+        batched into frames over a (compressed) websocket. Forwarded messages
+        record the nodes they passed in `context["federation_path"]` and are
+        never sent back to a node on that path or over more than `max_hops`
+        links.
+        :param context: bus to federate
+        :param node_id: unique name of this node (defaults to the hostname)
+        :param peers: websocket URLs of peer federation routes to dial
+        :param subscribe: message types (or glob patterns) to receive
+        :param token: shared secret required from peers
+        :param route: path to accept peer links on
+        :param batch_size: maximum messages per frame
+        :param batch_interval: maximum seconds to wait to fill a frame
+        :param frame_size: bytes of messages after which a frame is sent
+        :param max_pending: maximum messages batched per link while a peer
+            is slow; the oldest are dropped
+        :param compress: negotiate permessage-deflate compression
+        :param max_hops: maximum links a message is forwarded over
+        :param min_delay: seconds to wait before redialing a peer
+        :param max_delay: maximum seconds to wait before redialing a peer
+        """
+        if not token:
+            raise ValueError("Federation requires a shared `token`")
+        self.context = context
+        self.node_id = node_id or socket.gethostname()
+        self.peers = list(peers or [])
+        self.subscriptions = list(subscribe or [])
+        self.rules = _get_rules(self.subscriptions)
+        self.token = token
+        self.route = route
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.frame_size = frame_size
+        self.max_pending = max(self.batch_size, max_pending)
+        self.compress = compress
+        self.max_hops = max_hops
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_frame_size = frame_size + context.max_message_size
+        self.links: List[FederationLink] = list()
+        self._clients = list()
+        self._stopping = False
+
+    def get_routes(self) -> list:
+        """
+        Get tornado routes for accepting links from peers
+        """
+        return [(self.route, FederationHandler, {"federation": self})]
+
+    def start(self):
+        """
+        Start dialing peers. Must be called on the bus event loop.
+        """
+        self._stopping = False
+        for url in self.peers:
+            IOLoop.current().spawn_callback(self._dial, url)
+
+    async def stop(self):
+        """
+        Stop dialing peers and close all links
+        """
+        self._stopping = True
+        for link in list(self.links):
+            link.close()
+        for connection in list(self._clients):
+            connection.close()
+
+    def subscribe(self, types: Iterable[str]):
+        """
+        Receive additional message types from peers
+        """
+        new = [t for t in types if t not in self.subscriptions]
+        if new:
+            self.subscriptions.extend(new)
+            self._update_subscriptions()
+
+    def unsubscribe(self, types: Iterable[str]):
+        """
+        Stop receiving message types from peers
+        """
+        types = set(types)
+        if types.intersection(self.subscriptions):
+            self.subscriptions = [t for t in self.subscriptions
+                                  if t not in types]
+            self._update_subscriptions()
+
+    def on_link_open(self, link: FederationLink):
+        LOG.info(f"Federation link to {link.remote_node} open")
+        self.links.append(link)
+        self.context.connections.append(link)
+
+    def on_link_close(self, link: FederationLink):
+        if link in self.links:
+            LOG.info(f"Federation link to {link.remote_node} closed")
+            self.links.remove(link)
+        if link in self.context.connections:
+            self.context.connections.remove(link)
+        self.context.scheduler.unregister(link)
+
+    def get_metrics(self) -> dict:
+        return {"node_id": self.node_id,
+                "subscriptions": list(self.subscriptions),
+                "links": {link.remote_node: link.get_metrics()
+                          for link in self.links}}
+
+    def _update_subscriptions(self):
+        self.rules = _get_rules(self.subscriptions)
+        for link in self.links:
+            link.write_subscriptions()
+
+    async def _dial(self, url: str):
+        failures = 0
+        while not self._stopping:
+            try:
+                connection = await websocket_connect(
+                    url, compression_options={} if self.compress else None,
+                    max_message_size=self.max_frame_size)
+            except Exception as e:
+                failures += 1
+                delay = get_backoff(failures, self.min_delay, self.max_delay)
+                LOG.warning(f"Failed to connect to federation peer {url} "
+                            f"({e}); retrying in {delay:.1f}s")
+                await gen.sleep(delay)
+                continue
+            failures = 0
+            self._clients.append(connection)
+            link = FederationLink(self, connection.write_message,
+                                  connection.close)
+            link.write_hello()
+            while True:
+                frame = await connection.read_message()
+                if frame is None:
+                    break
+                waiter = link.on_frame(frame)
+                if waiter is not None:
+                    await waiter
+            self.on_link_close(link)
+            self._clients.remove(connection)
+            if not self._stopping:
+                await gen.sleep(get_backoff(1, self.min_delay,
+                                            self.max_delay))
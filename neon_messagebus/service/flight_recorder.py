@@ -0,0 +1,145 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+
+from datetime import datetime
+from os import makedirs
+from os.path import expanduser, join
+from tempfile import gettempdir
+from time import time
+from typing import Optional
+
+from ovos_utils.log import LOG
+
+from neon_messagebus.util.envelope import get_message_type
+
+
+class FlightRecorder:
+    def __init__(self, size: int = 1024, record_bytes: int = 4096,
+                 dump_dir: Optional[str] = None):
+        """
+        Fixed-size ring of the most recently routed messages, kept for
+        post-mortem debugging. Slots are allocated up front and overwritten
+        in place; recording a message stores a reference to the routed string
+        (no copy) if it is at most `record_bytes` long, else only its type.
+        Message types of stored messages are parsed when the ring is dumped.
+        :param size: number of messages to keep
+        :param record_bytes: largest message kept in full
+        :param dump_dir: directory dumps are written to (system temp default)
+        """
+        self.size = size
+        self.record_bytes = record_bytes
+        self.dump_dir = expanduser(dump_dir or join(gettempdir(),
+                                                    "neon_messagebus"))
+        self._times = [0.0] * size
+        self._sizes = [0] * size
+        self._messages = [None] * size
+        self._types = [None] * size
+        self._senders = [None] * size
+        self._priorities = [0] * size
+        self._fanouts = [0] * size
+        self._next = 0
+        self.recorded = 0
+
+    def record(self, message: str, sender, priority: int, fanout: int):
+        """
+        Record a routed message
+        :param message: serialized message
+        :param sender: connection the message was received from
+        :param priority: priority class the message was routed with
+        :param fanout: number of connections the message was routed to
+        """
+        i = self._next
+        self._times[i] = time()
+        size = self._sizes[i] = len(message)
+        if size <= self.record_bytes:
+            self._messages[i] = message
+            self._types[i] = None
+        else:
+            self._messages[i] = None
+            self._types[i] = get_message_type(message, parse=False)
+        self._senders[i] = sender
+        self._priorities[i] = priority
+        self._fanouts[i] = fanout
+        self._next = i + 1 if i + 1 < self.size else 0
+        self.recorded += 1
+
+    def get_entries(self) -> list:
+        """
+        Get recorded messages, oldest first
+        :returns: list of dict `time`, `type`, `size`, `sender`, `priority`,
+            `fanout`, and `message` (None if it was too large to keep)
+        """
+        count = min(self.recorded, self.size)
+        # Negative indices wrap around to the end of the ring
+        start = self._next - count
+        entries = list()
+        for i in range(start, start + count):
+            message = self._messages[i]
+            sender = self._senders[i]
+            entries.append({
+                "time": self._times[i],
+                "type": self._types[i] if message is None else
+                get_message_type(message),
+                "size": self._sizes[i],
+                "sender": getattr(sender, "identity", None) or
+                getattr(sender, "remote_node", None),
+                "priority": self._priorities[i],
+                "fanout": self._fanouts[i],
+                "message": message})
+        return entries
+
+    def dump(self, reason: str) -> Optional[str]:
+        """
+        Write recorded messages to a new file in `dump_dir`
+        :param reason: why the dump was requested, saved in the file
+        :returns: path to the written file, or None if writing failed
+        """
+        dumped = datetime.now()
+        path = join(self.dump_dir, f"flight_recorder_"
+                                   f"{dumped.strftime('%Y%m%d-%H%M%S-%f')}"
+                                   f".json")
+        try:
+            makedirs(self.dump_dir, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump({"reason": reason,
+                           "dumped": dumped.timestamp(),
+                           "recorded": self.recorded,
+                           "messages": self.get_entries()}, f)
+        except OSError as e:
+            LOG.error(f"Failed to write flight recorder dump: {e}")
+            return None
+        LOG.info(f"Wrote flight recorder dump ({reason}) to {path}")
+        return path
+
+    def get_metrics(self) -> dict:
+        """
+        Get flight recorder settings and counters
+        """
+        return {"size": self.size, "recorded": self.recorded}
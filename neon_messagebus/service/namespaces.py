@@ -0,0 +1,131 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import Dict, List, Optional
+
+from neon_messagebus.service.send_queue import MessageTypeRules
+from neon_messagebus.util.envelope import get_message_type
+
+DEFAULT_NAMESPACE = ""
+
+
+class Namespaces:
+    def __init__(self, tokens: Optional[Dict[str, str]] = None,
+                 require_token: bool = False,
+                 bridge: Optional[Dict[str, List[str]]] = None):
+        """
+        Isolates groups of connections on one bus. Connections authenticate
+        with a token bound to a namespace and messages are only routed within
+        the sender's namespace, unless their type is bridged to other
+        namespaces. Connections without a token are in the default namespace
+        (named ""), with the service's own client and federation links.
+        :param tokens: dict of token to namespace name
+        :param require_token: if True, reject connections without a token
+        :param bridge: dict of message type (or glob pattern) to a list of
+            namespaces messages of that type are also routed to; "*" routes
+            to every namespace
+        """
+        self.tokens = dict(tokens or dict())
+        self.require_token = require_token
+        self.bridge = MessageTypeRules({msg_type: tuple(namespaces or ())
+                                        for msg_type, namespaces in
+                                        (bridge or dict()).items()})
+        # Connections in each namespace other than the default namespace
+        self.connections: Dict[str, list] = dict()
+        self.rejected = 0
+
+    def __len__(self):
+        return sum(len(c) for c in self.connections.values())
+
+    def authenticate(self, token: Optional[str]) -> Optional[str]:
+        """
+        Get the namespace for a connection
+        :param token: token sent by the client, if any
+        :returns: namespace name, or None if the connection is not allowed
+        """
+        if token is None and not self.require_token:
+            return DEFAULT_NAMESPACE
+        namespace = self.tokens.get(token) if token is not None else None
+        if namespace is None:
+            self.rejected += 1
+        return namespace
+
+    def add(self, handler, namespace: str):
+        """
+        Add a connection to a namespace other than the default namespace
+        """
+        self.connections.setdefault(namespace, list()).append(handler)
+
+    def remove(self, handler, namespace: str):
+        """
+        Remove a connection added with `add`
+        """
+        connections = self.connections.get(namespace)
+        if connections and handler in connections:
+            connections.remove(handler)
+            if not connections:
+                del self.connections[namespace]
+
+    def get_all(self) -> list:
+        """
+        Get connections in all namespaces other than the default namespace
+        """
+        return [c for connections in list(self.connections.values())
+                for c in connections]
+
+    def get_targets(self, message: str, namespace: str,
+                    default_connections: list) -> tuple:
+        """
+        Get the connections a message from `namespace` is routed to
+        :param message: serialized message
+        :param namespace: namespace of the sender
+        :param default_connections: connections in the default namespace
+        :returns: tuple of connection lists, one per namespace
+        """
+        own = default_connections if namespace == DEFAULT_NAMESPACE else \
+            self.connections.get(namespace, ())
+        if not self.bridge:
+            return own,
+        msg_type = get_message_type(message)
+        bridged = self.bridge.get(msg_type) if msg_type else None
+        if not bridged:
+            return own,
+        if "*" in bridged:
+            return (default_connections, *self.connections.values())
+        return (own, *(default_connections if name == DEFAULT_NAMESPACE else
+                       self.connections.get(name, ())
+                       for name in bridged if name != namespace))
+
+    def get_metrics(self) -> dict:
+        """
+        Get the number of connections per namespace and rejected handshakes
+        """
+        return {"connections": {namespace: len(connections) for
+                                namespace, connections in
+                                list(self.connections.items())},
+                "rejected": self.rejected}
@@ -0,0 +1,202 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque
+from time import time
+from typing import Dict, Optional
+
+from neon_messagebus.util.envelope import get_message_type
+
+
+def percentile(values: list, pct: float) -> float:
+    """
+    Get a percentile of some values by the nearest-rank method
+    :param values: non-empty list of numbers
+    :param pct: percentile to get, from 0 to 100
+    :returns: the value at `pct`
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class TrafficProfiler:
+    def __init__(self, sample_every: int = 1, reply_timeout: float = 30,
+                 max_latencies: int = 1000):
+        """
+        Aggregates bus traffic by message type and sender, and measures the
+        time from a request to its reply. A message is treated as a reply to
+        the oldest unanswered message whose type is a prefix of its own, such
+        as `neon.check_for_signal` -> `neon.check_for_signal.<name>` or `x`
+        -> `x.response`.
+        :param sample_every: record every Nth message and scale the counts;
+            request/reply pairs are only reliable with 1
+        :param reply_timeout: seconds after which a request is unanswered
+        :param max_latencies: latencies kept per request type
+        """
+        self.sample_every = max(1, int(sample_every))
+        self.reply_timeout = reply_timeout
+        self.max_latencies = max_latencies
+        self.started = time()
+        self.messages = 0
+        self.bytes = 0
+        # type -> [count, bytes, bytes sent to all recipients]
+        self._types: Dict[Optional[str], list] = dict()
+        # sender -> [count, bytes]
+        self._talkers: Dict[str, list] = dict()
+        self._pending: Dict[str, deque] = dict()
+        self._latencies: Dict[str, deque] = dict()
+        self._skip = 1
+
+    def sample(self, message: str, sender, fanout: int):
+        """
+        Record every `sample_every`th routed message
+        :param message: serialized message
+        :param sender: connection the message was received from
+        :param fanout: number of connections the message was routed to
+        """
+        self._skip -= 1
+        if self._skip:
+            return
+        self._skip = self.sample_every
+        self.add(get_message_type(message, parse=False), len(message),
+                 getattr(sender, "identity", None) or
+                 getattr(sender, "remote_node", None), fanout)
+
+    def add(self, msg_type: Optional[str], size: int,
+            sender: Optional[str] = None, fanout: int = 1,
+            timestamp: Optional[float] = None):
+        """
+        Record one message
+        :param msg_type: message type
+        :param size: serialized message length
+        :param sender: identity of the sending client, if known
+        :param fanout: number of clients the message was sent to
+        :param timestamp: time the message was seen, defaults to now
+        """
+        timestamp = timestamp or time()
+        weight = self.sample_every
+        self.messages += weight
+        self.bytes += size * weight
+        stats = self._types.get(msg_type)
+        if stats is None:
+            stats = self._types[msg_type] = [0, 0, 0]
+        stats[0] += weight
+        stats[1] += size * weight
+        stats[2] += size * fanout * weight
+        if sender:
+            talker = self._talkers.get(sender)
+            if talker is None:
+                talker = self._talkers[sender] = [0, 0]
+            talker[0] += weight
+            talker[1] += size * weight
+        if msg_type:
+            self._match_reply(msg_type, timestamp)
+            pending = self._pending.get(msg_type)
+            if pending is None:
+                pending = self._pending[msg_type] = \
+                    deque(maxlen=self.max_latencies)
+            pending.append(timestamp)
+
+    def _match_reply(self, msg_type: str, timestamp: float):
+        request = msg_type
+        while "." in request:
+            request = request.rsplit(".", 1)[0]
+            pending = self._pending.get(request)
+            while pending and timestamp - pending[0] > self.reply_timeout:
+                pending.popleft()
+            if pending:
+                latencies = self._latencies.get(request)
+                if latencies is None:
+                    latencies = self._latencies[request] = \
+                        deque(maxlen=self.max_latencies)
+                latencies.append(timestamp - pending.popleft())
+                return
+
+    def get_report(self, top: int = 10) -> dict:
+        """
+        Get the busiest message types and senders, and reply latencies
+        :param top: number of entries in each list
+        :returns: dict report
+        """
+        types = [{"type": msg_type, "count": count, "bytes": size,
+                  "fanout_bytes": fanout}
+                 for msg_type, (count, size, fanout) in self._types.items()]
+        talkers = [{"client": client, "count": count, "bytes": size}
+                   for client, (count, size) in self._talkers.items()]
+        latency = [{"request": request, "replies": len(values),
+                    "p50": percentile(values, 50),
+                    "p90": percentile(values, 90),
+                    "p99": percentile(values, 99),
+                    "max": max(values)}
+                   for request, values in self._latencies.items() if values]
+        return {
+            "duration": time() - self.started,
+            "sample_every": self.sample_every,
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "top_count": sorted(types, key=lambda t: -t["count"])[:top],
+            "top_bytes": sorted(types, key=lambda t: -t["bytes"])[:top],
+            "top_fanout": sorted(types,
+                                 key=lambda t: -t["fanout_bytes"])[:top],
+            "talkers": sorted(talkers, key=lambda t: -t["bytes"])[:top],
+            "latency": sorted(latency, key=lambda t: -t["replies"])[:top]}
+
+
+def format_report(report: dict) -> str:
+    """
+    Format a `TrafficProfiler` report as text tables
+    :param report: dict report
+    :returns: printable report
+    """
+    duration = max(report["duration"], 0.001)
+    lines = [f"{report['messages']} messages, {report['bytes']} bytes in "
+             f"{report['duration']:.1f}s ({report['messages'] / duration:.1f}"
+             f" msg/s)"]
+    if report["sample_every"] > 1:
+        lines[0] += f", sampling 1 in {report['sample_every']}"
+    for title, key in (("By count", "top_count"), ("By bytes", "top_bytes"),
+                       ("By fan-out bytes", "top_fanout")):
+        lines.extend(["", f"{title:<40} {'msgs':>10} {'msg/s':>8} "
+                          f"{'bytes':>12} {'fan-out':>12}"])
+        for entry in report[key]:
+            lines.append(f"{str(entry['type'])[:40]:<40} "
+                         f"{entry['count']:>10} "
+                         f"{entry['count'] / duration:>8.1f} "
+                         f"{entry['bytes']:>12} {entry['fanout_bytes']:>12}")
+    lines.extend(["", f"{'Top talkers':<40} {'msgs':>10} {'bytes':>12}"])
+    for entry in report["talkers"]:
+        size = "-" if entry["bytes"] is None else entry["bytes"]
+        lines.append(f"{str(entry['client'])[:40]:<40} {entry['count']:>10} "
+                     f"{size:>12}")
+    lines.extend(["", f"{'Reply latency (ms)':<40} {'replies':>10} "
+                      f"{'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}"])
+    for entry in report["latency"]:
+        lines.append(f"{entry['request'][:40]:<40} {entry['replies']:>10} " +
+                     " ".join(f"{1000 * entry[k]:>8.1f}"
+                              for k in ("p50", "p90", "p99", "max")))
+    return "\n".join(lines)
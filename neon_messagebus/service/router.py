@@ -0,0 +1,168 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+
+from abc import ABC, abstractmethod
+from typing import Hashable, List, Optional
+
+from tornado.ioloop import IOLoop
+
+from neon_messagebus.service.send_queue import PRIORITY_NORMAL
+
+_FIN_TEXT = 0x81
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    Encode an unmasked, uncompressed websocket text frame as sent by a server
+    :param payload: UTF-8 encoded message
+    :returns: frame header and payload
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", _FIN_TEXT, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", _FIN_TEXT, 126, length)
+    else:
+        header = struct.pack("!BBQ", _FIN_TEXT, 127, length)
+    return header + payload
+
+
+class Router(ABC):
+    """
+    Sends routed messages to connected clients. Implementations must keep
+    the order of messages for each client.
+    """
+    name = None
+
+    @abstractmethod
+    def route(self, message: str, connections: list,
+              coalesce_key: Optional[Hashable] = None,
+              priority: int = PRIORITY_NORMAL):
+        """
+        Send a message to every connection
+        :param message: serialized message
+        :param connections: connected handlers and other subscribers
+        :param coalesce_key: optional key identifying replaceable messages
+        :param priority: priority class of the message
+        """
+
+    def flush(self):
+        """
+        Send any messages held back by this router
+        """
+
+    def get_metrics(self) -> dict:
+        return {"name": self.name}
+
+
+class BroadcastRouter(Router):
+    """
+    Reference router; hands each message to every connection as it is routed
+    """
+    name = "broadcast"
+
+    def route(self, message: str, connections: list,
+              coalesce_key: Optional[Hashable] = None,
+              priority: int = PRIORITY_NORMAL):
+        for client in connections:
+            client.send(message, coalesce_key, priority)
+
+
+class BatchedRouter(Router):
+    def __init__(self):
+        """
+        Collects messages routed during one event loop iteration and writes
+        them to each idle connection with a single socket write. Frames are
+        encoded once per batch and the same buffer is written to every idle
+        connection; routing a message only appends it to the batch.
+        Connections that are still sending earlier data, use compression, or
+        are not client handlers (such as federation links) get each message
+        through their own `send` so queueing and coalescing apply as usual.
+        """
+        self._messages: List[str] = list()
+        self._keys: List[Optional[Hashable]] = list()
+        self._priorities: List[int] = list()
+        self._connections = None
+        self.batches = 0
+        self.batched = 0
+
+    name = "batched"
+
+    def route(self, message: str, connections: list,
+              coalesce_key: Optional[Hashable] = None,
+              priority: int = PRIORITY_NORMAL):
+        if self._messages and connections is not self._connections:
+            # A batch is written to one list of connections (namespace)
+            self.flush()
+        if not self._messages:
+            IOLoop.current().add_callback(self.flush)
+        self._messages.append(message)
+        self._keys.append(coalesce_key)
+        self._priorities.append(priority)
+        self._connections = connections
+
+    def flush(self):
+        if not self._messages:
+            return
+        messages, self._messages = self._messages, list()
+        keys, self._keys = self._keys, list()
+        priorities, self._priorities = self._priorities, list()
+        self.batches += 1
+        self.batched += len(messages)
+        data = None
+        for client in list(self._connections):
+            if not getattr(client, "can_write_frames", False):
+                for message, key, priority in zip(messages, keys,
+                                                  priorities):
+                    client.send(message, key, priority)
+                continue
+            if data is None:
+                data = b"".join(encode_frame(message.encode("utf-8"))
+                                for message in messages)
+            client.write_frames(data)
+
+    def get_metrics(self) -> dict:
+        return {"name": self.name, "batches": self.batches,
+                "batched": self.batched}
+
+
+_ROUTERS = {router.name: router for router in (BroadcastRouter,
+                                                BatchedRouter)}
+
+
+def get_router(name: Optional[str] = None) -> Router:
+    """
+    Get a new router by name
+    :param name: `broadcast` (default) or `batched`
+    :returns: Router instance
+    """
+    if name not in (None, *_ROUTERS):
+        raise ValueError(f"Unknown router: {name}")
+    return _ROUTERS[name or BroadcastRouter.name]()
@@ -0,0 +1,407 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from asyncio import Future
+from collections import deque
+from time import monotonic
+from typing import Callable, Dict, Optional
+
+from tornado.ioloop import IOLoop
+
+from neon_messagebus.service.send_queue import PriorityRules, PRIORITY_HIGH
+from neon_messagebus.util.envelope import get_message_type
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "_tokens", "_last")
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """
+        Token bucket rate limiter
+        :param rate: tokens added per second
+        :param burst: maximum number of tokens (defaults to `rate`)
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = monotonic()
+
+    def consume(self, now: float) -> float:
+        """
+        Take a token from the bucket if one is available
+        :param now: current `time.monotonic` value
+        :returns: 0 if a token was taken, else seconds until one is available
+        """
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+class RateLimits:
+    def __init__(self, config: Optional[dict] = None):
+        """
+        Per-connection rate limits, parsed from `websocket.rate_limit`.
+        Limits are dicts with a `rate` in messages per second and an optional
+        `burst`; a rate of 0 means unlimited. `clients` limits replace the
+        `default` limit for matching client identities and `message_types`
+        limits replace the connection limit for messages of that type.
+        :param config: dict rate limit configuration
+        """
+        config = config or dict()
+        self.default = config.get("default") or dict()
+        self.clients = config.get("clients") or dict()
+        self.message_types = config.get("message_types") or dict()
+
+    @staticmethod
+    def _get_bucket(limit: dict) -> Optional[TokenBucket]:
+        if not limit or not limit.get("rate"):
+            return None
+        return TokenBucket(limit["rate"], limit.get("burst"))
+
+    def get_client_bucket(self, identity: str) -> Optional[TokenBucket]:
+        """
+        Get a new token bucket for a connection
+        :param identity: client identity of the connection
+        :returns: TokenBucket, or None if the connection is unlimited
+        """
+        return self._get_bucket(self.clients.get(identity, self.default))
+
+    def get_type_bucket(self, msg_type: str) -> Optional[TokenBucket]:
+        """
+        Get a new token bucket for one message type on one connection
+        :param msg_type: message type with a configured limit
+        :returns: TokenBucket, or None if the message type is unlimited
+        """
+        return self._get_bucket(self.message_types[msg_type])
+
+
+class ConnectionState:
+    __slots__ = ("handler", "identity", "bucket", "type_buckets", "queues",
+                 "deficits", "in_lane", "parked", "waiter", "received",
+                 "throttled")
+
+    def __init__(self, handler, identity: str,
+                 bucket: Optional[TokenBucket]):
+        """
+        Inbound scheduling state for one client connection. Queues are only
+        allocated once messages from the connection have to be deferred.
+        :param handler: NeonBusEventHandler for the connection
+        :param identity: client identity used for limits and metrics
+        :param bucket: optional connection rate limit
+        """
+        self.handler = handler
+        self.identity = identity
+        self.bucket = bucket
+        self.type_buckets: Optional[Dict[str, Optional[TokenBucket]]] = None
+        # Normal and low priority lanes; high priority messages are only
+        # queued (in the normal lane) while the connection is throttled
+        self.queues = None
+        self.deficits = None
+        self.in_lane = None
+        self.parked = False
+        self.waiter: Optional[Future] = None
+        self.received = 0
+        self.throttled = 0
+
+    @property
+    def queued(self) -> int:
+        if self.queues is None:
+            return 0
+        return len(self.queues[0]) + len(self.queues[1])
+
+    def enqueue(self, lane: int, message: str, msg_type: Optional[str],
+                priority: int):
+        """
+        Queue a deferred message
+        :param lane: 0 for normal (or throttled high) priority, 1 for low
+        :param message: serialized message
+        :param msg_type: message type, if known
+        :param priority: priority class to route the message with
+        """
+        if self.queues is None:
+            self.queues = (deque(), deque())
+            self.deficits = [0, 0]
+            self.in_lane = [False, False]
+        self.queues[lane].append((message, msg_type, priority))
+
+
+class FairScheduler:
+    def __init__(self, route: Callable[[object, str, int], None],
+                 rate_limits: Optional[RateLimits] = None,
+                 priority_rules: Optional[PriorityRules] = None,
+                 quantum: int = 65536, batch: int = 256,
+                 max_pending: int = 1024):
+        """
+        Deficit round-robin scheduler for messages received from clients.
+        Messages are routed immediately while the loop is not under
+        contention; otherwise they are queued per connection and each
+        connection may route up to `quantum` bytes per round. High priority
+        messages are always routed immediately and low priority messages are
+        routed only when no normal priority messages are queued.
+        :param route: callback to route a message, called with the receiving
+            handler, the serialized message, and its priority
+        :param rate_limits: optional per-connection rate limits
+        :param priority_rules: optional message type priority classes
+        :param quantum: bytes each connection may route per round
+        :param batch: maximum messages routed per event loop iteration
+        :param max_pending: queued messages after which reads from a
+            connection are paused until its queue drains
+        """
+        self._route = route
+        self.rate_limits = rate_limits or RateLimits()
+        # Empty rules are falsy; they disable priorities rather than
+        # selecting the defaults
+        self.priority_rules = PriorityRules() if priority_rules is None \
+            else priority_rules
+        self.quantum = quantum
+        self.batch = batch
+        self.max_pending = max_pending
+        self._active = (deque(), deque())
+        self._connections: Dict[object, ConnectionState] = dict()
+        self._scheduled = False
+        self._tick_count = 0
+        self.routed = 0
+        self.deferred = 0
+        self.throttled = 0
+
+    def register(self, handler, identity: str) -> ConnectionState:
+        """
+        Add a client connection to the scheduler
+        :param handler: NeonBusEventHandler for the connection
+        :param identity: client identity used for limits and metrics
+        :returns: ConnectionState for the connection
+        """
+        state = ConnectionState(handler, identity,
+                                self.rate_limits.get_client_bucket(identity))
+        self._connections[handler] = state
+        return state
+
+    def unregister(self, handler):
+        """
+        Remove a closed client connection. Messages already received from it
+        are still routed.
+        :param handler: NeonBusEventHandler for the connection
+        """
+        state = self._connections.pop(handler, None)
+        if state:
+            self._release_waiter(state, force=True)
+
+    def submit(self, state: ConnectionState,
+               message: str) -> Optional[Future]:
+        """
+        Schedule a message received from a client for routing
+        :param state: ConnectionState of the sending connection
+        :param message: serialized message
+        :returns: Future to await before reading more from this connection
+            if its queue is full, else None
+        """
+        state.received += 1
+        msg_type = self._get_type(message)
+        priority = self.priority_rules.get_priority(msg_type)
+        if priority == PRIORITY_HIGH:
+            # High priority messages skip the queues but not the rate limits
+            wait = self._check_rate(state, msg_type)
+            if not wait:
+                self.routed += 1
+                self._route(state.handler, message, priority)
+                return None
+            state.enqueue(0, message, msg_type, priority)
+            if not state.parked:
+                self._park(state, wait)
+            self.deferred += 1
+            return self._get_waiter(state)
+        lane = priority - 1
+        if not state.parked and not state.queued and \
+                self._tick_count < self.batch:
+            wait = self._check_rate(state, msg_type)
+            if not wait:
+                self._count_tick()
+                self.routed += 1
+                self._route(state.handler, message, priority)
+                return None
+            state.enqueue(lane, message, msg_type, priority)
+            self._park(state, wait)
+        else:
+            state.enqueue(lane, message, msg_type, priority)
+            self._activate(state, lane)
+        self.deferred += 1
+        self._schedule()
+        return self._get_waiter(state)
+
+    def reconfigure(self, rate_limits: Optional[RateLimits] = None,
+                    priority_rules: Optional[PriorityRules] = None,
+                    quantum: int = 65536, batch: int = 256,
+                    max_pending: int = 1024):
+        """
+        Apply new settings to the scheduler and all registered connections.
+        Queued messages are kept; rate limit buckets are replaced, so each
+        connection starts again with a full burst.
+        :param rate_limits: optional per-connection rate limits
+        :param priority_rules: optional message type priority classes
+        :param quantum: bytes each connection may route per round
+        :param batch: maximum messages routed per event loop iteration
+        :param max_pending: queued messages after which reads from a
+            connection are paused until its queue drains
+        """
+        self.rate_limits = rate_limits or RateLimits()
+        # Empty rules are falsy; they disable priorities rather than
+        # selecting the defaults
+        self.priority_rules = PriorityRules() if priority_rules is None \
+            else priority_rules
+        self.quantum = quantum
+        self.batch = batch
+        self.max_pending = max_pending
+        for state in self._connections.values():
+            state.bucket = self.rate_limits.get_client_bucket(state.identity)
+            state.type_buckets = None
+            self._release_waiter(state)
+
+    def get_metrics(self) -> dict:
+        """
+        Get scheduler counters and per-client stats, aggregated by identity
+        """
+        clients = dict()
+        for state in list(self._connections.values()):
+            stats = clients.setdefault(state.identity,
+                                       {"connections": 0, "received": 0,
+                                        "throttled": 0, "queued": 0})
+            stats["connections"] += 1
+            stats["received"] += state.received
+            stats["throttled"] += state.throttled
+            stats["queued"] += state.queued
+        return {"routed": self.routed,
+                "deferred": self.deferred,
+                "throttled": self.throttled,
+                "clients": clients}
+
+    def _get_type(self, message: str) -> Optional[str]:
+        if not self.rate_limits.message_types and not self.priority_rules:
+            return None
+        return get_message_type(message)
+
+    def _check_rate(self, state: ConnectionState,
+                    msg_type: Optional[str]) -> float:
+        if msg_type in self.rate_limits.message_types:
+            if state.type_buckets is None:
+                state.type_buckets = dict()
+            if msg_type not in state.type_buckets:
+                state.type_buckets[msg_type] = \
+                    self.rate_limits.get_type_bucket(msg_type)
+            bucket = state.type_buckets[msg_type]
+        else:
+            bucket = state.bucket
+        if bucket is None:
+            return 0
+        wait = bucket.consume(monotonic())
+        if wait:
+            state.throttled += 1
+            self.throttled += 1
+        return wait
+
+    def _count_tick(self):
+        if not self._tick_count:
+            IOLoop.current().add_callback(self._reset_tick)
+        self._tick_count += 1
+
+    def _reset_tick(self):
+        self._tick_count = 0
+
+    def _schedule(self):
+        if not self._scheduled and (self._active[0] or self._active[1]):
+            self._scheduled = True
+            IOLoop.current().add_callback(self._run)
+
+    def _activate(self, state: ConnectionState, lane: int):
+        if not state.parked and not state.in_lane[lane]:
+            state.in_lane[lane] = True
+            self._active[lane].append(state)
+
+    def _park(self, state: ConnectionState, wait: float):
+        state.parked = True
+        IOLoop.current().call_later(wait, self._unpark, state)
+
+    def _unpark(self, state: ConnectionState):
+        state.parked = False
+        for lane, queue in enumerate(state.queues):
+            if queue:
+                self._activate(state, lane)
+        self._schedule()
+
+    def _get_waiter(self, state: ConnectionState) -> Optional[Future]:
+        if state.queued >= self.max_pending:
+            if state.waiter is None:
+                state.waiter = Future()
+            return state.waiter
+        return None
+
+    def _release_waiter(self, state: ConnectionState, force: bool = False):
+        if state.waiter is not None and \
+                (force or state.queued <= self.max_pending // 2):
+            if not state.waiter.done():
+                state.waiter.set_result(None)
+            state.waiter = None
+
+    def _run(self):
+        """
+        Route queued messages in deficit round-robin order, up to `batch`
+        messages per loop iteration. Low priority messages are only routed
+        once no normal priority messages are queued.
+        """
+        self._scheduled = False
+        budget = self.batch
+        for lane, active in enumerate(self._active):
+            while active and budget > 0:
+                state = active.popleft()
+                state.in_lane[lane] = False
+                if state.parked:
+                    continue
+                queue = state.queues[lane]
+                state.deficits[lane] += self.quantum
+                while queue and budget > 0:
+                    message, msg_type, priority = queue[0]
+                    if len(message) > state.deficits[lane]:
+                        break
+                    wait = self._check_rate(state, msg_type)
+                    if wait:
+                        self._park(state, wait)
+                        break
+                    queue.popleft()
+                    state.deficits[lane] -= len(message)
+                    budget -= 1
+                    self.routed += 1
+                    self._route(state.handler, message, priority)
+                self._release_waiter(state)
+                if not queue:
+                    state.deficits[lane] = 0
+                else:
+                    self._activate(state, lane)
+        self._schedule()
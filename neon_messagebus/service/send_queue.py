@@ -0,0 +1,214 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque
+from fnmatch import fnmatchcase
+from typing import Any, Dict, List, Optional, Hashable
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_CLASSES = {"high": PRIORITY_HIGH,
+                    "normal": PRIORITY_NORMAL,
+                    "low": PRIORITY_LOW}
+
+_DEFAULT_PRIORITY = {
+    "high": ["mycroft.stop", "mycroft.audio.speech.stop",
+             "mycroft.audio.stop", "recognizer_loop:utterance",
+             "recognizer_loop:wakeword", "recognizer_loop:record_begin",
+             "recognizer_loop:record_end", "speak", "*.abort"],
+    # `gui.value.set` stays normal so values arrive before the
+    # `gui.page.show` that displays them
+    "low": ["mycroft.binary.*", "gui.page.upload"]
+}
+
+
+class MessageTypeRules:
+    def __init__(self, rules: Optional[Dict[str, Any]] = None):
+        """
+        Values configured per message type. Types may be glob patterns; exact
+        types take precedence, then patterns in the configured order.
+        :param rules: dict of message type (or glob pattern) to value
+        """
+        rules = rules or dict()
+        self._exact = {msg_type: value for msg_type, value in rules.items()
+                       if not any(c in msg_type for c in "*?[")}
+        self._patterns = [(pattern, value) for pattern, value in rules.items()
+                          if pattern not in self._exact]
+        self._pattern_cache: Dict[str, Any] = dict()
+
+    def __bool__(self):
+        return bool(self._exact or self._patterns)
+
+    def get(self, msg_type: str, default: Any = None) -> Any:
+        """
+        Get the value configured for a message type
+        :param msg_type: message type to look up
+        :param default: value to return if no rule matches
+        :returns: configured value for `msg_type`, else `default`
+        """
+        if msg_type in self._exact:
+            return self._exact[msg_type]
+        if not self._patterns:
+            return default
+        if msg_type not in self._pattern_cache:
+            if len(self._pattern_cache) > 1024:
+                self._pattern_cache.clear()
+            self._pattern_cache[msg_type] = next(
+                (value for pattern, value in self._patterns
+                 if fnmatchcase(msg_type, pattern)), default)
+        return self._pattern_cache[msg_type]
+
+
+class CoalesceRules(MessageTypeRules):
+    def __init__(self, rules: Optional[Dict[str, List[str]]] = None):
+        """
+        Rules describing which message types are "latest value wins" updates.
+        :param rules: dict of message type (or glob pattern) to a list of
+            `data` keys that, with the message type, identify one value
+        """
+        MessageTypeRules.__init__(self, {msg_type: tuple(keys or ())
+                                         for msg_type, keys in
+                                         (rules or dict()).items()})
+
+    def get_key(self, message: dict) -> Optional[Hashable]:
+        """
+        Get the coalescing key for a deserialized message
+        :param message: dict deserialized Message
+        :returns: hashable key if the message may be coalesced, else None
+        """
+        msg_type = message.get("type")
+        if not isinstance(msg_type, str):
+            return None
+        data_keys = self.get(msg_type)
+        if data_keys is None:
+            return None
+        data = message.get("data") or dict()
+        return (msg_type,) + tuple(str(data.get(k)) for k in data_keys)
+
+
+class PriorityRules(MessageTypeRules):
+    def __init__(self, rules: Optional[Dict[str, List[str]]] = None):
+        """
+        Priority classes for message types. High priority messages are routed
+        ahead of any queued messages; low priority messages are routed and
+        sent only when no normal priority messages are waiting.
+        :param rules: dict of priority class ("high", "normal", "low") to a
+            list of message types (or glob patterns) in that class
+        """
+        rules = _DEFAULT_PRIORITY if rules is None else rules
+        MessageTypeRules.__init__(self, {
+            msg_type: PRIORITY_CLASSES[priority]
+            for priority, msg_types in rules.items()
+            for msg_type in msg_types or ()})
+
+    def get_priority(self, msg_type: Optional[str]) -> int:
+        """
+        Get the priority of a message type
+        :param msg_type: message type, or None if unknown
+        :returns: one of PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+        """
+        if msg_type is None:
+            return PRIORITY_NORMAL
+        return self.get(msg_type, PRIORITY_NORMAL)
+
+
+class ClientSendQueue:
+    __slots__ = ("_lanes", "_pending", "_size", "coalesced")
+
+    def __init__(self):
+        """
+        Queue of serialized messages waiting to be written to one client.
+        Messages are sent in priority order, then in the order queued.
+        Messages queued with a coalescing key replace a queued message with
+        the same key in place, so a slow client only receives the latest
+        value of each state update.
+        """
+        self._lanes = (deque(), deque(), deque())
+        self._pending = dict()
+        self._size = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, message: str, coalesce_key: Optional[Hashable] = None,
+            priority: int = PRIORITY_NORMAL) -> Optional[str]:
+        """
+        Add a message to the queue
+        :param message: serialized message to send
+        :param coalesce_key: optional key identifying replaceable messages
+        :param priority: priority class of the message
+        :returns: the queued message this one replaced, if any
+        """
+        if coalesce_key is None:
+            self._lanes[priority].append([message, None])
+            self._size += 1
+            return None
+        entry = self._pending.get(coalesce_key)
+        if entry is not None:
+            replaced, entry[0] = entry[0], message
+            self.coalesced += 1
+            return replaced
+        entry = [message, coalesce_key]
+        self._pending[coalesce_key] = entry
+        self._lanes[priority].append(entry)
+        self._size += 1
+        return None
+
+    def pop(self) -> str:
+        """
+        Remove and return the oldest queued message of the highest priority
+        """
+        for lane in self._lanes:
+            if lane:
+                message, coalesce_key = lane.popleft()
+                if coalesce_key is not None:
+                    self._pending.pop(coalesce_key, None)
+                self._size -= 1
+                return message
+        raise IndexError("pop from an empty queue")
+
+    def peek(self) -> str:
+        """
+        Return the message `pop` would return without removing it
+        """
+        for lane in self._lanes:
+            if lane:
+                return lane[0][0]
+        raise IndexError("peek at an empty queue")
+
+    def clear(self):
+        """
+        Drop all queued messages
+        """
+        for lane in self._lanes:
+            lane.clear()
+        self._pending.clear()
+        self._size = 0
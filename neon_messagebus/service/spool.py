@@ -0,0 +1,129 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+from tempfile import TemporaryFile
+from typing import Optional
+
+from ovos_bus_client import Message
+from tornado.ioloop import IOLoop
+
+from neon_messagebus.util.envelope import get_message_type
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SpooledMessage:
+    __slots__ = ("msg_type", "size", "_file")
+
+    def __init__(self, message: str, directory: Optional[str] = None):
+        """
+        A serialized message written to an anonymous temporary file so it can
+        be sent to clients in chunks instead of copied for each of them.
+        The file is removed when this object is garbage collected.
+        :param message: serialized message
+        :param directory: optional directory for the temporary file
+        """
+        self.msg_type = get_message_type(message, parse=False)
+        self._file = TemporaryFile(dir=directory)
+        self.size = self._file.write(message.encode())
+        self._file.flush()
+
+    def __len__(self):
+        return self.size
+
+    def read(self, offset: int, size: int) -> bytes:
+        """
+        Read part of the encoded message
+        :param offset: byte offset to read from
+        :param size: maximum number of bytes to read
+        """
+        return os.pread(self._file.fileno(), size, offset)
+
+
+class OversizePolicy:
+    def __init__(self, max_frame: int = 0, spool: bool = False,
+                 chunk_size: int = CHUNK_SIZE,
+                 spool_dir: Optional[str] = None):
+        """
+        Handling for messages larger than `max_frame`, parsed from the
+        `websocket` configuration. Oversize messages are rejected with a
+        `neon.messagebus.rejected` reply to the sender, or if `spool` is
+        True, written to a temporary file and sent to each client as a
+        fragmented websocket message of `chunk_size` byte frames.
+        :param max_frame: largest message relayed normally; 0 for no limit
+        :param spool: if True, spool oversize messages instead of rejecting
+        :param chunk_size: bytes per frame when sending a spooled message
+        :param spool_dir: optional directory for spooled messages
+        """
+        self.max_frame = max_frame or 0
+        self.spool = spool
+        self.chunk_size = chunk_size
+        self.spool_dir = spool_dir
+        self.rejected = 0
+        self.spooled = 0
+
+    def is_oversize(self, message: str) -> bool:
+        """
+        Check if a serialized message is larger than `max_frame`
+        """
+        return bool(self.max_frame) and len(message) > self.max_frame
+
+    def reject(self, message: str) -> str:
+        """
+        Count a rejected message and get the reply for its sender
+        :param message: oversize serialized message
+        :returns: serialized `neon.messagebus.rejected` message
+        """
+        self.rejected += 1
+        return Message("neon.messagebus.rejected",
+                       {"reason": "max_frame",
+                        "type": get_message_type(message, parse=False),
+                        "size": len(message),
+                        "max_frame": self.max_frame}).serialize()
+
+    async def spool_message(self, message: str) -> SpooledMessage:
+        """
+        Write an oversize message to a temporary file without blocking the
+        event loop
+        :param message: oversize serialized message
+        :returns: SpooledMessage to send to clients
+        """
+        spooled = await IOLoop.current().run_in_executor(
+            None, SpooledMessage, message, self.spool_dir)
+        self.spooled += 1
+        return spooled
+
+    def get_metrics(self) -> dict:
+        """
+        Get oversize message counters
+        """
+        return {"max_frame": self.max_frame,
+                "rejected": self.rejected,
+                "spooled": self.spooled}
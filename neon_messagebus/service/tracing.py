@@ -0,0 +1,334 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+
+from os import makedirs
+from os.path import dirname, expanduser, join
+from tempfile import gettempdir
+from time import time_ns
+from typing import Optional, Tuple
+
+from ovos_utils.log import LOG
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from neon_messagebus.util.envelope import Envelope, get_message_type
+from neon_messagebus.util.tracing import TRACEPARENT, format_traceparent, \
+    new_span_id, parse_traceparent
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_PRODUCER = 4
+SPAN_KIND_CONSUMER = 5
+
+
+class _Trace:
+    __slots__ = ("trace_id", "parent_id", "span_id", "message", "sender",
+                 "received", "routed")
+
+    def __init__(self, trace_id: str, parent_id: str, message: str,
+                 sender: str, received: int):
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = new_span_id()
+        self.message = message
+        self.sender = sender
+        self.received = received
+        self.routed = 0
+
+
+def _get_traceparent(message: str) -> Optional[Tuple[Envelope, str, str]]:
+    """
+    Read the traceparent from the context of a serialized message
+    :param message: serialized message
+    :returns: envelope of the message, trace ID and span ID, or None if the
+        message is not traced
+    """
+    if '"traceparent"' not in message:
+        return None
+    envelope = Envelope(message)
+    try:
+        traceparent = envelope.context.get(TRACEPARENT)
+    except ValueError:
+        return None
+    parsed = parse_traceparent(traceparent) \
+        if isinstance(traceparent, str) else None
+    return (envelope, *parsed) if parsed else None
+
+
+def _attributes(attributes: dict) -> list:
+    return [{"key": key, "value": {"intValue": str(value)}
+             if isinstance(value, int) else {"stringValue": str(value)}}
+            for key, value in attributes.items()]
+
+
+class Tracer:
+    def __init__(self, path: Optional[str] = None,
+                 endpoint: Optional[str] = None,
+                 service_name: str = "neon_messagebus",
+                 batch_size: int = 512, flush_interval: float = 1.0,
+                 max_pending: int = 10000):
+        """
+        Records spans for messages that carry a W3C `traceparent` in their
+        context. Each traced message gets a span (child of the sender's span)
+        with `receive` (waiting to be scheduled), `route` and per-client
+        `write` (queued until flushed to the socket) child spans. The
+        message is routed with its traceparent pointing at the message span,
+        so replies are recorded as its children. Spans are exported as OTLP
+        JSON, one `resourceSpans` batch per line.
+        :param path: file to append spans to; defaults to
+            <system temp>/neon_messagebus/traces.jsonl if no endpoint is set
+        :param endpoint: OTLP/HTTP traces URL to POST spans to, i.e.
+            http://localhost:4318/v1/traces
+        :param service_name: `service.name` resource attribute
+        :param batch_size: number of spans that triggers an export
+        :param flush_interval: max seconds between exports while tracing
+        :param max_pending: max messages waiting to be routed or written
+        """
+        self.endpoint = endpoint
+        if path or not endpoint:
+            path = expanduser(path or join(gettempdir(), "neon_messagebus",
+                                           "traces.jsonl"))
+        self.path = path
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.exported = 0
+        self._spans = list()
+        # Receive times by sender (trace ID, span ID), oldest first, and
+        # pending writes by (client, span ID). Messages are not keyed by
+        # `id()` since ids are reused once a message is freed.
+        self._received = dict()
+        self._writes = dict()
+        self._last_flush = time_ns()
+        self._flushing = False
+
+    def receive(self, message: str):
+        """
+        Note the time a message was received if it is traced
+        :param message: serialized message
+        """
+        traced = _get_traceparent(message)
+        if traced is None:
+            return
+        key = traced[1:]
+        received = self._received.get(key)
+        if received is not None:
+            # Messages from the same span are routed in the order received
+            received.append(time_ns())
+            return
+        self._received[key] = [time_ns()]
+        if len(self._received) > self.max_pending:
+            del self._received[next(iter(self._received))]
+
+    def discard(self, message: str):
+        """
+        Forget a received message that will not be routed with a trace
+        :param message: serialized message passed to `receive`
+        """
+        if self._received:
+            traced = _get_traceparent(message)
+            if traced is not None:
+                self._pop_received(traced[1:])
+
+    def start_route(self, message: str, sender) -> Optional[_Trace]:
+        """
+        Start routing a received message
+        :param message: serialized message
+        :param sender: connection the message was received from
+        :returns: trace to pass to `queue_write` and `end_route`, or None if
+            the message is not traced
+        """
+        if not self._received:
+            return None
+        traced = _get_traceparent(message)
+        if traced is None:
+            return None
+        envelope, trace_id, parent_id = traced
+        received = self._pop_received((trace_id, parent_id))
+        if received is None:
+            return None
+        trace = _Trace(trace_id, parent_id, message,
+                       getattr(sender, "identity", None) or
+                       getattr(sender, "remote_node", None), received)
+        trace.routed = time_ns()
+        # Downstream handlers reply as children of this message's span
+        trace.message = envelope.with_context(
+            {**envelope.context,
+             TRACEPARENT: format_traceparent(trace.trace_id, trace.span_id)})
+        self._add_span(trace, "receive", trace.received, trace.routed)
+        return trace
+
+    def queue_write(self, trace: _Trace, client):
+        """
+        Note that a traced message is being sent to a client
+        :param trace: trace returned by `start_route`
+        :param client: connection the message is sent to
+        """
+        self._writes[(id(client), trace.span_id)] = (trace, time_ns())
+        if len(self._writes) > self.max_pending:
+            del self._writes[next(iter(self._writes))]
+
+    def written(self, client, message: str, future=None):
+        """
+        Called when a message has been written to a client connection
+        :param client: connection the message was written to
+        :param message: serialized message
+        :param future: write future, if the write is not flushed yet
+        """
+        pending = self._pop_write(client, message)
+        if pending is None:
+            return
+        trace, start = pending
+        identity = getattr(client, "identity", None) or \
+            getattr(client, "remote_node", None)
+
+        def _finish(*_):
+            self._add_span(trace, "write", start, time_ns(),
+                           SPAN_KIND_PRODUCER, {"messaging.client_id":
+                                                str(identity)})
+        if future is None:
+            _finish()
+        else:
+            future.add_done_callback(_finish)
+
+    def dropped(self, client, message: str):
+        """
+        Called when a message queued for a client will not be written, i.e.
+        it was replaced by a coalesced update
+        :param client: connection the message was queued for
+        :param message: serialized message
+        """
+        self._pop_write(client, message)
+
+    def remove_client(self, client):
+        """
+        Forget pending writes to a closed connection
+        :param client: connection that was closed
+        """
+        if self._writes:
+            client_id = id(client)
+            for key in [key for key in self._writes if key[0] == client_id]:
+                del self._writes[key]
+
+    def end_route(self, trace: _Trace, fanout: int):
+        """
+        Finish routing a traced message
+        :param trace: trace returned by `start_route`
+        :param fanout: number of connections the message was routed to
+        """
+        now = time_ns()
+        self._add_span(trace, "route", trace.routed, now)
+        self._add_span(trace, get_message_type(trace.message, parse=False),
+                       trace.received, now, SPAN_KIND_CONSUMER,
+                       {"messaging.client_id": str(trace.sender),
+                        "messaging.message.body.size": len(trace.message),
+                        "messaging.neon.fanout": fanout},
+                       span_id=trace.span_id, parent_id=trace.parent_id)
+
+    def _pop_received(self, key: Tuple[str, str]) -> Optional[int]:
+        received = self._received.get(key)
+        if not received:
+            return None
+        if len(received) == 1:
+            del self._received[key]
+        return received.pop(0)
+
+    def _pop_write(self, client, message: str) -> Optional[tuple]:
+        if not self._writes:
+            return None
+        traced = _get_traceparent(message)
+        if traced is None:
+            return None
+        return self._writes.pop((id(client), traced[2]), None)
+
+    def _add_span(self, trace: _Trace, name: str, start: int, end: int,
+                  kind: int = SPAN_KIND_INTERNAL,
+                  attributes: Optional[dict] = None,
+                  span_id: Optional[str] = None,
+                  parent_id: Optional[str] = None):
+        self._spans.append({
+            "traceId": trace.trace_id,
+            "spanId": span_id or new_span_id(),
+            "parentSpanId": parent_id or trace.span_id,
+            "name": name,
+            "kind": kind,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(end),
+            "attributes": _attributes(attributes or dict())})
+        if not self._flushing and \
+                (len(self._spans) >= self.batch_size or
+                 end - self._last_flush > self.flush_interval * 1e9):
+            self._flushing = True
+            IOLoop.current().spawn_callback(self.flush)
+
+    def _get_payload(self, spans: list) -> str:
+        return json.dumps({"resourceSpans": [{
+            "resource": {"attributes": _attributes(
+                {"service.name": self.service_name})},
+            "scopeSpans": [{"scope": {"name": "neon_messagebus"},
+                            "spans": spans}]}]})
+
+    def _write(self, payload: str):
+        makedirs(dirname(self.path), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(payload + "\n")
+
+    async def flush(self):
+        """
+        Export recorded spans
+        """
+        spans, self._spans = self._spans, list()
+        self._last_flush = time_ns()
+        try:
+            if not spans:
+                return
+            payload = self._get_payload(spans)
+            if self.path:
+                await IOLoop.current().run_in_executor(None, self._write,
+                                                       payload)
+            if self.endpoint:
+                response = await AsyncHTTPClient().fetch(
+                    self.endpoint, method="POST", body=payload,
+                    headers={"Content-Type": "application/json"},
+                    raise_error=False)
+                if response.code >= 400:
+                    LOG.warning(f"Failed to export {len(spans)} spans: "
+                                f"{response.code}")
+            self.exported += len(spans)
+        except Exception as e:
+            LOG.error(f"Failed to export {len(spans)} spans: {e}")
+        finally:
+            self._flushing = False
+
+    def get_metrics(self) -> dict:
+        """
+        Get the number of exported and pending spans
+        """
+        return {"exported": self.exported, "pending": len(self._spans)}
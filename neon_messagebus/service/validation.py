@@ -0,0 +1,74 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import Optional
+
+from ovos_bus_client import Message
+
+from neon_messagebus.util.envelope import Envelope
+
+VALIDATION_MODES = ("envelope", "strict")
+
+
+class MessageValidator:
+    def __init__(self, mode: str = "envelope"):
+        """
+        Rejects malformed messages before they are routed, with a
+        `neon.messagebus.rejected` reply to the sender. `envelope` mode only
+        decodes the type and context of each message, so payloads are not
+        decoded; `strict` mode decodes and checks the whole message.
+        :param mode: `envelope` or `strict`
+        """
+        if mode not in VALIDATION_MODES:
+            raise ValueError(f"Unknown validation mode: {mode}")
+        self.mode = mode
+        self.strict = mode == "strict"
+        self.rejected = 0
+
+    def check(self, message: str) -> Optional[str]:
+        """
+        Validate a message received from a client
+        :param message: serialized message
+        :returns: serialized `neon.messagebus.rejected` reply if the message
+            is not valid, else None
+        """
+        envelope = Envelope(message)
+        error = envelope.validate(self.strict)
+        if error is None:
+            return None
+        self.rejected += 1
+        return Message("neon.messagebus.rejected",
+                       {"reason": "invalid", "error": error,
+                        "type": envelope.msg_type,
+                        "size": len(message)}).serialize()
+
+    def get_metrics(self) -> dict:
+        """
+        Get validation counters
+        """
+        return {"mode": self.mode, "rejected": self.rejected}
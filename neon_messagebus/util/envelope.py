@@ -0,0 +1,267 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import re
+
+from typing import Optional, Tuple
+
+from ovos_bus_client import Message
+
+_decoder = json.JSONDecoder()
+# `Message.serialize` writes `type`, then `data`, then `context`
+_DATA_KEY = re.compile(r'\s*,\s*"data"\s*:\s*')
+_CONTEXT_KEY = '"context"'
+_WHITESPACE = " \t\n\r"
+_UNSET = object()
+
+
+def _get_type_span(message: str) -> Optional[Tuple[int, int]]:
+    """
+    Get the position of the type of a message that starts with its type
+    :param message: serialized message
+    :returns: start and end index of the (unescaped) type, else None
+    """
+    if isinstance(message, str) and message.startswith('{"type":'):
+        start = message.find('"', 8, 10) + 1
+        end = message.find('"', start) if start else -1
+        if end > 0 and "\\" not in message[start:end]:
+            return start, end
+    return None
+
+
+def get_message_type(message: str, parse: bool = True) -> Optional[str]:
+    """
+    Get the type of a serialized message without parsing the whole message
+    where possible. `Message.serialize` always writes `type` first.
+    :param message: serialized message
+    :param parse: if False, return None instead of parsing messages that do
+        not start with their type
+    :returns: message type, or None if the message is not a valid Message
+    """
+    span = _get_type_span(message)
+    if span:
+        return message[span[0]:span[1]]
+    if not parse:
+        return None
+    try:
+        msg_type = json.loads(message).get("type")
+    except (ValueError, AttributeError):
+        return None
+    return msg_type if isinstance(msg_type, str) else None
+
+
+class Envelope:
+    __slots__ = ("raw", "_msg_type", "_data", "_context")
+
+    def __init__(self, raw: str):
+        """
+        A serialized message that is only decoded as far as needed. The type
+        is read without decoding anything else, and `context` and `data` are
+        each decoded separately on first access, so reading routing fields
+        of a message with a large payload does not decode the payload.
+        Messages not in the `Message.serialize` layout are fully parsed.
+        :param raw: serialized message
+        """
+        self.raw = raw
+        self._msg_type = _UNSET
+        self._data = _UNSET
+        self._context = _UNSET
+
+    @property
+    def msg_type(self) -> Optional[str]:
+        """
+        Message type, or None if the message does not have a valid type
+        """
+        if self._msg_type is _UNSET:
+            msg_type = get_message_type(self.raw, parse=False)
+            if msg_type is None:
+                try:
+                    self._parse()
+                except ValueError:
+                    self._msg_type = None
+            else:
+                self._msg_type = msg_type
+        return self._msg_type
+
+    @property
+    def data(self) -> dict:
+        """
+        Message data, decoded on first access
+        :raises ValueError: if the message or its data is not valid
+        """
+        if self._data is _UNSET:
+            data = self._decode_data()
+            if data is _UNSET:
+                self._parse()
+            else:
+                self._data = self._check("data", data)
+        return self._data
+
+    @property
+    def context(self) -> dict:
+        """
+        Message context, decoded on first access without decoding `data`
+        :raises ValueError: if the message or its context is not valid
+        """
+        if self._context is _UNSET:
+            found = self._find_context()
+            if found is _UNSET:
+                self._parse()
+            else:
+                self._context = self._check("context", found[0])
+        return self._context
+
+    def with_context(self, context: dict) -> str:
+        """
+        Get the serialized message with a different context. Only the context
+        is encoded again if it is the last key of the message, so `data` is
+        left exactly as received.
+        :param context: new message context
+        :returns: serialized message
+        :raises ValueError: if the message is not valid
+        """
+        found = self._find_context()
+        if found is _UNSET:
+            try:
+                message = json.loads(self.raw)
+            except TypeError:
+                raise ValueError("message is not text")
+            if not isinstance(message, dict):
+                raise ValueError("message is not an object")
+            message["context"] = context
+            return json.dumps(message)
+        _, start, end = found
+        return self.raw[:start] + json.dumps(context) + self.raw[end:]
+
+    def _decode_data(self):
+        """
+        Decode `data` if it directly follows the type
+        :returns: decoded value, or _UNSET if not found
+        """
+        raw = self.raw
+        span = _get_type_span(raw)
+        match = _DATA_KEY.match(raw, span[1] + 1) if span else None
+        if not match:
+            return _UNSET
+        try:
+            value, end = _decoder.raw_decode(raw, match.end())
+        except ValueError:
+            return _UNSET
+        while end < len(raw) and raw[end] in _WHITESPACE:
+            end += 1
+        if end >= len(raw) or raw[end] not in ",}":
+            return _UNSET
+        return value
+
+    def _find_context(self):
+        """
+        Decode `context` if it is the last key of the message
+        :returns: decoded value and the start and end index of its encoding,
+            or _UNSET if not found
+        """
+        raw = self.raw
+        start = raw.rfind(_CONTEXT_KEY) if isinstance(raw, str) else -1
+        if start < 1:
+            return _UNSET
+        before = start - 1
+        while before > 0 and raw[before] in _WHITESPACE:
+            before -= 1
+        if raw[before] not in ",{":
+            return _UNSET
+        value_start = start + len(_CONTEXT_KEY)
+        while value_start < len(raw) and raw[value_start] in _WHITESPACE:
+            value_start += 1
+        if not raw.startswith(":", value_start):
+            return _UNSET
+        value_start += 1
+        while value_start < len(raw) and raw[value_start] in _WHITESPACE:
+            value_start += 1
+        try:
+            value, end = _decoder.raw_decode(raw, value_start)
+        except ValueError:
+            return _UNSET
+        # A `context` key nested in another value is followed by more than
+        # the end of the message
+        if raw[end:].strip(_WHITESPACE) != "}":
+            return _UNSET
+        return value, value_start, end
+
+    @staticmethod
+    def _check(name: str, value) -> dict:
+        if value is None:
+            return dict()
+        if not isinstance(value, dict):
+            raise ValueError(f"{name} is not an object")
+        return value
+
+    def _parse(self):
+        """
+        Decode the whole message
+        :raises ValueError: if the message is not a JSON object
+        """
+        try:
+            message = json.loads(self.raw)
+        except TypeError:
+            raise ValueError("message is not text")
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        msg_type = message.get("type")
+        self._msg_type = msg_type if isinstance(msg_type, str) else None
+        self._data = self._check("data", message.get("data"))
+        self._context = self._check("context", message.get("context"))
+
+    def validate(self, strict: bool = False) -> Optional[str]:
+        """
+        Check that this is a valid Message. Only the type and context are
+        decoded, unless `strict`.
+        :param strict: if True, decode and check the whole message
+        :returns: reason the message is not valid, else None
+        """
+        raw = self.raw
+        if not isinstance(raw, str) or not raw.startswith("{") or \
+                not raw.endswith("}"):
+            return "message is not an object"
+        try:
+            if strict:
+                self._parse()
+            if not self.msg_type:
+                return "message has no type"
+            self.context
+        except ValueError as e:
+            return str(e)
+        return None
+
+    def to_message(self) -> Message:
+        """
+        Get a Message with the decoded type, data, and context
+        :raises ValueError: if the message is not valid
+        """
+        if not self.msg_type:
+            raise ValueError("message has no type")
+        return Message(self.msg_type, self.data, self.context)
@@ -0,0 +1,193 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from functools import wraps
+from multiprocessing import get_context
+from threading import Lock
+from typing import Callable, Optional
+
+from ovos_bus_client import Message
+from ovos_utils.log import LOG
+
+CPU_POOLS = ("thread", "process")
+
+
+class _Pool:
+    def __init__(self, executor: Executor, workers: int, kind: str):
+        """
+        An executor with queue depth counters
+        :param executor: Executor to run calls in
+        :param workers: number of workers in `executor`
+        :param kind: `thread` or `process`
+        """
+        self.executor = executor
+        self.workers = workers
+        self.kind = kind
+        self._lock = Lock()
+        self.pending = 0
+        self.max_pending = 0
+        self.completed = 0
+        self.errors = 0
+        self._futures = set()
+
+    def submit(self, func: Callable, *args) -> Future:
+        with self._lock:
+            self.pending += 1
+            self.max_pending = max(self.max_pending, self.pending)
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self._done(None)
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def shutdown(self, wait: bool = False):
+        """
+        Cancel calls that have not started and stop the executor
+        :param wait: if True, wait for running calls to finish
+        """
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+        self.executor.shutdown(wait)
+
+    def _done(self, future: Optional[Future]):
+        with self._lock:
+            self.pending -= 1
+            self._futures.discard(future)
+            if future is not None and future.cancelled():
+                return
+            self.completed += 1
+            if future is None or future.exception() is not None:
+                self.errors += 1
+
+    def get_metrics(self) -> dict:
+        return {"type": self.kind, "workers": self.workers,
+                "pending": self.pending, "max_pending": self.max_pending,
+                "completed": self.completed, "errors": self.errors}
+
+
+class HandlerExecutor:
+    def __init__(self, io_workers: int = 8, cpu_workers: int = 1,
+                 cpu_pool: str = "thread", wait_workers: int = 64):
+        """
+        Runs service-side bus handlers in bounded worker pools, tagged by the
+        work they do. I/O-bound handlers (files, metrics, etc.) run in a
+        thread pool. Handlers that wait for another request (e.g. for a
+        signal to be created) run in a separate thread pool, so waiters can
+        not hold every I/O thread while the request that releases them is
+        queued. CPU-bound work runs in a separate pool of `cpu_workers`;
+        with a `process` pool it does not hold the GIL the server event loop
+        needs, so relay latency is unaffected.
+        :param io_workers: threads for I/O-bound handlers
+        :param cpu_workers: workers for CPU-bound handlers and work
+        :param cpu_pool: `thread` or `process`
+        :param wait_workers: threads for handlers that wait for other
+            requests
+        """
+        if cpu_pool not in CPU_POOLS:
+            raise ValueError(f"Unknown cpu_pool: {cpu_pool}")
+        self._io = _Pool(ThreadPoolExecutor(io_workers, "bus_handler_io"),
+                         io_workers, "thread")
+        if cpu_pool == "process":
+            # Server threads must not be forked with the worker processes
+            executor = ProcessPoolExecutor(cpu_workers,
+                                           mp_context=get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(cpu_workers, "bus_handler_cpu")
+        self._cpu = _Pool(executor, cpu_workers, cpu_pool)
+        self._wait = _Pool(ThreadPoolExecutor(wait_workers,
+                                              "bus_handler_wait"),
+                           wait_workers, "thread")
+
+    def wrap(self, handler: Callable[[Message], None], cpu: bool = False,
+             wait: bool = False) -> Callable[[Message], None]:
+        """
+        Get a bus handler that runs `handler` in the I/O, wait, or CPU pool.
+        Bound handlers generally cannot be sent to another process, so with a
+        `process` pool CPU handlers run in the I/O pool. CPU handlers must
+        do their work directly; handlers that pass heavy work to
+        `submit_cpu` and wait for it are I/O-bound, since waiting on the CPU
+        pool from one of its own workers can deadlock.
+        :param handler: bus handler to wrap
+        :param cpu: if True, `handler` is CPU-bound
+        :param wait: if True, `handler` waits for other requests
+        :returns: handler for `MessageBusClient.on`
+        """
+        if wait:
+            pool = self._wait
+        elif cpu and self._cpu.kind == "thread":
+            pool = self._cpu
+        else:
+            pool = self._io
+
+        @wraps(handler)
+        def wrapper(message: Message):
+            pool.submit(self._run, handler, message)
+        return wrapper
+
+    @staticmethod
+    def _run(handler: Callable[[Message], None], message: Message):
+        try:
+            handler(message)
+        except Exception as e:
+            LOG.exception(f"Handler for {message.msg_type} failed: {e}")
+            raise
+
+    def submit_cpu(self, func: Callable, *args) -> Future:
+        """
+        Run CPU-bound work in the CPU pool. With a `process` pool, `func`
+        must be a module-level function and `func`, `args`, and the result
+        must be picklable.
+        :param func: function to call
+        :param args: arguments to pass to `func`
+        :returns: Future for the result of `func`
+        """
+        return self._cpu.submit(func, *args)
+
+    def get_metrics(self) -> dict:
+        """
+        Get queue depth and completion counts for each pool
+        """
+        return {"io": self._io.get_metrics(), "wait": self._wait.get_metrics(),
+                "cpu": self._cpu.get_metrics()}
+
+    def shutdown(self, wait: bool = False):
+        """
+        Stop the worker pools; queued calls that have not started are
+        cancelled
+        :param wait: if True, wait for running calls to finish
+        """
+        for pool in (self._io, self._wait, self._cpu):
+            pool.shutdown(wait)
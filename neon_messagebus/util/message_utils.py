@@ -27,26 +27,128 @@
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import json
-from os.path import expanduser, isfile
+import mmap
+
+from binascii import unhexlify
+from concurrent.futures import Future
+from os.path import expanduser, isfile, getsize
 from threading import Event
-from typing import Union, Optional
+from time import sleep
+from typing import Callable, Union, Optional
+from urllib.parse import quote
+from uuid import uuid4
 
 from ovos_bus_client import MessageBusClient, Message
 from ovos_utils import create_daemon
 from ovos_utils.json_helper import merge_dict
+from ovos_utils.log import LOG
+from websocket import WebSocketApp, WebSocketBadStatusException, \
+    WebSocketException
 
+from neon_messagebus.util.backoff import get_backoff, get_retry_after
 from neon_messagebus.util.config import load_message_bus_config
+from neon_messagebus.util.envelope import Envelope
+from neon_messagebus.util.shared_memory_utils import SharedMemoryWriter, \
+    read_shared_memory
+from neon_messagebus.util.tracing import start_trace
+
+_decoder = json.JSONDecoder()
+
+
+class NeonMessageBusClient(MessageBusClient):
+    """
+    MessageBusClient that skips websocket-client's pure-Python UTF-8
+    validation of received frames. The messagebus server decodes every text
+    frame before relaying it and frames are decoded here, so the validation
+    only costs CPU (and GIL time) proportional to the size of every message
+    on the bus.
+
+    Reconnects use jittered exponential backoff from `min_delay` up to
+    `max_delay` seconds, added to any `Retry-After` delay the server sends
+    when it rejects a handshake, so clients disconnected together do not
+    all reconnect at the same moment.
+
+    With `batch`, the client asks the server to send messages queued
+    together as one frame holding a JSON array of messages, and unpacks them.
+
+    With `token`, the client authenticates into the namespace the server
+    binds that token to.
+    """
+    def __init__(self, *args, min_delay: float = 1, max_delay: float = 60,
+                 batch: bool = False, token: Optional[str] = None,
+                 **kwargs):
+        # `create_client` is called by `MessageBusClient.__init__`
+        self.batch = batch
+        self.token = token
+        MessageBusClient.__init__(self, *args, **kwargs)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._attempts = 0
+
+    def create_client(self) -> WebSocketApp:
+        client = MessageBusClient.create_client(self)
+        args = list()
+        if self.batch:
+            args.append("batch=1")
+        if self.token:
+            args.append(f"token={quote(self.token, safe='')}")
+        if args:
+            client.url += ("&" if "?" in client.url else "?") + "&".join(args)
+        return client
+
+    def on_open(self, *args):
+        self._attempts = 0
+        MessageBusClient.on_open(self, *args)
+
+    def on_error(self, *args):
+        error = args[-1]
+        self._attempts += 1
+        retry_after = get_retry_after(getattr(error, "resp_headers", None))
+        self.retry = retry_after + get_backoff(self._attempts, self.min_delay,
+                                               self.max_delay)
+        if not isinstance(error, WebSocketBadStatusException) or \
+                error.status_code != 503:
+            return MessageBusClient.on_error(self, *args)
+        # The server is up but not accepting connections yet
+        LOG.info(f"Messagebus busy; reconnecting in {self.retry:.1f} seconds")
+        sleep(self.retry)
+        try:
+            self.emitter.emit('reconnecting')
+            self.client = self.create_client()
+            self.run_forever()
+        except WebSocketException:
+            pass
+
+    def run_forever(self):
+        self.started_running = True
+        self.client.run_forever(skip_utf8_validation=True)
+
+    def on_message(self, *args):
+        args = list(args)
+        if isinstance(args[-1], bytes):
+            args[-1] = args[-1].decode("utf-8")
+        message = args[-1]
+        if not message.startswith("["):
+            return MessageBusClient.on_message(self, *args)
+        # Batch frame; handle each serialized message as sent
+        end = 0
+        while message[end] != "]":
+            start = end + 1
+            _, end = _decoder.raw_decode(message, start)
+            args[-1] = message[start:end]
+            MessageBusClient.on_message(self, *args)
 
 
 def get_messagebus(running: bool = True) -> MessageBusClient:
     """
     Get a MessageBusClient object for the globally configured bus (usually localhost).
+    The client reconnects with jittered backoff if the connection is lost.
     :param running: If True, run the bus in a daemon thread and wait for it to connect
     :returns: instantiated MessageBusClient
     """
     config = load_message_bus_config()
-    bus = MessageBusClient(host=config.host, port=config.port,
-                           route=config.route, ssl=config.ssl)
+    bus = NeonMessageBusClient(host=config.host, port=config.port,
+                               route=config.route, ssl=config.ssl)
     if running:
         bus_connected = Event()
         # Set the bus connected event when connection is established
@@ -62,8 +164,10 @@ def send_message(message: Union[str, dict, Message],
                  context: Optional[dict] = None,
                  bus: Optional[MessageBusClient] = None):
     """
-    Send a message over the messagebus
+    Send a message over the messagebus. A new trace is started in the message
+    context unless it already has a `traceparent`.
     :param message: One of: Message name, Message object, serialized Message
+        (a string starting with `{`), or dict deserialized Message
     :param data: Optional dict message data
     :param context: Optional dict message context
     :param bus: Optional MessageBusClient to send message with
@@ -71,19 +175,18 @@ def send_message(message: Union[str, dict, Message],
     auto_close = bus is None
     bus = bus or get_messagebus()
     if isinstance(message, str):
-        if isinstance(data, dict) or isinstance(context, dict):
+        if isinstance(data, dict) or isinstance(context, dict) or \
+                not message.startswith("{"):
             message = Message(message, data, context)
         else:
-            try:
-                message = json.loads(message)
-            except:
-                message = Message(message)
+            message = Envelope(message).to_message()
     if isinstance(message, dict):
         message = Message(message["type"],
                           message.get("data"),
                           message.get("context"))
     if not isinstance(message, Message):
         raise ValueError
+    start_trace(message.context)
     bus.emit(message)
     if auto_close:
         bus.close()
@@ -93,7 +196,9 @@ def send_binary_data_message(binary_data: Union[bytes, bytearray],
                              msg_type: str = "mycroft.binary.data",
                              msg_data: Optional[dict] = None,
                              msg_context: Optional[dict] = None,
-                             bus: Optional[MessageBusClient] = None):
+                             bus: Optional[MessageBusClient] = None,
+                             shared_memory: Optional[SharedMemoryWriter] =
+                             None):
     """
     Send arbitrary binary data over the messagebus
     :param binary_data: bytes or bytearray
@@ -101,11 +206,19 @@ def send_binary_data_message(binary_data: Union[bytes, bytearray],
     :param msg_data: Optional data to send with binary
     :param msg_context: Optional dict message context
     :param bus: Optional MessageBusClient to send message with
+    :param shared_memory: Optional SharedMemoryWriter to pass the data through
+        when all consumers are on this host. Falls back to sending the data
+        in the message if the shared memory is full.
     """
     msg_data = msg_data or {}
+    handle = shared_memory.write(binary_data) if shared_memory else None
+    if handle:
+        binary = {"shm": handle}
+    else:
+        binary = {"binary": binary_data.hex()}
     msg = {
         "type": msg_type,
-        "data": merge_dict(msg_data, {"binary": binary_data.hex()}),
+        "data": merge_dict(msg_data, binary),
         "context": msg_context or None
     }
     send_message(msg, bus=bus)
@@ -116,7 +229,8 @@ def send_binary_file_message(filepath: str,
                              msg_context: dict = None,
                              bus: MessageBusClient = None):
     """
-    Send file contents over the messagebus
+    Send file contents over the messagebus. The whole file is sent in one
+    message; see `stream_binary_file_message` for large files.
     :param filepath: Path to file to send
     :param msg_type: string message type to emit
     :param msg_context: Optional dict message context
@@ -133,23 +247,181 @@ def send_binary_file_message(filepath: str,
                              msg_context=msg_context, bus=bus)
 
 
-def decode_binary_message(message: Union[Message, str, dict]) -> bytearray:
+def stream_binary_file_message(filepath: str,
+                               msg_type: str = "mycroft.binary.file",
+                               msg_context: Optional[dict] = None,
+                               bus: Optional[MessageBusClient] = None,
+                               chunk_size: int = 1024 * 1024,
+                               progress: Optional[Callable[[int, int], None]]
+                               = None,
+                               shared_memory: Optional[SharedMemoryWriter] =
+                               None) -> Future:
     """
-    Decode a binary file message
-    :param message: Message containing a binary file
-    :returns: File contents as bytes
+    Send file contents over the messagebus in chunks without reading the
+    whole file into memory. The file is memory-mapped and each slice is sent
+    in a separate message with data `path` and `stream`, where `stream`
+    contains `id`, `offset`, `size` (of the whole file) and `final`. Consumers
+    may reassemble the file with `decode_binary_message_into`.
+    :param filepath: Path to file to send
+    :param msg_type: string message type to emit
+    :param msg_context: Optional dict message context
+    :param bus: Optional MessageBusClient to send messages with
+    :param chunk_size: maximum bytes of file data per message
+    :param progress: Optional callback called with bytes sent and file size
+        after each chunk
+    :param shared_memory: Optional SharedMemoryWriter to pass chunks through
+        (see `send_binary_data_message`)
+    :returns: Future resolving to the number of bytes sent; use
+        `asyncio.wrap_future` to await it
+    """
+    filepath = expanduser(filepath)
+    if not isfile(filepath):
+        raise FileNotFoundError(f"{filepath} is not a valid file")
+    if chunk_size < 1:
+        raise ValueError(f"Invalid chunk_size: {chunk_size}")
+    future = Future()
+    future.set_running_or_notify_cancel()
+    stream_id = uuid4().hex
+
+    def _send_chunk(chunk, offset: int, size: int):
+        final = offset + len(chunk) >= size
+        send_binary_data_message(
+            chunk, msg_type,
+            {"path": filepath, "stream": {"id": stream_id, "offset": offset,
+                                          "size": size, "final": final}},
+            msg_context, message_bus, shared_memory)
+
+    def _stream():
+        sent = 0
+        try:
+            size = getsize(filepath)
+            if size == 0:
+                # Empty files can't be mapped
+                _send_chunk(b"", 0, 0)
+                if progress:
+                    progress(0, 0)
+            else:
+                with open(filepath, 'rb') as f, \
+                        mmap.mmap(f.fileno(), 0,
+                                  access=mmap.ACCESS_READ) as mapped, \
+                        memoryview(mapped) as view:
+                    while sent < size:
+                        with view[sent:sent + chunk_size] as chunk:
+                            _send_chunk(chunk, sent, size)
+                            sent += len(chunk)
+                        if progress:
+                            progress(sent, size)
+            future.set_result(sent)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            if auto_close:
+                message_bus.close()
+
+    auto_close = bus is None
+    message_bus = bus or get_messagebus()
+    create_daemon(_stream)
+    return future
+
+
+_DECODE_CHUNK = 1024 * 1024
+
+
+def _get_binary_data(message: Union[Message, str, dict]) -> Union[dict, str]:
+    """
+    Get the data of a binary message without parsing more than necessary
+    :param message: Message, serialized Message, Message.data, or hex string
+    :returns: dict containing `binary` or `shm`, or a hex string
     """
     if isinstance(message, str):
-        try:  # json string
-            message = json.loads(message)
-            binary_data = message.get("binary") or message["data"]["binary"]
-        except (json.JSONDecodeError, TypeError):  # hex string
-            binary_data = message
-    elif isinstance(message, dict):
-        # data field or serialized message
-        binary_data = message.get("binary") or message["data"]["binary"]
-    else:
+        if not message.startswith("{"):
+            # hex string; skip the JSON parser for (large) payloads
+            return message
+        if message.startswith('{"type":'):
+            # serialized message; decode only `data`
+            return Envelope(message).data
+        message = json.loads(message)
+    elif not isinstance(message, dict):
         # message object
-        binary_data = message.data["binary"]
+        return message.data
+    # data field or serialized message
+    return message if "binary" in message or "shm" in message \
+        else message["data"]
+
+
+def decode_binary_message(message: Union[Message, str, dict],
+                          mutable: bool = True) -> \
+        Union[bytearray, bytes, memoryview]:
+    """
+    Decode a binary file message
+    :param message: Message containing a binary file; a Message object or
+        dict is used as-is, a serialized message is parsed
+    :param mutable: if False, return immutable `bytes` without the extra
+        copy into a new `bytearray`
+    :returns: File contents as bytes, or a read-only memoryview for data
+        passed through shared memory (see `acknowledge_binary_message`)
+    """
+    data = _get_binary_data(message)
+    if isinstance(data, str):
+        binary_data = data
+    elif data.get("shm"):
+        return read_shared_memory(data["shm"])
+    else:
+        binary_data = data["binary"]
     # decode hex string
-    return bytearray.fromhex(binary_data)
+    if mutable:
+        return bytearray.fromhex(binary_data)
+    return unhexlify(binary_data)
+
+
+def decode_binary_message_into(message: Union[Message, str, dict],
+                               buffer: Union[bytearray, memoryview]) -> int:
+    """
+    Decode a binary file message into a caller-provided buffer so that one
+    buffer may be reused for a stream of messages.
+    :param message: Message containing a binary file (see
+        `decode_binary_message`)
+    :param buffer: writable buffer at least as large as the decoded data
+    :returns: number of bytes written to `buffer`
+    """
+    data = _get_binary_data(message)
+    if isinstance(data, str):
+        binary_data = data
+    elif data.get("shm"):
+        view = read_shared_memory(data["shm"])
+        length = len(view)
+        if length > len(buffer):
+            raise ValueError(f"{length} bytes will not fit in buffer of "
+                             f"length {len(buffer)}")
+        buffer[:length] = view
+        view.release()
+        return length
+    else:
+        binary_data = data["binary"]
+    length = len(binary_data) // 2
+    if length > len(buffer):
+        raise ValueError(f"{length} bytes will not fit in buffer of "
+                         f"length {len(buffer)}")
+    # decode in chunks to bound the size of intermediate copies
+    with memoryview(buffer) as view:
+        for start in range(0, length, _DECODE_CHUNK):
+            end = min(start + _DECODE_CHUNK, length)
+            view[start:end] = unhexlify(binary_data[2 * start:2 * end])
+    return length
+
+
+def acknowledge_binary_message(message: Message,
+                               bus: Optional[MessageBusClient] = None):
+    """
+    Notify the sender that this consumer is done with data passed through
+    shared memory, so the memory may be reused. Views returned by
+    `decode_binary_message` for this message must not be used afterwards.
+    Does nothing for messages that contain the data.
+    :param message: Message containing binary data
+    :param bus: Optional MessageBusClient to send the acknowledgement with
+    """
+    handle = message.data.get("shm")
+    if not handle:
+        return
+    send_message("neon.shared_memory.ack",
+                 {"name": handle["name"], "block": handle["block"]}, bus=bus)
@@ -26,22 +26,43 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from typing import Optional
+
 from ovos_config.config import Configuration
 from ovos_utils.log import LOG
 
+from neon_messagebus.util.mq_connector.bridge import MQBridge, LocalBroker, \
+    PikaTransport
+from neon_messagebus.util.mq_connector.supervisor import MQConnectorSupervisor
 
-def start_mq_connector(config: dict):
+__all__ = ["LocalBroker", "MQBridge", "MQConnectorSupervisor",
+           "PikaTransport", "create_mq_connector", "start_mq_connector"]
+
+
+def create_mq_connector(config: dict, token: Optional[str] = None):
     """
-    Start the MQ Connector module to handle MQ API requests
+    Create the MQ Connector module to handle MQ API requests without
+    connecting to MQ
     @param config: Configuration object
+    @param token: namespace token to connect to the messagebus with
+    @return: connector, or None if no chat API credentials are configured
     """
-    from neon_messagebus_mq_connector.controller import ChatAPIProxy
+    from neon_messagebus.util.mq_connector.proxy import BridgedChatAPIProxy
     config = config or Configuration()
 
     if "neon_chat_api" not in config.get("MQ", {}).get("users", {}):
         LOG.info("Skipping MQ Connector init")
         return None
-    chat_connector = ChatAPIProxy(service_name="neon_chat_api",
-                                  config=config)
-    chat_connector.run(run_sync=False)
+    return BridgedChatAPIProxy(service_name="neon_chat_api", config=config,
+                               token=token)
+
+
+def start_mq_connector(config: dict):
+    """
+    Start the MQ Connector module to handle MQ API requests
+    @param config: Configuration object
+    """
+    chat_connector = create_mq_connector(config)
+    if chat_connector:
+        chat_connector.run(run_sync=False)
     return chat_connector
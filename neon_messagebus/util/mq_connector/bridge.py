@@ -0,0 +1,638 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import struct
+
+from collections import deque
+from functools import partial
+from os import makedirs
+from os.path import dirname, isfile
+from threading import Condition, Event, Thread
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from ovos_utils.log import LOG
+
+from neon_messagebus.util.backoff import get_backoff
+
+# exchange, routing_key, body, expiration (ms)
+Publish = Tuple[str, str, bytes, int]
+ConfirmCallback = Callable[[int, bool, bool], None]
+
+
+class _Pending:
+    __slots__ = ("publish", "queued", "attempts")
+
+    def __init__(self, publish: Publish, queued: float):
+        self.publish = publish
+        self.queued = queued
+        self.attempts = 0
+
+
+class _Spill:
+    """
+    Append-only file of queued publishes, read back in order. Messages left
+    in the file by a previous process are published first.
+    """
+    _length = struct.Struct("!II")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+        self._file = open(path, "r+b" if isfile(path) else "w+b")
+        self._read_offset = 0
+        self._recover()
+
+    def _recover(self):
+        """
+        Count records in an existing file, discarding a partial last record
+        """
+        end = self._file.seek(0, 2)
+        offset = 0
+        while offset + self._length.size <= end:
+            self._file.seek(offset)
+            header_len, body_len = self._length.unpack(
+                self._file.read(self._length.size))
+            record_end = offset + self._length.size + header_len + body_len
+            if record_end > end:
+                break
+            offset = record_end
+            self.count += 1
+        self._file.truncate(offset)
+        if self.count:
+            LOG.info(f"Recovered {self.count} spilled MQ messages")
+
+    def append(self, publish: Publish):
+        exchange, routing_key, body, expiration = publish
+        header = json.dumps([exchange, routing_key, expiration]).encode()
+        self._file.seek(0, 2)
+        self._file.write(self._length.pack(len(header), len(body)))
+        self._file.write(header)
+        self._file.write(body)
+        self.count += 1
+
+    def read(self, count: int) -> List[Publish]:
+        publishes = list()
+        self._file.seek(self._read_offset)
+        while self.count and len(publishes) < count:
+            header_len, body_len = self._length.unpack(
+                self._file.read(self._length.size))
+            exchange, routing_key, expiration = \
+                json.loads(self._file.read(header_len))
+            publishes.append((exchange, routing_key,
+                              self._file.read(body_len), expiration))
+            self.count -= 1
+        self._read_offset = self._file.tell()
+        if not self.count:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_offset = 0
+        return publishes
+
+    def prepend(self, publishes: List[Publish]):
+        """
+        Write messages ahead of those already in the file
+        """
+        remaining = self.read(self.count)
+        for publish in publishes + remaining:
+            self.append(publish)
+
+    def close(self):
+        self._file.close()
+
+
+def _get_latency_stats(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"p50": None, "p99": None, "max": None}
+    latencies = sorted(latencies)
+    return {"p50": latencies[len(latencies) // 2],
+            "p99": latencies[min(len(latencies) - 1,
+                                 int(len(latencies) * 0.99))],
+            "max": latencies[-1]}
+
+
+class MQBridge:
+    def __init__(self, transport, batch_size: int = 100,
+                 batch_interval: float = 0.005, max_in_flight: int = 1000,
+                 max_attempts: int = 3, max_queued: int = 10000,
+                 spill_path: Optional[str] = None, drain_rate: float = 0):
+        """
+        Publishes messages to MQ in batches over one persistent channel with
+        publisher confirms. `publish` queues a message; a worker thread waits
+        up to `batch_interval` seconds to fill a batch of `batch_size`
+        messages and keeps at most `max_in_flight` messages unconfirmed.
+        Nacked messages are retried up to `max_attempts` times and
+        unconfirmed messages are published again after a reconnect.
+
+        While the broker is unavailable, up to `max_queued` messages are kept
+        in memory; more are written to `spill_path` if set, otherwise the
+        oldest are dropped. The backlog is published at up to `drain_rate`
+        messages per second once the broker is available again.
+        :param transport: broker connection (PikaTransport or LocalBroker)
+        :param batch_size: maximum messages per batch
+        :param batch_interval: maximum seconds to wait to fill a batch
+        :param max_in_flight: maximum published, unconfirmed messages
+        :param max_attempts: maximum times to publish a nacked message
+        :param max_queued: maximum messages to queue in memory
+        :param spill_path: optional file for messages beyond `max_queued`
+        :param drain_rate: maximum messages per second while publishing a
+            backlog; 0 for no limit
+        """
+        self.transport = transport
+        self.batch_size = max(1, batch_size)
+        self.batch_interval = batch_interval
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_attempts = max_attempts
+        self.max_queued = max(1, max_queued)
+        self.drain_rate = drain_rate
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.dropped = 0
+        self.batches = 0
+        self.overflowed = 0
+        self._spill = _Spill(spill_path) if spill_path else None
+        self._draining = False
+        self._next_publish = 0
+        self._queue = deque()
+        self._in_flight: Dict[int, _Pending] = dict()
+        self._next_tag = 1
+        self._latencies = deque(maxlen=1024)
+        self._cond = Condition()
+        self._running = False
+        self._thread = None
+
+    @property
+    def queued(self) -> int:
+        """
+        Number of messages waiting to be published
+        """
+        return len(self._queue) + self.spilled
+
+    @property
+    def spilled(self) -> int:
+        """
+        Number of queued messages written to disk
+        """
+        return self._spill.count if self._spill else 0
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Number of published messages waiting to be confirmed
+        """
+        return len(self._in_flight)
+
+    def start(self):
+        """
+        Connect to the broker and start publishing queued messages
+        """
+        if self._running:
+            return
+        self._running = True
+        self.transport.start(self._on_confirm, self._on_reset)
+        self._thread = Thread(target=self._run, name="MQBridge", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        """
+        Stop publishing after waiting up to `timeout` seconds for queued
+        messages to be confirmed, then disconnect from the broker. With a
+        `spill_path`, unconfirmed messages are saved to it for the next
+        bridge using the same file.
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        self.transport.stop()
+        if self._spill:
+            with self._cond:
+                unconfirmed = list(self._in_flight.values()) + \
+                    list(self._queue)
+                self._in_flight.clear()
+                self._queue.clear()
+                if unconfirmed:
+                    self._spill.prepend([p.publish for p in unconfirmed])
+                self._spill.close()
+
+    def publish(self, body: bytes, routing_key: str, exchange: str = '',
+                expiration: int = 1000):
+        """
+        Queue a message to be published
+        :param body: serialized message
+        :param routing_key: queue name (or routing key for `exchange`)
+        :param exchange: exchange name, default exchange if empty
+        :param expiration: message expiration time in milliseconds
+        """
+        publish = (exchange, routing_key, body, expiration)
+        with self._cond:
+            if not self.transport.connected.is_set():
+                self._draining = True
+            if self.spilled or len(self._queue) >= self.max_queued:
+                self._overflow(publish)
+            else:
+                self._queue.append(_Pending(publish, monotonic()))
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for all queued messages to be confirmed
+        :param timeout: maximum seconds to wait
+        :returns: True if all messages were confirmed
+        """
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: not self.queued and not self._in_flight, timeout)
+
+    def get_metrics(self) -> dict:
+        """
+        Get queue depth, counters and publish-to-confirm latency in seconds
+        """
+        with self._cond:
+            latencies = list(self._latencies)
+            metrics = {"connected": self.transport.connected.is_set(),
+                       "queued": self.queued,
+                       "spilled": self.spilled,
+                       "in_flight": self.in_flight,
+                       "draining": self._draining,
+                       "published": self.published,
+                       "confirmed": self.confirmed,
+                       "nacked": self.nacked,
+                       "dropped": self.dropped,
+                       "overflowed": self.overflowed,
+                       "batches": self.batches}
+        metrics["latency"] = _get_latency_stats(latencies)
+        return metrics
+
+    def _overflow(self, publish: Publish):
+        """
+        Handle a message that doesn't fit in the memory queue. Must be called
+        with the lock held.
+        """
+        self.overflowed += 1
+        if self._spill:
+            self._spill.append(publish)
+            return
+        dropped = self._queue.popleft()
+        self._queue.append(_Pending(publish, monotonic()))
+        self.dropped += 1
+        if self.dropped % 1000 == 1:
+            LOG.warning(f"MQ buffer full; dropped message to "
+                        f"{dropped.publish[1]} ({self.dropped} total)")
+
+    def _refill(self):
+        """
+        Move spilled messages back to the memory queue, in order
+        """
+        if self.spilled and len(self._queue) < self.max_queued // 2:
+            now = monotonic()
+            self._queue.extend(
+                _Pending(publish, now) for publish in
+                self._spill.read(self.max_queued - len(self._queue)))
+
+    def _next_batch(self) -> Optional[List[_Pending]]:
+        """
+        Wait for a batch to publish. Must be called with the lock held.
+        :returns: list of messages, or None if the bridge is stopped
+        """
+        while self._running:
+            self._refill()
+            if not self._queue or not self.transport.connected.is_set() or \
+                    len(self._in_flight) >= self.max_in_flight:
+                if not self.queued and not self._in_flight:
+                    self._draining = False
+                # Wait for messages, a connection, or confirms
+                self._cond.wait(0.1)
+                continue
+            now = monotonic()
+            if self._draining and self.drain_rate:
+                if self._next_publish > now:
+                    self._cond.wait(self._next_publish - now)
+                    continue
+            else:
+                linger = self._queue[0].queued + self.batch_interval - now
+                if len(self._queue) < self.batch_size and linger > 0:
+                    self._cond.wait(linger)
+                    continue
+            count = min(self.batch_size, len(self._queue),
+                        self.max_in_flight - len(self._in_flight))
+            if self._draining and self.drain_rate:
+                self._next_publish = now + count / self.drain_rate
+            return [self._queue.popleft() for _ in range(count)]
+        return None
+
+    def _run(self):
+        with self._cond:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                for tag, pending in enumerate(batch, self._next_tag):
+                    self._in_flight[tag] = pending
+                self._next_tag += len(batch)
+                try:
+                    # Publishing with the lock held keeps delivery tags in
+                    # step with the transport's channel across reconnects
+                    self.transport.publish_batch([p.publish for p in batch])
+                    self.published += len(batch)
+                    self.batches += 1
+                except Exception as e:
+                    LOG.warning(f"Failed to publish batch: {e}")
+                    for tag in range(self._next_tag - len(batch),
+                                     self._next_tag):
+                        self._in_flight.pop(tag, None)
+                    self._next_tag -= len(batch)
+                    self._queue.extendleft(reversed(batch))
+                    self._cond.wait(0.1)
+
+    def _on_confirm(self, delivery_tag: int, multiple: bool, ack: bool):
+        with self._cond:
+            if multiple:
+                tags = list()
+                for tag in self._in_flight:
+                    if tag > delivery_tag:
+                        break
+                    tags.append(tag)
+            else:
+                tags = [delivery_tag] if delivery_tag in self._in_flight \
+                    else []
+            now = monotonic()
+            retries = list()
+            for tag in tags:
+                pending = self._in_flight.pop(tag)
+                if ack:
+                    self.confirmed += 1
+                    self._latencies.append(now - pending.queued)
+                    continue
+                self.nacked += 1
+                pending.attempts += 1
+                if pending.attempts < self.max_attempts:
+                    retries.append(pending)
+                else:
+                    self.dropped += 1
+                    LOG.error(f"Dropping message to {pending.publish[1]} "
+                              f"after {pending.attempts} attempts")
+            self._queue.extendleft(reversed(retries))
+            self._cond.notify_all()
+
+    def _on_reset(self):
+        with self._cond:
+            # Delivery tags restart on a new channel; publish everything
+            # unconfirmed again, in order
+            self._queue.extendleft(reversed(list(self._in_flight.values())))
+            self._in_flight.clear()
+            self._next_tag = 1
+            self._draining = True
+            self._cond.notify_all()
+
+
+class LocalBroker:
+    def __init__(self, latency: float = 0.001):
+        """
+        In-process stand-in for an MQ broker with publisher confirms, for
+        testing and benchmarking an MQBridge without RabbitMQ. Each batch is
+        confirmed `latency` seconds after it is published with a single
+        multiple-ack, as RabbitMQ does under load.
+        :param latency: simulated round-trip time in seconds
+        """
+        self.latency = latency
+        self.connected = Event()
+        self.queues: Dict[str, deque] = dict()
+        self.batches = 0
+        self.nack_next = 0
+        self._tag = 0
+        self._generation = 0
+        self._confirms = deque()
+        self._cond = Condition()
+        self._on_confirm: Optional[ConfirmCallback] = None
+        self._on_reset: Optional[Callable[[], None]] = None
+        self._running = False
+        self._thread = None
+
+    def start(self, on_confirm: ConfirmCallback, on_reset: Callable[[], None]):
+        self._on_confirm = on_confirm
+        self._on_reset = on_reset
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.connected.set()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self.connected.clear()
+        if self._thread:
+            self._thread.join(5)
+
+    def publish_batch(self, batch: List[Publish]):
+        if not self.connected.is_set():
+            raise ConnectionError("Broker disconnected")
+        with self._cond:
+            due = monotonic() + self.latency
+            for _, routing_key, body, _ in batch:
+                self._tag += 1
+                if self.nack_next > 0:
+                    self.nack_next -= 1
+                    self._confirms.append((due, self._generation,
+                                           self._tag, False, False))
+                else:
+                    self.queues.setdefault(routing_key, deque()).append(body)
+            self._confirms.append((due, self._generation, self._tag,
+                                   True, True))
+            self.batches += 1
+            self._cond.notify_all()
+
+    def disconnect(self):
+        """
+        Simulate a lost connection; unconfirmed messages are discarded
+        """
+        with self._cond:
+            self.connected.clear()
+            self._generation += 1
+            self._tag = 0
+            self._confirms.clear()
+        self._on_reset()
+
+    def connect(self):
+        """
+        Simulate reconnecting after `disconnect`
+        """
+        self.connected.set()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._confirms:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                due, generation, tag, multiple, ack = self._confirms[0]
+                wait = due - monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self._confirms.popleft()
+                if generation != self._generation:
+                    continue
+            self._on_confirm(tag, multiple, ack)
+
+
+class PikaTransport:
+    def __init__(self, connection_params, min_delay: float = 1,
+                 max_delay: float = 60):
+        """
+        Persistent pika connection with a publisher-confirm channel for an
+        MQBridge. Runs its own IO loop thread and reconnects with
+        exponential backoff if the connection is lost.
+        :param connection_params: pika.ConnectionParameters for the vhost
+        :param min_delay: seconds to wait after the first failure
+        :param max_delay: maximum seconds to wait between attempts
+        """
+        self.connection_params = connection_params
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.connected = Event()
+        self._stopping = Event()
+        self._connection = None
+        self._channel = None
+        self._generation = 0
+        self._declared = set()
+        self._on_confirm: Optional[ConfirmCallback] = None
+        self._on_reset: Optional[Callable[[], None]] = None
+        self._running = False
+        self._thread = None
+
+    def start(self, on_confirm: ConfirmCallback, on_reset: Callable[[], None]):
+        self._on_confirm = on_confirm
+        self._on_reset = on_reset
+        self._running = True
+        self._thread = Thread(target=self._run, name="MQBridgeTransport",
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._stopping.set()
+        connection = self._connection
+        if connection:
+            try:
+                connection.ioloop.add_callback_threadsafe(
+                    partial(self._close, connection))
+            except Exception as e:
+                LOG.debug(e)
+        if self._thread:
+            self._thread.join(5)
+
+    def publish_batch(self, batch: List[Publish]):
+        connection = self._connection
+        if not connection or not self.connected.is_set():
+            raise ConnectionError("Not connected to MQ")
+        connection.ioloop.add_callback_threadsafe(
+            partial(self._publish, self._generation, batch))
+
+    def _run(self):
+        import pika
+        while self._running:
+            self._connection = pika.SelectConnection(
+                self.connection_params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed)
+            self._connection.ioloop.start()
+            if self._running:
+                self.failures += 1
+                self._stopping.wait(get_backoff(self.failures, self.min_delay,
+                                                self.max_delay))
+
+    @staticmethod
+    def _close(connection):
+        if connection.is_closing or connection.is_closed:
+            connection.ioloop.stop()
+        else:
+            connection.close()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, connection, error):
+        LOG.error(f"MQ connection failed: {error}")
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        LOG.warning(f"MQ connection closed: {reason}")
+        self._reset()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.confirm_delivery(self._on_delivery_confirmation)
+        self._channel = channel
+        self._declared.clear()
+        self._generation += 1
+        self.failures = 0
+        self.connected.set()
+
+    def _on_channel_closed(self, channel, reason):
+        LOG.warning(f"MQ channel closed: {reason}")
+        self._reset()
+        if self._connection and self._connection.is_open:
+            self._connection.close()
+
+    def _reset(self):
+        if self._channel is None:
+            return
+        self._channel = None
+        self.connected.clear()
+        self._on_reset()
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        self._on_confirm(method.delivery_tag, method.multiple,
+                         method.NAME == "Basic.Ack")
+
+    def _publish(self, generation: int, batch: List[Publish]):
+        from pika import BasicProperties
+        if generation != self._generation or not self._channel:
+            # Published on a previous channel; the bridge publishes these
+            # messages again after the reset
+            return
+        for exchange, routing_key, body, expiration in batch:
+            if not exchange and routing_key not in self._declared:
+                self._channel.queue_declare(routing_key, auto_delete=False)
+                self._declared.add(routing_key)
+            self._channel.basic_publish(
+                exchange, routing_key, body,
+                BasicProperties(expiration=str(expiration)))
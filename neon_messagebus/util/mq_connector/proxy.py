@@ -0,0 +1,127 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import Optional
+
+from neon_messagebus_mq_connector.controller import ChatAPIProxy
+from neon_mq_connector.consumers.select_consumer import SelectConsumerThread
+from neon_mq_connector.utils.network_utils import dict_to_b64
+from ovos_utils.log import LOG
+
+from neon_messagebus.util.message_utils import NeonMessageBusClient
+from neon_messagebus.util.mq_connector.bridge import MQBridge, PikaTransport
+
+
+class WindowedConsumerThread(SelectConsumerThread):
+    """
+    Consumer thread with a configurable prefetch window
+    """
+    prefetch_count = 50
+
+    def set_qos(self, _unused_frame=None):
+        self.channel.basic_qos(prefetch_count=self.prefetch_count,
+                               callback=self.start_consuming)
+
+
+class BridgedChatAPIProxy(ChatAPIProxy):
+    def __init__(self, config: dict, service_name: str,
+                 token: Optional[str] = None):
+        """
+        ChatAPIProxy that publishes responses through an MQBridge instead of
+        opening a connection per message. Bridge options are read from the
+        `bridge` section of the MQ config.
+        :param config: Configuration object
+        :param service_name: MQ service name
+        :param token: namespace token to connect to the messagebus with
+        """
+        self.token = token
+        mq_config = config.get("MQ", config)
+        bridge_config = dict(mq_config.get("bridge") or {})
+        prefetch = bridge_config.pop("prefetch", 50)
+        self._consumer_cls = type("WindowedConsumerThread",
+                                  (WindowedConsumerThread,),
+                                  {"prefetch_count": prefetch})
+        self.bridge: Optional[MQBridge] = None
+        ChatAPIProxy.__init__(self, config, service_name)
+        self.bridge = MQBridge(PikaTransport(
+            self.get_connection_params(self.vhost)), **bridge_config)
+
+    @property
+    def consumer_thread_cls(self):
+        if self.async_consumers_enabled:
+            return self._consumer_cls
+        return ChatAPIProxy.consumer_thread_cls.fget(self)
+
+    def connect_bus(self, refresh: bool = False):
+        """
+        Connect to the messagebus, authenticating with `token` if set
+        :param refresh: To refresh existing connection
+        """
+        if not self._bus or refresh:
+            self._bus = NeonMessageBusClient(
+                host=self.bus_config['host'],
+                port=int(self.bus_config.get('port', 8181)),
+                route=self.bus_config.get('route', '/core'), token=self.token)
+            self.register_bus_handlers()
+            self._bus.run_in_thread()
+
+    def pre_run(self, **kwargs):
+        self.bridge.start()
+
+    def shutdown(self):
+        """
+        Stop consumers and the bridge. `stop` leaves the bridge running so
+        that messages are buffered while consumers are restarted.
+        """
+        try:
+            self.stop()
+        finally:
+            if self.bridge:
+                self.bridge.stop()
+
+    def send_message(self, request_data: dict, vhost: str = '',
+                     connection_props: dict = None, exchange: str = '',
+                     queue: str = '', *args, **kwargs) -> str:
+        """
+        Queue a message on the bridge. Messages for another vhost or
+        exchange are sent on a new connection by ChatAPIProxy.
+        """
+        if (vhost and vhost != self.vhost) or exchange or not queue or \
+                args or set(kwargs) - {"expiration"}:
+            return ChatAPIProxy.send_message(self, request_data, vhost,
+                                             connection_props, exchange,
+                                             queue, *args, **kwargs)
+        request_data = dict(request_data)
+        if request_data.get('message_id') is None:
+            request_data['message_id'] = \
+                request_data.get("context", {}).get("mq", {}).get(
+                    "message_id") or self.create_unique_id()
+        self.bridge.publish(dict_to_b64(request_data), queue,
+                            expiration=kwargs.get("expiration", 1000))
+        LOG.debug(f"Queued message: {request_data['message_id']}")
+        return request_data['message_id']
@@ -0,0 +1,156 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from threading import Event, Thread
+from typing import Callable, Optional
+
+from ovos_utils.log import LOG
+
+from neon_messagebus.util.backoff import get_backoff
+
+
+class MQConnectorSupervisor:
+    def __init__(self, create_connector: Callable[[], Optional[object]],
+                 min_delay: float = 1, max_delay: float = 60,
+                 health_interval: float = 30, mq_timeout: float = 10):
+        """
+        Starts an MQ connector in a background thread and keeps it running.
+        The connector is started once the broker accepts connections;
+        failed starts are retried with exponential backoff, and consumers
+        that die are restarted. Messages published while the broker is
+        unavailable are buffered by the connector's bridge.
+        :param create_connector: method returning an MQConnector, or None if
+            MQ is not configured
+        :param min_delay: seconds to wait after the first failure
+        :param max_delay: maximum seconds to wait between attempts
+        :param health_interval: seconds between health checks
+        :param mq_timeout: seconds to wait for the broker on each attempt
+        """
+        self._create_connector = create_connector
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.health_interval = health_interval
+        self.mq_timeout = mq_timeout
+        self.connector = None
+        self.failures = 0
+        self.restarts = 0
+        self._stopping = Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start supervising the connector without blocking
+        """
+        self._thread = Thread(target=self._run, name="MQConnectorSupervisor",
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """
+        Stop supervising and stop the connector
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self.connector:
+            try:
+                getattr(self.connector, "shutdown", self.connector.stop)()
+            except Exception as e:
+                # Connection may already be lost
+                LOG.debug(e)
+
+    def get_metrics(self) -> dict:
+        """
+        Get connector state and bridge metrics
+        """
+        metrics = {"started": bool(self.connector and
+                                   self.connector.started),
+                   "failures": self.failures,
+                   "restarts": self.restarts}
+        bridge = getattr(self.connector, "bridge", None)
+        if bridge:
+            metrics.update(bridge.get_metrics())
+        return metrics
+
+    def _run(self):
+        while not self._stopping.is_set() and not self.connector:
+            try:
+                self.connector = self._create_connector()
+                if not self.connector:
+                    LOG.info("No MQ Credentials provided")
+                    return
+            except ImportError as e:
+                LOG.warning(f"MQ Connector module not available: {e}")
+                return
+            except Exception as e:
+                LOG.error(f"Failed to create MQ Connector: {e}")
+                self._wait_after_failure()
+        while not self._stopping.is_set():
+            try:
+                healthy = self._check_connector()
+            except Exception as e:
+                LOG.error(f"MQ Connector error: {e}")
+                healthy = False
+            if healthy:
+                self.failures = 0
+                self._stopping.wait(self.health_interval)
+            else:
+                self._wait_after_failure()
+
+    def _wait_after_failure(self):
+        self.failures += 1
+        delay = get_backoff(self.failures, self.min_delay, self.max_delay)
+        LOG.info(f"Retrying MQ Connector in {delay:.1f}s")
+        self._stopping.wait(delay)
+
+    def _check_connector(self) -> bool:
+        """
+        Start the connector or restart dead consumers
+        :returns: True if the connector is running
+        """
+        connector = self.connector
+        if not connector.started:
+            from neon_mq_connector.utils.connection_utils import \
+                check_rmq_is_available
+            if not check_rmq_is_available(
+                    connector.get_connection_params(connector.vhost)):
+                return False
+            connector.run(run_sync=False, mq_timeout=self.mq_timeout)
+            if connector.started:
+                LOG.info(f"MQ Connection Established to "
+                         f"{connector.config.get('server')}:"
+                         f"{connector.config.get('port')}")
+            return connector.started
+        if connector.check_health():
+            return True
+        for name, consumer in list(connector.consumers.items()):
+            if not consumer.is_alive():
+                LOG.warning(f"Restarting MQ consumer: {name}")
+                connector.restart_consumer(name)
+                self.restarts += 1
+        return False
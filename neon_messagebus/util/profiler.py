@@ -0,0 +1,87 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from ovos_bus_client import MessageBusClient, Message
+
+from neon_messagebus.service.profiler import TrafficProfiler
+from neon_messagebus.util.envelope import get_message_type
+
+
+class BusProfiler:
+    def __init__(self, bus: MessageBusClient, top: int = 10,
+                 timeout: float = 5):
+        """
+        Profile traffic on a running bus from a client connection. Every
+        client receives every message, so message types are counted as they
+        arrive here. Fan-out assumes every message goes to every connection
+        and senders are counted by the service (message counts only).
+        :param bus: connected MessageBusClient
+        :param top: number of entries in each report list
+        :param timeout: seconds to wait for service metrics
+        """
+        self.bus = bus
+        self.top = top
+        self.timeout = timeout
+        self.profiler = TrafficProfiler()
+        self._connections = 1
+        self._start_clients = None
+        self._clients = dict()
+
+    def start(self):
+        self._start_clients = self._get_clients()
+        self.bus.on("message", self._on_message)
+
+    def stop(self):
+        self.bus.remove("message", self._on_message)
+
+    def _on_message(self, message: str):
+        self.profiler.add(get_message_type(message), len(message),
+                          fanout=self._connections)
+
+    def _get_clients(self) -> dict:
+        response = self.bus.wait_for_response(
+            Message("neon.messagebus.get_metrics"), timeout=self.timeout)
+        if not response:
+            return dict()
+        self._connections = response.data.get("connections") or 1
+        return {client: stats.get("received", 0) for client, stats in
+                (response.data.get("clients") or {}).items()}
+
+    def get_report(self) -> dict:
+        """
+        Get a report of traffic since `start`
+        """
+        report = self.profiler.get_report(self.top)
+        clients = self._get_clients() or self._clients
+        self._clients = clients
+        talkers = [{"client": client,
+                    "count": count - self._start_clients.get(client, 0),
+                    "bytes": None} for client, count in clients.items()]
+        report["talkers"] = sorted(talkers,
+                                   key=lambda t: -t["count"])[:self.top]
+        return report
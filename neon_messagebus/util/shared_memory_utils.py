@@ -0,0 +1,217 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque
+from threading import Lock
+from time import monotonic
+from typing import TYPE_CHECKING, Dict, Optional, Union
+from uuid import uuid4
+
+from ovos_bus_client import MessageBusClient, Message
+from ovos_utils.log import LOG
+
+if TYPE_CHECKING:
+    from multiprocessing.shared_memory import SharedMemory
+
+# `multiprocessing.shared_memory` (Python 3.8+) is imported where it is used
+# so the rest of the package imports on older Pythons
+_attached_segments: Dict[str, "SharedMemory"] = dict()
+_attach_lock = Lock()
+
+
+class _Block:
+    __slots__ = ("block_id", "offset", "length", "remaining", "expires")
+
+    def __init__(self, block_id: int, offset: int, length: int,
+                 remaining: int, expires: float):
+        self.block_id = block_id
+        self.offset = offset
+        self.length = length
+        self.remaining = remaining
+        self.expires = expires
+
+
+class SharedMemoryWriter:
+    def __init__(self, bus: MessageBusClient, size: int = 16 * 1024 * 1024,
+                 subscribers: int = 1, ttl: float = 30):
+        """
+        Ring buffer in shared memory for sending binary data to consumers on
+        the same host. Messages carry a handle to the data instead of the
+        data; a block is reused after `subscribers` consumers acknowledge it,
+        or after `ttl` seconds if some never do.
+        :param bus: MessageBusClient to receive acknowledgements on
+        :param size: bytes of shared memory to allocate
+        :param subscribers: default number of acknowledgements per block
+        :param ttl: seconds after which unacknowledged blocks are reclaimed
+        """
+        from multiprocessing.shared_memory import SharedMemory
+        self.bus = bus
+        self.subscribers = subscribers
+        self.ttl = ttl
+        self._shm = SharedMemory(name=f"neon_bus_{uuid4().hex[:16]}",
+                                 create=True, size=size)
+        self._blocks = deque()
+        self._pending: Dict[int, _Block] = dict()
+        self._head = 0
+        self._next_id = 0
+        self._lock = Lock()
+        self.bus.on("neon.shared_memory.ack", self._handle_ack)
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    @property
+    def size(self) -> int:
+        return self._shm.size
+
+    def write(self, binary_data: Union[bytes, bytearray, memoryview],
+              subscribers: Optional[int] = None) -> Optional[dict]:
+        """
+        Copy data into shared memory
+        :param binary_data: data to write
+        :param subscribers: number of acknowledgements before the block may
+            be reused, if different from the default
+        :returns: handle to include in a message, or None if there is not
+            enough free space
+        """
+        length = len(binary_data)
+        with self._lock:
+            offset = self._allocate(length)
+            if offset is None:
+                return None
+            self._shm.buf[offset:offset + length] = binary_data
+            block = _Block(self._next_id, offset, length,
+                           subscribers or self.subscribers,
+                           monotonic() + self.ttl)
+            self._next_id += 1
+            self._blocks.append(block)
+            self._pending[block.block_id] = block
+            self._head = offset + length
+        return {"name": self.name, "block": block.block_id,
+                "offset": offset, "length": length}
+
+    def close(self):
+        """
+        Stop handling acknowledgements and free the shared memory
+        """
+        self.bus.remove("neon.shared_memory.ack", self._handle_ack)
+        with self._lock:
+            self._blocks.clear()
+            self._pending.clear()
+        self._shm.close()
+        self._shm.unlink()
+
+    def _allocate(self, length: int) -> Optional[int]:
+        """
+        Find `length` contiguous free bytes after the newest block
+        """
+        self._reclaim()
+        if not self._blocks:
+            self._head = 0
+            return 0 if length <= self.size else None
+        tail = self._blocks[0].offset
+        if self._blocks[-1].offset < tail:
+            # Writes have wrapped around; free space is up to the oldest block
+            return self._head if self._head + length <= tail else None
+        if self._head + length <= self.size:
+            return self._head
+        return 0 if length <= tail else None
+
+    def _reclaim(self):
+        now = monotonic()
+        while self._blocks and (self._blocks[0].remaining <= 0 or
+                                self._blocks[0].expires < now):
+            block = self._blocks.popleft()
+            self._pending.pop(block.block_id, None)
+
+    def _handle_ack(self, message: Message):
+        if message.data.get("name") != self.name:
+            return
+        with self._lock:
+            block = self._pending.get(message.data.get("block"))
+            if block:
+                block.remaining -= 1
+
+
+def _open_segment(name: str) -> "SharedMemory":
+    """
+    Attach to an existing segment without taking ownership of it
+    :raises FileNotFoundError: if the segment has been unlinked
+    """
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    shm = SharedMemory(name=name)
+    # Only the writer may unlink the segment; don't let this process's
+    # resource tracker remove it on exit
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception as e:
+        LOG.debug(e)
+    return shm
+
+
+def _release_stale_segments():
+    """
+    Detach cached segments that their writer has unlinked, so a restarted
+    writer's old segment is not kept mapped by every reader. Segments with
+    views still in use are retried on the next call. Call with
+    `_attach_lock` held.
+    """
+    for name in list(_attached_segments):
+        try:
+            _open_segment(name).close()
+            continue
+        except FileNotFoundError:
+            pass
+        try:
+            _attached_segments[name].close()
+        except BufferError:
+            LOG.debug(f"Segment {name} is still in use")
+            continue
+        del _attached_segments[name]
+
+
+def _attach(name: str) -> "SharedMemory":
+    with _attach_lock:
+        if name not in _attached_segments:
+            _release_stale_segments()
+            _attached_segments[name] = _open_segment(name)
+        return _attached_segments[name]
+
+
+def read_shared_memory(handle: dict) -> memoryview:
+    """
+    Get a read-only view of data written by a SharedMemoryWriter. The view is
+    only valid until the block is acknowledged.
+    :param handle: handle included in a binary message
+    :returns: memoryview of the data without copying it
+    """
+    shm = _attach(handle["name"])
+    offset = handle["offset"]
+    return shm.buf[offset:offset + handle["length"]].toreadonly()
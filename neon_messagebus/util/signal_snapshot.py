@@ -0,0 +1,193 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import json
+import os
+
+from os.path import dirname, expanduser
+from threading import Event, Lock, Thread
+from time import time
+from typing import Callable, Dict, Optional, Tuple
+
+from ovos_utils.log import LOG
+
+
+class SignalSnapshot:
+    def __init__(self, path: str, interval: float = 5.0,
+                 max_age: Optional[float] = 3600, compact_every: int = 100):
+        """
+        Persists signal states so they survive a bus restart. Changed
+        signals are appended to a journal (`<path>.journal`) by a background
+        thread every `interval` seconds; the journal is periodically folded
+        into the snapshot file, which is replaced atomically. Signal handling
+        only records which signals changed.
+        :param path: snapshot file path
+        :param interval: seconds between journal writes
+        :param max_age: signals set longer ago than this are restored as
+            cleared; None to restore all signals
+        :param compact_every: journal writes between snapshot rewrites
+        """
+        self.path = expanduser(path)
+        self.journal_path = f"{self.path}.journal"
+        self.interval = interval
+        self.max_age = max_age
+        self.compact_every = compact_every
+        self._get_state: Optional[Callable[[], Dict[str, Tuple[bool,
+                                                               float]]]] = None
+        self._dirty = set()
+        self._dirty_lock = Lock()
+        self._write_lock = Lock()
+        self._seq = 0
+        self._journal_writes = 0
+        self._stopping = Event()
+        self._thread = None
+
+    def restore(self) -> Dict[str, Tuple[bool, float]]:
+        """
+        Read saved signal states, applying `max_age`
+        :returns: dict of signal name to (is_set, create_time)
+        """
+        states = dict()
+        snapshot_seq = 0
+        try:
+            with open(self.path) as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot.get("seq", 0)
+            states.update({name: tuple(state) for name, state in
+                           snapshot.get("signals", {}).items()})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            LOG.error(f"Failed to read signal snapshot {self.path}: {e}")
+        self._seq = snapshot_seq
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        seq, changed = json.loads(line)
+                    except ValueError:
+                        # Interrupted write
+                        break
+                    if seq <= snapshot_seq:
+                        # Already in the snapshot
+                        continue
+                    states.update({name: tuple(state) for name, state in
+                                   changed.items()})
+                    self._seq = seq
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            LOG.error(f"Failed to read signal journal: {e}")
+        if self.max_age is not None:
+            oldest = time() - self.max_age
+            states = {name: (is_set and create_time >= oldest, create_time)
+                      for name, (is_set, create_time) in states.items()}
+        return states
+
+    def start(self, get_state: Callable[[], Dict[str, Tuple[bool, float]]]):
+        """
+        Write a full snapshot, then start saving changed signals
+        :param get_state: returns a dict of signal name to
+            (is_set, create_time) for all signals
+        """
+        self._get_state = get_state
+        self.compact()
+        self._stopping.clear()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread and write a full snapshot
+        """
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(self.interval + 5)
+            self._thread = None
+        if self._get_state:
+            self.compact()
+
+    def mark(self, signal: str):
+        """
+        Note that a signal changed and must be saved
+        :param signal: signal name
+        """
+        with self._dirty_lock:
+            self._dirty.add(signal)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                LOG.error(f"Failed to save signals: {e}")
+
+    def write(self):
+        """
+        Append changed signals to the journal, compacting it into the
+        snapshot every `compact_every` writes
+        """
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        with self._write_lock:
+            states = self._get_state()
+            self._seq += 1
+            line = json.dumps([self._seq, {name: states[name]
+                                           for name in dirty
+                                           if name in states}])
+            with open(self.journal_path, "a") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_writes += 1
+        if self._journal_writes >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        Atomically replace the snapshot with the state of all signals and
+        empty the journal
+        """
+        with self._dirty_lock:
+            self._dirty.clear()
+        with self._write_lock:
+            states = self._get_state()
+            os.makedirs(dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"seq": self._seq, "saved": time(),
+                           "signals": states}, f, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            # Journal entries up to `seq` are now in the snapshot; they are
+            # skipped on restore if this is interrupted
+            open(self.journal_path, "w").close()
+            self._journal_writes = 0
@@ -0,0 +1,242 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import struct
+
+from threading import Lock
+from time import time
+from typing import Dict, Optional, Tuple
+from zlib import crc32
+
+from ovos_utils.log import LOG
+
+SIGNAL_TABLE_NAME = "neon_signals"
+
+_MAGIC = b"NSIG"
+_VERSION = 1
+# magic, version, slots, flags
+_HEADER = struct.Struct("<4sIII16x")
+# seq, state, name length, hash, create_time, name
+_SLOT = struct.Struct("<IBBxxQd72s")
+_SEQ = struct.Struct("<I")
+_MAX_NAME = 72
+_FLAG_OVERFLOW = 1
+_EMPTY, _CLEAR, _SET = 0, 1, 2
+
+# `multiprocessing.shared_memory` (Python 3.8+) is imported where it is used
+# so the service imports on older Pythons
+_readers: Dict[str, "SharedSignalTable"] = dict()
+_readers_lock = Lock()
+
+
+class SharedSignalTable:
+    def __init__(self, name: str = SIGNAL_TABLE_NAME, slots: int = 1024,
+                 create: bool = False):
+        """
+        Fixed-size hashed table of signal states in shared memory (/dev/shm),
+        so processes on the same host can read signals without a bus round
+        trip. Only the SignalManager writes to the table; each slot is
+        guarded by a sequence counter so readers never see a partial write.
+        :param name: shared memory segment name
+        :param slots: number of signals the table can hold (writer only)
+        :param create: if True, create (or reset) the table for writing
+        """
+        from multiprocessing import resource_tracker
+        from multiprocessing.shared_memory import SharedMemory
+        self.name = name
+        self._lock = Lock()
+        self._writer = create
+        if create:
+            size = _HEADER.size + slots * _SLOT.size
+            try:
+                self._shm = SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a previous run; reuse it so attached readers
+                # see the new state
+                self._shm = SharedMemory(name=name)
+                if self._shm.size < size:
+                    # Tell readers attached to the old segment to re-attach
+                    self._shm.buf[:4] = bytes(4)
+                    self._shm.close()
+                    self._shm.unlink()
+                    self._shm = SharedMemory(name=name, create=True,
+                                             size=size)
+            self._shm.buf[:size] = bytes(size)
+            self.slots = slots
+            _HEADER.pack_into(self._shm.buf, 0, _MAGIC, _VERSION, slots, 0)
+        else:
+            self._shm = SharedMemory(name=name)
+            # Only the writer may unlink the segment; don't let this
+            # process's resource tracker remove it on exit
+            try:
+                resource_tracker.unregister(self._shm._name, "shared_memory")
+            except Exception as e:
+                LOG.debug(e)
+            magic, version, self.slots, _ = \
+                _HEADER.unpack_from(self._shm.buf, 0)
+            if magic != _MAGIC or version != _VERSION:
+                self._shm.close()
+                raise ValueError(f"{name} is not a signal table")
+
+    @property
+    def valid(self) -> bool:
+        """
+        False once the writer has closed the table
+        """
+        return self._shm.buf[:4] == _MAGIC
+
+    def _find(self, name: bytes, name_hash: int) -> Tuple[Optional[int],
+                                                          Optional[tuple]]:
+        """
+        Find the slot holding `name`, or the empty slot it would be stored in
+        :returns: slot offset (None if the table is full), and its fields if
+            the slot holds `name`
+        """
+        buf = self._shm.buf
+        index = name_hash % self.slots
+        for _ in range(self.slots):
+            offset = _HEADER.size + index * _SLOT.size
+            for _ in range(100):
+                fields = _SLOT.unpack_from(buf, offset)
+                if not fields[0] & 1 and \
+                        _SEQ.unpack_from(buf, offset)[0] == fields[0]:
+                    break
+            else:
+                # The writer is stuck or gone mid-write
+                return None, None
+            if fields[1] == _EMPTY:
+                return offset, None
+            if fields[3] == name_hash and fields[5][:fields[2]] == name:
+                return offset, fields
+            index = (index + 1) % self.slots
+        return None, None
+
+    def set(self, signal: str, is_set: bool, create_time: float) -> bool:
+        """
+        Publish the state of a signal
+        :param signal: signal name
+        :param is_set: True if the signal is set
+        :param create_time: time the signal was last created
+        :returns: False if the name is too long or the table is full
+        """
+        name = signal.encode()
+        if len(name) > _MAX_NAME:
+            return False
+        name_hash = crc32(name)
+        with self._lock:
+            offset, fields = self._find(name, name_hash)
+            buf = self._shm.buf
+            if offset is None:
+                flags = _HEADER.unpack_from(buf, 0)[3]
+                _HEADER.pack_into(buf, 0, _MAGIC, _VERSION, self.slots,
+                                  flags | _FLAG_OVERFLOW)
+                LOG.warning(f"Signal table full; {signal} is only "
+                            f"available over the bus")
+                return False
+            seq = _SEQ.unpack_from(buf, offset)[0]
+            _SEQ.pack_into(buf, offset, seq + 1)
+            _SLOT.pack_into(buf, offset, seq + 1, _SET if is_set else _CLEAR,
+                            len(name), name_hash, create_time, name)
+            _SEQ.pack_into(buf, offset, seq + 2)
+        return True
+
+    def get(self, signal: str) -> Optional[Tuple[bool, float]]:
+        """
+        Read the state of a signal
+        :param signal: signal name
+        :returns: (is_set, create_time), or None if the state is not in the
+            table and must be requested over the bus
+        """
+        name = signal.encode()
+        if len(name) > _MAX_NAME:
+            return None
+        offset, fields = self._find(name, crc32(name))
+        if fields:
+            return fields[1] == _SET, fields[4]
+        if offset is None or \
+                _HEADER.unpack_from(self._shm.buf, 0)[3] & _FLAG_OVERFLOW:
+            return None
+        # Signals that were never created are not set
+        return False, 0.0
+
+    def close(self):
+        """
+        Detach from the table; the writer also removes it
+        """
+        if self._writer and self._shm.buf is not None:
+            self._shm.buf[:4] = bytes(4)
+        self._shm.close()
+        if self._writer:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def _get_reader(name: str) -> Optional[SharedSignalTable]:
+    with _readers_lock:
+        table = _readers.get(name)
+        if table is not None and not table.valid:
+            # The bus service restarted; attach to the new table
+            table.close()
+            table = None
+        if table is None:
+            try:
+                table = SharedSignalTable(name)
+            except (FileNotFoundError, ValueError):
+                return None
+            _readers[name] = table
+        return table
+
+
+def check_shared_signal(signal: str, sec_lifetime: int = -1,
+                        name: str = SIGNAL_TABLE_NAME) -> Optional[bool]:
+    """
+    Check a signal in the shared signal table without a bus round trip.
+    Clearing a signal still goes through the SignalManager, so a set signal
+    checked with `sec_lifetime=0` returns None.
+    :param signal: signal name
+    :param sec_lifetime: as for `neon.check_for_signal`; -1 to only check the
+        state, >0 to treat signals older than this many seconds as not set
+    :param name: shared memory segment name
+    :returns: signal state, or None if the caller should send
+        `neon.check_for_signal` over the bus instead
+    """
+    table = _get_reader(name)
+    state = table.get(signal) if table else None
+    if state is None:
+        return None
+    is_set, create_time = state
+    if not is_set:
+        return False
+    if sec_lifetime == 0:
+        return None
+    if sec_lifetime > 0 and create_time + sec_lifetime < time():
+        # The manager clears expired signals when asked over the bus
+        return False
+    return True
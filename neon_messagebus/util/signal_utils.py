@@ -26,14 +26,19 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
-from threading import Event
-from time import time
+from functools import wraps
+from threading import Event, Lock
+from time import monotonic, time
 from typing import Optional, Dict
 from ovos_bus_client import MessageBusClient, Message
 from ovos_utils.log import LOG
 from ovos_config.config import Configuration
 from ovos_utils.signal import create_signal, check_for_signal
 
+from neon_messagebus.util.executor import HandlerExecutor
+from neon_messagebus.util.signal_snapshot import SignalSnapshot
+from neon_messagebus.util.signal_table import SharedSignalTable
+
 
 class Signal:
     def __init__(self):
@@ -85,17 +90,139 @@ class Signal:
 
 class SignalManager:
     def __init__(self, bus: MessageBusClient = None,
-                 handle_files: bool = True):
+                 handle_files: bool = True,
+                 shared_table: Optional[SharedSignalTable] = None,
+                 snapshot: Optional[SignalSnapshot] = None,
+                 executor: Optional[HandlerExecutor] = None):
+        """
+        Manages signal state for clients that create and check signals over
+        the bus.
+        :param bus: MessageBusClient to handle signal requests from
+        :param handle_files: if True, also create and remove signal files
+        :param shared_table: optional SharedSignalTable to publish signal
+            states to for processes on the same host
+        :param snapshot: optional SignalSnapshot to restore signal states
+            from and save them to
+        :param executor: optional HandlerExecutor to run signal requests in;
+            by default they run in the bus client's handler threads
+        """
         self._signal_config = dict(Configuration())
         self._signals: Dict[str, Signal] = dict()
         self.bus = bus or MessageBusClient()
         self._handle_files = handle_files
+        self._shared_table = shared_table
+        self._snapshot = None
+        self._executor = executor
+        self._metrics_lock = Lock()
+        self._handled = 0
+        self._busy = 0.0
+        self._active = 0
+        self._max_active = 0
+        if snapshot:
+            self._restore(snapshot)
+            self.set_snapshot(snapshot)
         self._register_listeners()
         if not self.bus.started_running:
             self.bus.run_in_thread()
         if not self.bus.connected_event.wait(60):
             LOG.error(f"Bus not connected after 60 seconds")
 
+    def reload_config(self, handle_files: Optional[bool] = None):
+        """
+        Reload the configuration used to locate signal files
+        :param handle_files: if set, enable or disable signal files
+        """
+        self._signal_config = dict(Configuration())
+        if handle_files is not None:
+            self._handle_files = handle_files
+
+    def set_shared_table(self, shared_table: Optional[SharedSignalTable]):
+        """
+        Publish signal states to a different shared table
+        :param shared_table: SharedSignalTable to write, or None to stop
+        """
+        self._shared_table = shared_table
+        for signal in list(self._signals):
+            self._publish(signal)
+
+    def set_snapshot(self, snapshot: Optional[SignalSnapshot]):
+        """
+        Save signal states with a different snapshot
+        :param snapshot: SignalSnapshot to save to, or None to stop saving
+        """
+        if self._snapshot:
+            self._snapshot.stop()
+        self._snapshot = snapshot
+        if snapshot:
+            snapshot.start(self._get_states)
+
+    def shutdown(self):
+        """
+        Save signal states and stop saving them
+        """
+        self.set_snapshot(None)
+
+    def get_metrics(self) -> dict:
+        """
+        Get the number of signals and handler counters. `busy` is the total
+        seconds spent in handlers (including waiting for signals), and
+        `max_active` the most handlers running at once.
+        """
+        with self._metrics_lock:
+            return {"signals": len(self._signals),
+                    "handled": self._handled,
+                    "busy": self._busy,
+                    "active": self._active,
+                    "max_active": self._max_active}
+
+    def _timed(self, handler, wait: bool = False):
+        @wraps(handler)
+        def wrapper(message: Message):
+            with self._metrics_lock:
+                self._active += 1
+                self._max_active = max(self._max_active, self._active)
+            start = monotonic()
+            try:
+                handler(message)
+            finally:
+                with self._metrics_lock:
+                    self._active -= 1
+                    self._handled += 1
+                    self._busy += monotonic() - start
+        if self._executor:
+            return self._executor.wrap(wrapper, wait=wait)
+        return wrapper
+
+    def _get_states(self) -> Dict[str, tuple]:
+        return {name: (signal.is_set, signal.create_time)
+                for name, signal in list(self._signals.items())}
+
+    def _restore(self, snapshot: SignalSnapshot):
+        for name, (is_set, create_time) in snapshot.restore().items():
+            self._ensure_signal_is_defined(name)
+            if is_set:
+                if self._handle_files:
+                    create_signal(name, config=self._signal_config)
+                self._signals[name].create()
+            self._signals[name].create_time = create_time
+            self._publish(name)
+        LOG.info(f"Restored {len(self._signals)} signals")
+
+    def _publish(self, signal: str):
+        shared_table = self._shared_table
+        if shared_table is not None:
+            state = self._signals[signal]
+            shared_table.set(signal, state.is_set, state.create_time)
+        snapshot = self._snapshot
+        if snapshot is not None:
+            snapshot.mark(signal)
+
+    def _clear(self, signal: str):
+        if self._handle_files:
+            check_for_signal(signal, config=self._signal_config)
+        self._signals[signal].clear()
+        self._publish(signal)
+
     def create_signal(self, signal: str) -> bool:
         """
         Set the specified signal, creating it if it doesn't exist
@@ -104,6 +231,7 @@ class SignalManager:
         if self._handle_files:
             create_signal(signal, config=self._signal_config)
         self._signals[signal].create()
+        self._publish(signal)
         return True
 
     def check_for_signal(self, signal: str, sec_lifetime: int = 0):
@@ -115,9 +243,7 @@ class SignalManager:
             return False
         if sec_lifetime == 0:
             # Clear the signal and return
-            if self._handle_files:
-                check_for_signal(signal, config=self._signal_config)
-            self._signals[signal].clear()
+            self._clear(signal)
             return True
         if sec_lifetime == -1:
             # Return signal state (True)
@@ -125,9 +251,7 @@ class SignalManager:
         if self._signals[signal].create_time + sec_lifetime < time():
             # Signal is expired and must be cleared
             LOG.debug(f"Clearing expired signal: {signal}")
-            if self._handle_files:
-                check_for_signal(signal, config=self._signal_config)
-            self._signals[signal].clear()
+            self._clear(signal)
             return False
         # Signal exists and is not yet expired
         return True
@@ -157,12 +281,16 @@ class SignalManager:
         """
         Register Event Handlers
         """
-        self.bus.on("neon.create_signal", self._handle_create_signal)
-        self.bus.on("neon.check_for_signal", self._handle_check_for_signal)
+        self.bus.on("neon.create_signal",
+                    self._timed(self._handle_create_signal))
+        self.bus.on("neon.check_for_signal",
+                    self._timed(self._handle_check_for_signal))
         self.bus.on("neon.wait_for_signal_create",
-                    self._handle_wait_for_signal_create)
+                    self._timed(self._handle_wait_for_signal_create,
+                                wait=True))
         self.bus.on("neon.wait_for_signal_clear",
-                    self._handle_wait_for_signal_clear)
+                    self._timed(self._handle_wait_for_signal_clear,
+                                wait=True))
         self.bus.on("neon.signal_manager_active",
                     self._handle_signal_manager_active)
 
@@ -0,0 +1,99 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+
+from os import urandom
+from typing import Optional, Tuple
+
+from ovos_bus_client import Message
+
+# W3C Trace Context header, carried in `Message.context`
+TRACEPARENT = "traceparent"
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+def new_trace_id() -> str:
+    """
+    Get a random 16 byte trace ID as hex
+    """
+    return urandom(16).hex()
+
+
+def new_span_id() -> str:
+    """
+    Get a random 8 byte span ID as hex
+    """
+    return urandom(8).hex()
+
+
+def format_traceparent(trace_id: str, span_id: str) -> str:
+    """
+    Build a sampled W3C `traceparent` value
+    :param trace_id: 32 character hex trace ID
+    :param span_id: 16 character hex span ID
+    :returns: traceparent string
+    """
+    return f"00-{trace_id}-{span_id}-01"
+
+
+def parse_traceparent(traceparent: Optional[str]) -> \
+        Optional[Tuple[str, str]]:
+    """
+    Parse a W3C `traceparent` value
+    :param traceparent: traceparent string
+    :returns: (trace_id, span_id) tuple, or None if not a valid traceparent
+    """
+    match = _TRACEPARENT.match(traceparent or "")
+    if not match:
+        return None
+    return match.group(1), match.group(2)
+
+
+def start_trace(context: Optional[dict] = None) -> dict:
+    """
+    Add a new trace to a message context unless it is already traced
+    :param context: message context to update
+    :returns: updated context
+    """
+    context = context if context is not None else dict()
+    if not parse_traceparent(context.get(TRACEPARENT)):
+        context[TRACEPARENT] = format_traceparent(new_trace_id(),
+                                                  new_span_id())
+    return context
+
+
+def get_trace_id(message: Message) -> Optional[str]:
+    """
+    Get the ID of the trace a message belongs to
+    :param message: Message to check
+    :returns: trace ID, or None if the message is not traced
+    """
+    parsed = parse_traceparent(message.context.get(TRACEPARENT))
+    return parsed[0] if parsed else None
@@ -0,0 +1,866 @@
+# NEON AI (TM) SOFTWARE, Software Development Kit & Application Framework
+# All trademark and other rights reserved by their respective owners
+# Copyright 2008-2022 Neongecko.com Inc.
+# Contributors: Daniel McKnight, Guy Daniels, Elon Gasper, Richard Leeds,
+# Regina Bloomstine, Casimiro Ferreira, Andrii Pernatii, Kirill Hrymailo
+# BSD-3 License
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 1. Redistributions of source code must retain the above copyright notice,
+#    this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from this
+#    software without specific prior written permission.
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR
+# PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+# CONTRIBUTORS  BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA,
+# OR PROFITS;  OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import json
+import os
+import resource
+import sys
+import unittest
+
+from time import time, sleep
+from multiprocessing import Process, Event as MPEvent
+from threading import Event, Thread
+
+from ovos_bus_client import Message
+from ovos_utils.log import LOG
+from tornado.httpclient import HTTPClientError
+from tornado.iostream import StreamClosedError
+from tornado.websocket import websocket_connect, WebSocketClosedError
+from websocket import create_connection, WebSocketException
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from neon_messagebus.service import NeonBusService
+from neon_messagebus.service.profiler import percentile
+
+
+def _get_service(port: int = 8181, **ws_config) -> NeonBusService:
+    """
+    Start a service with the given `websocket` config on `port`
+    """
+    ws_config = {"host": "0.0.0.0", "port": port, "route": "/core",
+                 **ws_config}
+    service = NeonBusService(config={"websocket": ws_config}, daemonic=True)
+    service.start()
+    service.started.wait()
+    return service
+
+
+def _get_connection(port: int = 8181, on_message: callable = None):
+    """
+    Get a raw websocket connection to the bus. Received messages are passed
+    to `on_message` (or discarded) in a daemon thread.
+    """
+    connection = create_connection(f"ws://127.0.0.1:{port}/core",
+                                   skip_utf8_validation=True)
+
+    def _receive():
+        try:
+            while True:
+                message = connection.recv()
+                if on_message:
+                    on_message(message)
+        except (WebSocketException, OSError):
+            pass
+
+    Thread(target=_receive, daemon=True).start()
+    return connection
+
+
+def _run_service_process(ws_config: dict, ready: MPEvent, stop: MPEvent):
+    service = _get_service(**ws_config)
+    ready.set()
+    stop.wait()
+    service.shutdown()
+
+
+def _get_rss(pid: int) -> int:
+    with open(f"/proc/{pid}/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+class TestConnectionScaling(unittest.TestCase):
+    num_connections = int(os.environ.get("BENCHMARK_CONNECTIONS", 2000))
+    port = 8184
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2 * cls.num_connections + 256:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (min(hard, 2 * cls.num_connections + 256),
+                                hard))
+        cls.ready = MPEvent()
+        cls.stop = MPEvent()
+        cls.service = Process(target=_run_service_process,
+                              args=({"port": cls.port,
+                                     "max_connections":
+                                         cls.num_connections + 1},
+                                    cls.ready, cls.stop), daemon=True)
+        cls.service.start()
+        cls.ready.wait(30)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.stop.set()
+        cls.service.join(30)
+
+    def test_idle_connection_scaling(self):
+        rss_before = _get_rss(self.service.pid)
+        rss_connected = 0
+
+        async def _run():
+            nonlocal rss_connected
+            url = f"ws://127.0.0.1:{self.port}/core"
+            connections = list()
+            accept_times = list()
+            for _ in range(self.num_connections):
+                start = time()
+                connection = await websocket_connect(url)
+                await connection.read_message()  # `connected` message
+                accept_times.append(time() - start)
+                connections.append(connection)
+            rss_connected = _get_rss(self.service.pid)
+            with self.assertRaises(HTTPClientError) as e:
+                await websocket_connect(url)
+            self.assertEqual(e.exception.code, 503)
+            for connection in connections:
+                connection.close()
+            return accept_times
+
+        accept_times = asyncio.new_event_loop().run_until_complete(_run())
+        per_connection = (rss_connected - rss_before) / self.num_connections
+        LOG.info(f"{self.num_connections} idle connections: "
+                 f"{per_connection / 1024:.1f} KiB RSS per connection, "
+                 f"accept latency p50/p99/max: "
+                 f"{percentile(accept_times, 50) * 1000:.2f}/"
+                 f"{percentile(accept_times, 99) * 1000:.2f}/"
+                 f"{max(accept_times) * 1000:.2f}ms")
+        self.assertEqual(len(accept_times), self.num_connections)
+
+
+class TestPriorityLatency(unittest.TestCase):
+    num_messages = 200
+    binary_size = 1024 * 1024
+    consumer_delay = 0.05
+    consumer_stall = 1.0
+
+    def _measure_stop_latency(self, port: int) -> (list, list):
+        """
+        Measure `mycroft.stop` latency to a slow consumer, first on an idle
+        bus and then while large binary messages are sent continuously.
+        """
+        latencies = list()
+        stop_prefix = Message("mycroft.stop").serialize()[:21]
+        binary_prefix = Message("mycroft.binary.data").serialize()[:28]
+        stalled = Event()
+
+        def _slow_consumer(message: str):
+            if message.startswith(stop_prefix):
+                latencies.append(time() - json.loads(message)["data"]["sent"])
+            elif not stalled.is_set() and message.startswith(binary_prefix):
+                # Stall once so a backlog builds however fast the sender is
+                stalled.set()
+                sleep(self.consumer_stall)
+            else:
+                sleep(self.consumer_delay)
+
+        sender = _get_connection(port)
+        bulk_sender = _get_connection(port)
+        consumer = _get_connection(port, _slow_consumer)
+
+        def _send_stops():
+            latencies.clear()
+            for _ in range(self.num_messages):
+                sender.send(Message("mycroft.stop",
+                                    {"sent": time()}).serialize())
+                sleep(0.01)
+
+        def _wait_for_stops() -> list:
+            timeout = time() + 30
+            while len(latencies) < self.num_messages and time() < timeout:
+                sleep(0.1)
+            return list(latencies)
+
+        _send_stops()
+        idle = _wait_for_stops()
+
+        transferring = Event()
+        transferring.set()
+        binary_message = Message(
+            "mycroft.binary.data",
+            {"binary": os.urandom(self.binary_size).hex()}).serialize()
+
+        def _send_binary():
+            # Send at up to twice the rate the consumer reads, so the backlog
+            # grows at a bounded pace on fast hosts
+            while transferring.is_set():
+                bulk_sender.send(binary_message)
+                sleep(self.consumer_delay / 2)
+
+        bulk_thread = Thread(target=_send_binary, daemon=True)
+        bulk_thread.start()
+        stalled.wait(5)
+        sleep(self.consumer_stall + 0.5)
+        _send_stops()
+        transferring.clear()
+        bulk_thread.join()
+        loaded = _wait_for_stops()
+        for connection in (sender, bulk_sender, consumer):
+            connection.close()
+        return idle, loaded
+
+    def test_high_priority_latency_during_binary_transfer(self):
+        results = dict()
+        for name, port, priority in (("prioritized", 8181, None),
+                                     ("unprioritized", 8182, {})):
+            service = _get_service(port, priority=priority)
+            try:
+                results[name] = self._measure_stop_latency(port)
+            finally:
+                service.shutdown()
+            idle, loaded = results[name]
+            LOG.info(f"{name} mycroft.stop latency p50/p99 idle: "
+                     f"{percentile(idle, 50):.4f}/"
+                     f"{percentile(idle, 99):.4f}s, during binary transfer: "
+                     f"{percentile(loaded, 50):.4f}/"
+                     f"{percentile(loaded, 99):.4f}s "
+                     f"({len(loaded)}/{self.num_messages} received)")
+
+        idle, loaded = results["prioritized"]
+        self.assertEqual(len(loaded), self.num_messages)
+        self.assertLess(percentile(loaded, 99),
+                        max(10 * percentile(idle, 99), 0.5))
+        # Without priority lanes, stops wait behind the queued binaries
+        unprioritized = results["unprioritized"][1]
+        self.assertEqual(len(unprioritized), self.num_messages)
+        self.assertLess(percentile(loaded, 99),
+                        percentile(unprioritized, 99) / 2)
+
+
+class TestBinaryDecode(unittest.TestCase):
+    sizes = [1024 * 2 ** n for n in range(0, 16, 3)] + [50 * 1024 * 1024]
+
+    def test_decode_binary_message(self):
+        from neon_messagebus.util.message_utils import \
+            decode_binary_message, decode_binary_message_into
+        buffer = bytearray(max(self.sizes))
+        for size in self.sizes:
+            byte_data = os.urandom(size)
+            message = Message("neon.audio.chunk", {"binary": byte_data.hex()})
+            serialized = message.serialize()
+            repeat = max(1, min(1000, 2 ** 24 // size))
+            modes = {
+                "serialized": lambda: decode_binary_message(serialized),
+                "bytearray": lambda: decode_binary_message(message),
+                "bytes": lambda: decode_binary_message(message,
+                                                       mutable=False),
+                "into": lambda: decode_binary_message_into(message, buffer)
+            }
+            results = dict()
+            for name, decode in modes.items():
+                start = time()
+                for _ in range(repeat):
+                    decode()
+                results[name] = (time() - start) / repeat
+            self.assertEqual(decode_binary_message(message, mutable=False),
+                             byte_data)
+            self.assertEqual(decode_binary_message_into(message, buffer),
+                             size)
+            self.assertEqual(buffer[:size], byte_data)
+            LOG.info(f"decode {size} bytes: " + ", ".join(
+                f"{name}={1000 * t:.3f}ms ({size / t / 2 ** 20:.0f} MiB/s)"
+                for name, t in results.items()))
+
+
+class TestFileStreaming(unittest.TestCase):
+    file_size = int(os.environ.get("BENCHMARK_FILE_MB", 128)) * 1024 * 1024
+    port = 8185
+
+    def test_stream_binary_file_rss(self):
+        from tempfile import NamedTemporaryFile
+        from neon_messagebus.util.message_utils import NeonMessageBusClient, \
+            stream_binary_file_message
+        ready = MPEvent()
+        stop = MPEvent()
+        service = Process(target=_run_service_process,
+                          args=({"port": self.port, "max_msg_size": 4},
+                                ready, stop), daemon=True)
+        service.start()
+        ready.wait(30)
+        bus = NeonMessageBusClient(port=self.port, route="/core")
+        bus.run_in_thread()
+        bus.connected_event.wait(10)
+
+        def _get_private_rss() -> int:
+            with open(f"/proc/{os.getpid()}/statm") as f:
+                _, resident, shared = f.read().split()[:3]
+            return (int(resident) - int(shared)) * \
+                os.sysconf("SC_PAGE_SIZE")
+
+        peak_rss = 0
+
+        def _progress(sent: int, size: int):
+            nonlocal peak_rss
+            peak_rss = max(peak_rss, _get_private_rss())
+
+        with NamedTemporaryFile() as f:
+            chunk = os.urandom(1024 * 1024)
+            for _ in range(self.file_size // len(chunk)):
+                f.write(chunk)
+            f.flush()
+            rss_before = _get_private_rss()
+            start = time()
+            future = stream_binary_file_message(f.name, bus=bus,
+                                                progress=_progress)
+            self.assertEqual(future.result(600), self.file_size)
+            duration = time() - start
+        bus.close()
+        stop.set()
+        service.join(30)
+        growth = peak_rss - rss_before
+        LOG.info(f"streamed {self.file_size // 2 ** 20} MiB in "
+                 f"{duration:.2f}s ({self.file_size / duration / 2 ** 20:.0f}"
+                 f" MiB/s); private RSS growth {growth // 1024} KiB")
+        # Reading and hex-encoding the whole file would need 3x its size
+        self.assertLess(growth, self.file_size // 2)
+
+
+class TestMQBridge(unittest.TestCase):
+    def _publish(self, count: int, **kwargs) -> dict:
+        from neon_messagebus.util.mq_connector import MQBridge, LocalBroker
+        bridge = MQBridge(LocalBroker(latency=0.002), **kwargs)
+        bridge.start()
+        body = json.dumps({"msg_type": "klat.response",
+                           "data": {"responses": {"en-us": {
+                               "sentence": "test" * 20}}},
+                           "context": {}}).encode()
+        start = time()
+        for _ in range(count):
+            bridge.publish(body, "neon_chat_api_response")
+        self.assertTrue(bridge.flush(60))
+        duration = time() - start
+        metrics = bridge.get_metrics()
+        bridge.stop()
+        metrics["rate"] = count / duration
+        return metrics
+
+    def test_batched_publish_throughput(self):
+        unbatched = self._publish(500, batch_size=1, max_in_flight=1,
+                                  batch_interval=0)
+        batched = self._publish(20000)
+        for name, metrics in (("unbatched", unbatched),
+                              ("batched", batched)):
+            LOG.info(f"MQ bridge {name}: {metrics['rate']:.0f} msg/s in "
+                     f"{metrics['batches']} batches; confirm latency p50/p99 "
+                     f"{1000 * metrics['latency']['p50']:.1f}/"
+                     f"{1000 * metrics['latency']['p99']:.1f}ms")
+        self.assertGreater(batched["rate"], 10 * unbatched["rate"])
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def test_record_overhead(self):
+        from neon_messagebus.service.flight_recorder import FlightRecorder
+        recorder = FlightRecorder()
+        messages = [Message("test.message", {"i": i}).serialize()
+                    for i in range(1000)]
+        large = Message("test.large", {"data": "a" * 8192}).serialize()
+        count = 100000
+        start = time()
+        for i in range(count):
+            recorder.record(messages[i % 1000], None, 1, 10)
+        small_time = (time() - start) / count
+        start = time()
+        for i in range(count):
+            recorder.record(large, None, 1, 10)
+        large_time = (time() - start) / count
+        LOG.info(f"Flight recorder overhead per message: "
+                 f"{small_time * 1e6:.2f}us (kept), "
+                 f"{large_time * 1e6:.2f}us (type only)")
+        self.assertLess(max(small_time, large_time), 5e-6)
+
+
+class TestSharedSignalTable(unittest.TestCase):
+    def test_shared_signal_read(self):
+        from uuid import uuid4
+        from neon_messagebus.util.signal_table import SharedSignalTable, \
+            check_shared_signal
+        name = f"neon_signals_bench_{uuid4().hex[:8]}"
+        table = SharedSignalTable(name, create=True)
+        self.addCleanup(table.close)
+        for i in range(512):
+            table.set(f"signal_{i}", i % 2 == 0, time())
+        count = 100000
+        start = time()
+        for i in range(count):
+            check_shared_signal(f"signal_{i % 512}", -1, name)
+        read_time = (time() - start) / count
+        LOG.info(f"Shared signal check: {read_time * 1e6:.2f}us")
+        self.assertLess(read_time, 50e-6)
+
+
+class TestEnvelope(unittest.TestCase):
+    def test_routing_fields(self):
+        from neon_messagebus.util.envelope import Envelope
+        message = Message("test.large", {"payload": ["a" * 64] * 16384},
+                          {"session": {"session_id": "test"}}).serialize()
+        count = 50
+        start = time()
+        for _ in range(count):
+            parsed = json.loads(message)
+            parsed["type"], parsed["context"]
+        parse_time = (time() - start) / count
+        start = time()
+        for _ in range(count):
+            envelope = Envelope(message)
+            envelope.msg_type, envelope.context
+        envelope_time = (time() - start) / count
+        LOG.info(f"Routing fields of a {len(message)} byte message: "
+                 f"{parse_time * 1e6:.1f}us parsed, "
+                 f"{envelope_time * 1e6:.1f}us from envelope")
+        self.assertLess(envelope_time, parse_time / 10)
+
+
+class TestReconnectStorm(unittest.TestCase):
+    num_clients = int(os.environ.get("BENCHMARK_RECONNECTS", 1000))
+    port = 8193
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 2 * cls.num_clients + 256:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (min(hard, 2 * cls.num_clients + 256), hard))
+
+    def _start_service(self, ws_config: dict) -> (Process, MPEvent):
+        ready = MPEvent()
+        stop = MPEvent()
+        service = Process(target=_run_service_process,
+                          args=({"port": self.port, **ws_config}, ready,
+                                stop), daemon=True)
+        service.start()
+        self.assertTrue(ready.wait(30))
+        return service, stop
+
+    def _reconnect_storm(self, ws_config: dict, get_delay: callable) -> dict:
+        """
+        Connect `num_clients` clients, restart the service, and measure the
+        time until every client has reconnected
+        :param ws_config: `websocket` config for the service
+        :param get_delay: callable returning seconds to wait before a retry,
+            given the attempt number and the server's Retry-After delay
+        """
+        from neon_messagebus.util.backoff import get_retry_after
+        url = f"ws://127.0.0.1:{self.port}/core"
+        stats = {"attempts": 0, "rejected": 0}
+        connected = list()
+        reconnected = list()
+
+        async def _connect():
+            attempt = 0
+            while True:
+                stats["attempts"] += 1
+                retry_after = 0
+                try:
+                    connection = await websocket_connect(url)
+                    if await connection.read_message() is not None:
+                        return connection
+                except HTTPClientError as e:
+                    stats["rejected"] += 1
+                    retry_after = get_retry_after(
+                        e.response.headers if e.response else None)
+                except (OSError, WebSocketClosedError, StreamClosedError):
+                    pass
+                attempt += 1
+                await asyncio.sleep(get_delay(attempt, retry_after))
+
+        async def _client():
+            connection = await _connect()
+            connected.append(time())
+            while await connection.read_message() is not None:
+                pass
+            connection = await _connect()
+            reconnected.append(time())
+            connection.close()
+
+        async def _run():
+            service, stop = self._start_service(ws_config)
+            clients = [asyncio.ensure_future(_client())
+                       for _ in range(self.num_clients)]
+            while len(connected) < self.num_clients:
+                await asyncio.sleep(0.1)
+            stats["attempts"] = stats["rejected"] = 0
+            stop.set()
+            while service.is_alive():
+                await asyncio.sleep(0.1)
+            service, stop = self._start_service(ws_config)
+            restarted = time()
+            await asyncio.wait_for(asyncio.gather(*clients), 120)
+            stats["time_to_all"] = max(reconnected) - restarted
+            stats["p50"] = percentile(reconnected, 50) - restarted
+            stop.set()
+            service.join(30)
+
+        asyncio.new_event_loop().run_until_complete(_run())
+        return stats
+
+    def test_reconnect_storm(self):
+        from neon_messagebus.util.backoff import get_backoff
+        results = {
+            # Fixed 5 second retry, doubling, as in MessageBusClient
+            "fixed retry": self._reconnect_storm(
+                {}, lambda attempt, _: min(60, 5 * 2 ** (attempt - 1))),
+            "jittered retry with warm-up": self._reconnect_storm(
+                {"accept_backlog": 1024,
+                 "warmup": {"duration": 2, "rate": 500, "burst": 100}},
+                lambda attempt, retry_after:
+                retry_after + get_backoff(attempt, 1, 60))}
+        for name, stats in results.items():
+            LOG.info(f"{self.num_clients} clients, {name}: all reconnected "
+                     f"after {stats['time_to_all']:.2f}s (p50 "
+                     f"{stats['p50']:.2f}s) with {stats['attempts']} "
+                     f"attempts, {stats['rejected']} rejected")
+        # Fixed retry times depend on how long the restart took, so only the
+        # jittered clients are held to a bound
+        self.assertLess(results["jittered retry with warm-up"]["time_to_all"],
+                        30)
+
+
+class TestSignalManagerLoad(unittest.TestCase):
+    num_clients = int(os.environ.get("BENCHMARK_SIGNAL_CLIENTS", 8))
+    num_rounds = int(os.environ.get("BENCHMARK_SIGNAL_ROUNDS", 20))
+    port = 8197
+
+    def _run_clients(self) -> (list, int, float):
+        """
+        Send signal requests from concurrent clients
+        :returns: request latencies, number of unanswered requests, and
+            elapsed seconds
+        """
+        from ovos_bus_client import MessageBusClient
+        latencies = list()
+        failures = list()
+        clients = list()
+        for _ in range(self.num_clients):
+            client = MessageBusClient(port=self.port)
+            client.run_in_thread()
+            self.assertTrue(client.connected_event.wait(10))
+            clients.append(client)
+
+        def _request(client, msg_type: str, signal: str, **data):
+            start = time()
+            response = client.wait_for_response(
+                Message(msg_type, {"signal_name": signal, **data}),
+                f"{msg_type}.{signal}", timeout=10)
+            if response is None:
+                failures.append(msg_type)
+            else:
+                latencies.append(time() - start)
+
+        def _run(index: int, client):
+            for i in range(self.num_rounds):
+                signal = f"bench_{index}_{i % 4}"
+                _request(client, "neon.create_signal", signal)
+                _request(client, "neon.check_for_signal", signal,
+                         sec_lifetime=-1)
+                _request(client, "neon.check_for_signal", signal,
+                         sec_lifetime=60)
+                _request(client, "neon.wait_for_signal_create", signal,
+                         timeout=1)
+                _request(client, "neon.check_for_signal", signal,
+                         sec_lifetime=0)
+                _request(client, "neon.wait_for_signal_clear", signal,
+                         timeout=1)
+
+        threads = [Thread(target=_run, args=(i, client))
+                   for i, client in enumerate(clients)]
+        start = time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time() - start
+        for client in clients:
+            client.close()
+        return latencies, len(failures), elapsed
+
+    def test_signal_manager_load(self):
+        results = dict()
+        for handle_files in (True, False):
+            service = NeonBusService(config={
+                "websocket": {"host": "0.0.0.0", "port": self.port,
+                              "route": "/core"},
+                "signal": {"handle_files": handle_files}}, daemonic=True)
+            service.start()
+            self.assertTrue(service.started.wait(15))
+            try:
+                before = service.get_metrics()["signal_manager"]
+                latencies, failures, elapsed = self._run_clients()
+                after = service.get_metrics()["signal_manager"]
+            finally:
+                service.shutdown()
+            occupancy = (after["busy"] - before["busy"]) / elapsed
+            results[handle_files] = latencies, failures
+            LOG.info(f"SignalManager handle_files={handle_files}: "
+                     f"{len(latencies) / elapsed:.1f} requests/s, latency "
+                     f"p50/p90/p99 {percentile(latencies, 50) * 1000:.1f}/"
+                     f"{percentile(latencies, 90) * 1000:.1f}/"
+                     f"{percentile(latencies, 99) * 1000:.1f}ms, "
+                     f"handler occupancy {occupancy:.2f}, max concurrent "
+                     f"handlers {after['max_active']}, {failures} timed out")
+
+        for handle_files, (latencies, failures) in results.items():
+            self.assertEqual(failures, 0, f"handle_files={handle_files}")
+            self.assertEqual(len(latencies),
+                             self.num_clients * self.num_rounds * 6)
+            self.assertLess(percentile(latencies, 99), 2.0)
+
+
+def _get_cpu_time(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class TestRouterFanout(unittest.TestCase):
+    client_counts = (10, 100, 1000)
+    deliveries = int(os.environ.get("BENCHMARK_ROUTER_DELIVERIES", 50000))
+    port = 8199
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        needed = 2 * max(cls.client_counts) + 256
+        if soft < needed:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (min(hard, needed), hard))
+
+    def _measure(self, router: str) -> dict:
+        """
+        Route small messages to each number of clients
+        :returns: dict client count to (deliveries/s, server CPU us/delivery)
+        """
+        ready = MPEvent()
+        stop = MPEvent()
+        service = Process(target=_run_service_process,
+                          args=({"port": self.port, "router": router,
+                                 "max_connections":
+                                     max(self.client_counts) + 10},
+                                ready, stop), daemon=True)
+        service.start()
+        self.assertTrue(ready.wait(30))
+        url = f"ws://127.0.0.1:{self.port}/core"
+        results = dict()
+
+        async def _run(num_clients: int):
+            num_messages = max(20, self.deliveries // num_clients)
+            received = 0
+            done = asyncio.Event()
+            prefix = Message("test.fanout").serialize()[:20]
+
+            def _on_message(message):
+                nonlocal received
+                if message and message.startswith(prefix):
+                    received += 1
+                    if received == num_clients * num_messages:
+                        done.set()
+
+            clients = [await websocket_connect(
+                url, on_message_callback=_on_message)
+                for _ in range(num_clients)]
+            sender = await websocket_connect(url)
+            message = Message("test.fanout", {"data": "a" * 64}).serialize()
+            await asyncio.sleep(0.5)
+            cpu = _get_cpu_time(service.pid)
+            start = time()
+            for _ in range(num_messages):
+                await sender.write_message(message)
+            await asyncio.wait_for(done.wait(), 300)
+            elapsed = time() - start
+            cpu = _get_cpu_time(service.pid) - cpu
+            for client in (sender, *clients):
+                client.close()
+            await asyncio.sleep(0.5)
+            deliveries = num_clients * num_messages
+            results[num_clients] = (deliveries / elapsed,
+                                    cpu / deliveries * 1e6)
+
+        try:
+            loop = asyncio.new_event_loop()
+            for num_clients in self.client_counts:
+                loop.run_until_complete(_run(num_clients))
+            loop.close()
+        finally:
+            stop.set()
+            service.join(30)
+        return results
+
+    def test_router_fanout(self):
+        results = {router: self._measure(router)
+                   for router in ("broadcast", "batched")}
+        for router, counts in results.items():
+            for num_clients, (rate, cpu) in counts.items():
+                LOG.info(f"{router} router, {num_clients} clients: "
+                         f"{rate:.0f} deliveries/s, {cpu:.2f}us server CPU "
+                         f"per delivery")
+        for num_clients in self.client_counts:
+            self.assertLess(results["batched"][num_clients][1],
+                            results["broadcast"][num_clients][1])
+
+
+class TestWriteBatching(unittest.TestCase):
+    num_clients = 20
+    num_messages = int(os.environ.get("BENCHMARK_BATCH_MESSAGES", 2000))
+    port = 8201
+
+    def _measure(self, write_window_ms: float) -> (float, list):
+        """
+        Send small messages at a high rate to a number of clients
+        :returns: server CPU us per delivery and delivery latencies
+        """
+        ready = MPEvent()
+        stop = MPEvent()
+        service = Process(target=_run_service_process,
+                          args=({"port": self.port,
+                                 "write_window_ms": write_window_ms},
+                                ready, stop), daemon=True)
+        service.start()
+        self.assertTrue(ready.wait(30))
+        url = f"ws://127.0.0.1:{self.port}/core"
+        latencies = list()
+
+        async def _run():
+            total = self.num_clients * self.num_messages
+            done = asyncio.Event()
+            prefix = Message("test.small").serialize()[:19]
+
+            def _on_message(message):
+                if message and message.startswith(prefix):
+                    latencies.append(time() -
+                                     json.loads(message)["data"]["sent"])
+                    if len(latencies) == total:
+                        done.set()
+
+            clients = [await websocket_connect(
+                url, on_message_callback=_on_message)
+                for _ in range(self.num_clients)]
+            sender = await websocket_connect(url)
+            await asyncio.sleep(0.5)
+            cpu = _get_cpu_time(service.pid)
+            for _ in range(self.num_messages):
+                await sender.write_message(
+                    Message("test.small", {"sent": time()}).serialize())
+            await asyncio.wait_for(done.wait(), 120)
+            cpu = _get_cpu_time(service.pid) - cpu
+            for client in (sender, *clients):
+                client.close()
+            return cpu / total * 1e6
+
+        try:
+            loop = asyncio.new_event_loop()
+            cpu = loop.run_until_complete(_run())
+            loop.close()
+        finally:
+            stop.set()
+            service.join(30)
+        return cpu, latencies
+
+    def test_write_batching(self):
+        results = {window: self._measure(window) for window in (0, 1)}
+        for window, (cpu, latencies) in results.items():
+            LOG.info(f"write_window_ms={window}: {cpu:.2f}us server CPU per "
+                     f"delivery, latency p50/p99 "
+                     f"{percentile(latencies, 50) * 1000:.2f}/"
+                     f"{percentile(latencies, 99) * 1000:.2f}ms")
+        self.assertLess(results[1][0], results[0][0])
+
+
+
+class TestHandlerOffload(unittest.TestCase):
+    num_messages = 200
+    port = 8203
+    # `sum` over a range holds the GIL for the whole call (tens of ms)
+    cpu_work = range(3 * 10 ** 6)
+
+    def _measure(self, cpu_pool: str) -> (list, int):
+        """
+        Measure relay latency while CPU-bound work runs in the handler pool
+        :returns: list of latencies, number of CPU calls completed
+        """
+        service = NeonBusService(config={
+            "websocket": {"host": "0.0.0.0", "port": self.port,
+                          "route": "/core"},
+            "handlers": {"cpu_workers": 2, "cpu_pool": cpu_pool}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(30))
+        latencies = list()
+        prefix = Message("test.relay").serialize()[:19]
+
+        def _on_message(message: str):
+            if message.startswith(prefix):
+                latencies.append(time() - json.loads(message)["data"]["sent"])
+
+        receiver = _get_connection(self.port, _on_message)
+        sender = _get_connection(self.port)
+        loading = Event()
+        loading.set()
+        completed = 0
+
+        def _load():
+            nonlocal completed
+            while loading.is_set():
+                futures = [service._executor.submit_cpu(sum, self.cpu_work)
+                           for _ in range(2)]
+                for future in futures:
+                    future.result()
+                    completed += 1
+
+        # Start worker processes before measuring
+        service._executor.submit_cpu(sum, range(1)).result(30)
+        load_thread = Thread(target=_load, daemon=True)
+        load_thread.start()
+        sleep(0.5)
+        for _ in range(self.num_messages):
+            sender.send(Message("test.relay", {"sent": time()}).serialize())
+            sleep(0.01)
+        timeout = time() + 30
+        while len(latencies) < self.num_messages and time() < timeout:
+            sleep(0.1)
+        loading.clear()
+        load_thread.join()
+        for connection in (sender, receiver):
+            connection.close()
+        service.shutdown()
+        return latencies, completed
+
+    def test_cpu_handler_offload(self):
+        results = {pool: self._measure(pool) for pool in ("thread",
+                                                          "process")}
+        for pool, (latencies, completed) in results.items():
+            LOG.info(f"{pool} CPU pool: relay latency p50/p99 "
+                     f"{percentile(latencies, 50) * 1000:.2f}/"
+                     f"{percentile(latencies, 99) * 1000:.2f}ms, "
+                     f"{completed} CPU calls completed")
+            self.assertEqual(len(latencies), self.num_messages)
+        self.assertLess(percentile(results["process"][0], 99),
+                        percentile(results["thread"][0], 99))
+
+
+if __name__ == '__main__':
+    unittest.main()
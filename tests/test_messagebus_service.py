@@ -26,15 +26,19 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import json
 import os
 import sys
 import unittest
 
+from copy import deepcopy
+from threading import Event, Thread
 from time import time, sleep
 from unittest.mock import Mock, patch
 from click.testing import CliRunner
 from ovos_bus_client import MessageBusClient, Message
 from ovos_utils.log import LOG
+from websocket import create_connection, WebSocketBadStatusException
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 from neon_messagebus.service import NeonBusService
@@ -43,6 +47,27 @@ from neon_messagebus.service import NeonBusService
 _mock_langs = Mock(stt={"stt1", "stt2"}, tts={"tts1", "tts2", "tts3"},
                    skills={"skills1"})
 
+
+def _get_client(port: int, route: str = "/core", timeout: float = 5):
+    """
+    Connect to a test service and read the `connected` message
+    """
+    client = create_connection(f"ws://127.0.0.1:{port}{route}",
+                               skip_utf8_validation=True)
+    client.settimeout(timeout)
+    client.recv()  # `connected`
+    return client
+
+
+def _receive_type(client, msg_type: str) -> dict:
+    """
+    Read messages from `client` until one of type `msg_type`
+    """
+    while True:
+        message = json.loads(client.recv())
+        if message["type"] == msg_type:
+            return message
+
 class TestMessagebusService(unittest.TestCase):
     def test_bus_service(self):
         called_count = 0
@@ -93,6 +118,12 @@ class TestMessagebusService(unittest.TestCase):
             sleep(1)
 
         self.assertEqual(len(clients), called_count)
+        # Test metrics
+        metrics = service.get_metrics()
+        self.assertEqual(metrics["connections"], len(clients) + 2)
+        self.assertGreaterEqual(metrics["routed"], 1)
+        self.assertIsInstance(metrics["clients"], dict)
+        self.assertIsInstance(metrics["signal_manager"]["handled"], int)
         # Test shutdown
         self.assertTrue(service.started.is_set())
         self.assertTrue(service.is_alive())
@@ -117,6 +148,643 @@ class TestMessagebusService(unittest.TestCase):
                                      "tts": list(_mock_langs.tts),
                                      "skills": list(_mock_langs.skills)})
 
+    @patch("neon_utils.language_utils.get_supported_languages")
+    def test_get_languages_over_bus(self, get_langs):
+        get_langs.return_value = _mock_langs
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8205, "route": "/core"}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        client = MessageBusClient(port=8205)
+        client.run_in_thread()
+        self.assertTrue(client.connected_event.wait(10))
+        response = client.wait_for_response(Message("neon.languages.get"),
+                                            timeout=10)
+        self.assertIsNotNone(response)
+        self.assertEqual(response.data["tts"], list(_mock_langs.tts))
+        handlers = service.get_metrics()["handlers"]
+        self.assertEqual(handlers["cpu"]["completed"], 1)
+        self.assertEqual(handlers["cpu"]["pending"], 0)
+        client.close()
+        service.shutdown()
+
+    def test_admission_control(self):
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8183, "route": "/core",
+            "max_connections": 3}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        url = "ws://127.0.0.1:8183/core"
+        connections = [create_connection(url), create_connection(url)]
+        with self.assertRaises(WebSocketBadStatusException) as e:
+            create_connection(url)
+        self.assertEqual(e.exception.status_code, 503)
+        self.assertEqual(e.exception.resp_headers["retry-after"], "1")
+        connections.pop().close()
+        sleep(0.5)
+        connections.append(create_connection(url))
+        metrics = service.get_metrics()
+        self.assertEqual(metrics["handshakes"]["rejected"], 1)
+        self.assertEqual(metrics["handshakes"]["accepted"], 4)
+        for connection in connections:
+            connection.close()
+        service.shutdown()
+
+    def test_oversize_messages(self):
+        # Oversize messages are rejected by default
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8189, "route": "/core",
+            "max_frame": 1}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        sender = _get_client(8189, timeout=30)
+        receiver = _get_client(8189, timeout=30)
+        sender.send(Message("test.large",
+                            {"data": "a" * 2 * 1024 * 1024}).serialize())
+        sender.send(Message("test.small").serialize())
+        reply = _receive_type(sender, "neon.messagebus.rejected")
+        self.assertEqual(reply["data"]["type"], "test.large")
+        self.assertEqual(reply["data"]["max_frame"], 1024 * 1024)
+        seen = [json.loads(receiver.recv())["type"]]
+        while seen[-1] != "test.small":
+            seen.append(json.loads(receiver.recv())["type"])
+        self.assertNotIn("test.large", seen)
+        self.assertEqual(service.get_metrics()["oversize"],
+                         {"max_frame": 1024 * 1024, "rejected": 1,
+                          "spooled": 0})
+        sender.close()
+        receiver.close()
+        service.shutdown()
+
+        # Spooled messages are sent in chunks without blocking the loop
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8190, "route": "/core",
+            "max_msg_size": 128, "max_frame": 1, "oversize": "spool"}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        sender = _get_client(8190, timeout=30)
+        receivers = [_get_client(8190, timeout=30) for _ in range(4)]
+        received = dict()
+
+        def _receive(client):
+            # Read raw frames to count the chunks of the large message
+            frames, size = 0, 0
+            while True:
+                frame = client.recv_frame()
+                frames += 1
+                size += len(frame.data)
+                if frame.fin and size > 1024 * 1024:
+                    received[client] = (frames, size)
+                    return
+                if frame.fin:
+                    frames, size = 0, 0
+
+        threads = [Thread(target=_receive, args=(client,), daemon=True)
+                   for client in receivers]
+        for thread in threads:
+            thread.start()
+        large = Message("test.large",
+                        {"data": "a" * 100 * 1024 * 1024}).serialize()
+        Thread(target=sender.send, args=(large,), daemon=True).start()
+        latency = list()
+        while any(thread.is_alive() for thread in threads):
+            start = time()
+            service.get_metrics()
+            latency.append(time() - start)
+            sleep(0.05)
+        self.assertEqual(list(received.values()), [(101, len(large))] * 4)
+        # Receiving and decoding the 100 MiB frame itself takes a few hundred
+        # milliseconds on slow machines; the fan-out should add little to it
+        LOG.info(f"max loop latency={max(latency)}")
+        self.assertLess(max(latency), 1.5)
+        self.assertEqual(service.get_metrics()["oversize"]["spooled"], 1)
+
+        # The connections are still usable
+        sender.send(Message("test.small").serialize())
+        for client in receivers:
+            _receive_type(client, "test.small")
+        for client in [sender, *receivers]:
+            client.close()
+        service.shutdown()
+
+    def test_reload_config(self):
+        from neon_messagebus.service.scheduler import TokenBucket
+        config = {"websocket": {"host": "0.0.0.0", "port": 8191,
+                                "route": "/core"},
+                  "signal": {"handle_files": True}}
+        service = NeonBusService(config=config, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        client = _get_client(8191)
+
+        # Unchanged config is a no-op
+        self.assertEqual(service.reload_config(), [])
+
+        # Rate limits apply to connected clients
+        config["websocket"]["rate_limit"] = {"default": {"rate": 1}}
+        self.assertEqual(service.reload_config(), ["websocket"])
+        state = service._scheduler._connections[service._connections[-1]]
+        self.assertIsInstance(state.bucket, TokenBucket)
+
+        # Route changes apply to new connections only
+        config["websocket"]["route"] = "/bus"
+        config["websocket"]["rate_limit"] = None
+        self.assertEqual(service.reload_config(), ["websocket"])
+        with self.assertRaises(Exception):
+            _get_client(8191)
+        new_client = _get_client(8191, "/bus")
+        new_client.send(Message("test.route").serialize())
+        _receive_type(client, "test.route")
+
+        # Listeners are moved without dropping connected clients
+        new_config = deepcopy(config)
+        new_config["websocket"]["port"] = 8192
+        new_config["signal"]["handle_files"] = False
+        new_config["MQ"] = {"supervisor": {"min_delay": 0}}
+        with patch("neon_messagebus.service.MQConnectorSupervisor") as sup:
+            self.assertEqual(service.reload_config(new_config),
+                             ["websocket", "signal", "MQ"])
+            sup.assert_called_once()
+            self.assertEqual(sup.call_args[1], {"min_delay": 0})
+            sup.return_value.start.assert_called_once()
+            service._mq_supervisor = None
+        self.assertFalse(service._signal_manager._handle_files)
+        self.assertEqual(service._bus.config.port, 8192)
+        with self.assertRaises(Exception):
+            _get_client(8191, "/bus")
+        moved_client = _get_client(8192, "/bus")
+        moved_client.send(Message("test.moved").serialize())
+        _receive_type(client, "test.moved")
+        _receive_type(new_client, "test.moved")
+
+        # Reload may be requested with a bus message
+        new_config["websocket"]["max_frame"] = 1
+        client.send(Message("neon.messagebus.reload_config").serialize())
+        response = _receive_type(client,
+                                 "neon.messagebus.reload_config.response")
+        self.assertEqual(response["data"], {"changed": ["websocket"]})
+        self.assertEqual(service.get_metrics()["oversize"]["max_frame"],
+                         1024 * 1024)
+        self.assertEqual(service.get_metrics()["connections"], 4)
+
+        for connection in (client, new_client, moved_client):
+            connection.close()
+        service.shutdown()
+
+    def test_flight_recorder_dump(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        dump_dir = mkdtemp()
+        self.addCleanup(rmtree, dump_dir)
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8194, "route": "/core",
+            "flight_recorder": {"size": 16, "dump_dir": dump_dir}}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        client = _get_client(8194)
+        for i in range(3):
+            client.send(Message("test.recorded", {"i": i}).serialize())
+        client.send(Message("neon.messagebus.dump_flight_recorder").
+                    serialize())
+        response = _receive_type(
+            client, "neon.messagebus.dump_flight_recorder.response")
+        with open(response["data"]["path"]) as f:
+            dump = json.load(f)
+        self.assertEqual(dump["reason"], "requested")
+        recorded = [json.loads(m["message"])["data"]["i"]
+                    for m in dump["messages"]
+                    if m["type"] == "test.recorded"]
+        self.assertEqual(recorded, [0, 1, 2])
+        self.assertEqual(service.get_metrics()["flight_recorder"]["size"],
+                         16)
+
+        # Recorded messages are kept when unrelated config is reloaded
+        config = deepcopy(service.config)
+        config["websocket"]["max_frame"] = 1
+        service.reload_config(config)
+        path = service.dump_flight_recorder("test")
+        with open(path) as f:
+            self.assertEqual(json.load(f)["recorded"], dump["recorded"] + 1)
+        client.close()
+        service.shutdown()
+
+    def test_profile(self):
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8195, "route": "/core"}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        self.assertIsNone(service.get_profile())
+        client = _get_client(8195, "/core?client_id=tester")
+        client.send(Message("neon.messagebus.profile.start").serialize())
+        _receive_type(client, "neon.messagebus.profile.start.response")
+        for i in range(3):
+            client.send(Message("test.profiled", {"i": i}).serialize())
+        client.send(Message("neon.messagebus.profile.stop",
+                            {"top": 50}).serialize())
+        response = _receive_type(client,
+                                 "neon.messagebus.profile.stop.response")
+        report = response["data"]["profile"]
+        profiled = [t for t in report["top_count"]
+                    if t["type"] == "test.profiled"][0]
+        self.assertEqual(profiled["count"], 3)
+        self.assertGreater(profiled["fanout_bytes"], profiled["bytes"])
+        self.assertIn("tester",
+                      [t["client"] for t in report["talkers"]])
+        self.assertIsNone(service.get_profile())
+        self.assertIsNone(service._handler_kwargs["context"].profiler)
+        client.close()
+        service.shutdown()
+
+    def test_batched_router(self):
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8198, "route": "/core",
+            "router": "batched"}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        receivers = [create_connection("ws://127.0.0.1:8198/core",
+                                       skip_utf8_validation=True)
+                     for _ in range(3)]
+        sender = create_connection("ws://127.0.0.1:8198/core")
+        sizes = (10, 200, 70000)
+        for i in range(30):
+            sender.send(Message("test.batched",
+                                {"i": i,
+                                 "data": "a" * sizes[i % 3]}).serialize())
+        for receiver in receivers:
+            receiver.settimeout(5)
+            received = list()
+            while len(received) < 30:
+                message = json.loads(receiver.recv())
+                if message["type"] == "test.batched":
+                    self.assertEqual(len(message["data"]["data"]),
+                                     sizes[message["data"]["i"] % 3])
+                    received.append(message["data"]["i"])
+            self.assertEqual(received, list(range(30)))
+        metrics = service.get_metrics()["router"]
+        self.assertEqual(metrics["name"], "batched")
+        self.assertGreaterEqual(metrics["batched"], 30)
+        self.assertLessEqual(metrics["batches"], metrics["batched"])
+
+        config = deepcopy(service.config)
+        config["websocket"]["router"] = "broadcast"
+        service.reload_config(config)
+        self.assertEqual(service.get_metrics()["router"],
+                         {"name": "broadcast"})
+        sender.send(Message("test.broadcast").serialize())
+        _receive_type(receivers[0], "test.broadcast")
+        for connection in (sender, *receivers):
+            connection.close()
+        service.shutdown()
+
+    def test_write_batching(self):
+        from neon_messagebus.util.message_utils import NeonMessageBusClient
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8200, "route": "/core",
+            "write_window_ms": 20}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        plain = create_connection("ws://127.0.0.1:8200/core")
+        batching = create_connection("ws://127.0.0.1:8200/core?batch=1")
+        received = list()
+        all_received = Event()
+
+        def _on_batched(message):
+            received.append(message.data["i"])
+            if len(received) == 20:
+                all_received.set()
+
+        client = NeonMessageBusClient(port=8200, batch=True)
+        client.on("test.batched", _on_batched)
+        client.run_in_thread()
+        self.assertTrue(client.connected_event.wait(10))
+        sender = create_connection("ws://127.0.0.1:8200/core")
+        for i in range(20):
+            sender.send(Message("test.batched", {"i": i}).serialize())
+
+        # Messages within the window are written together
+        plain.settimeout(5)
+        plain_received = list()
+        while len(plain_received) < 20:
+            message = json.loads(plain.recv())
+            if message["type"] == "test.batched":
+                plain_received.append(message["data"]["i"])
+        self.assertEqual(plain_received, list(range(20)))
+
+        batching.settimeout(5)
+        batch_received = list()
+        frames = 0
+        while len(batch_received) < 20:
+            frame = json.loads(batching.recv())
+            frames += 1
+            for message in frame if isinstance(frame, list) else [frame]:
+                if message["type"] == "test.batched":
+                    batch_received.append(message["data"]["i"])
+        self.assertEqual(batch_received, list(range(20)))
+        self.assertLess(frames, 20)
+
+        self.assertTrue(all_received.wait(5))
+        self.assertEqual(received, list(range(20)))
+        client.close()
+        for connection in (plain, batching, sender):
+            connection.close()
+        service.shutdown()
+
+    def test_namespaces(self):
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8202, "route": "/core",
+            "router": "batched",
+            "namespaces": {"tokens": {"token-a": "a", "token-b": "b"},
+                           "bridge": {"test.announce": ["*"],
+                                      "test.to_a": ["a"]}}}},
+            daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        url = "ws://127.0.0.1:8202/core"
+        default = create_connection(url)
+        a1 = create_connection(f"{url}?token=token-a")
+        a2 = create_connection(url, header=["Authorization: Bearer token-a"])
+        b = create_connection(f"{url}?token=token-b")
+        with self.assertRaises(WebSocketBadStatusException) as e:
+            create_connection(f"{url}?token=invalid")
+        self.assertEqual(e.exception.status_code, 401)
+
+        def _get_types(connection) -> list:
+            # Read messages up to and including the next announcement
+            connection.settimeout(5)
+            types = list()
+            while "test.announce" not in types:
+                message = json.loads(connection.recv())
+                if message["type"] != "connected":
+                    types.append(message["type"])
+            return types
+
+        # Messages stay in the sender's namespace unless bridged; each
+        # message is sent once the previous one has been routed
+        for sender, msg_type in ((a1, "test.private"), (b, "test.to_a"),
+                                 (default, "test.default")):
+            sender.send(Message(msg_type).serialize())
+            sender.settimeout(5)
+            _receive_type(sender, msg_type)
+        default.send(Message("test.announce").serialize())
+        self.assertEqual(_get_types(a1), ["test.to_a", "test.announce"])
+        self.assertEqual(_get_types(a2), ["test.private", "test.to_a",
+                                          "test.announce"])
+        self.assertEqual(_get_types(b), ["test.announce"])
+        self.assertEqual(_get_types(default), ["test.announce"])
+
+        metrics = service.get_metrics()
+        self.assertEqual(metrics["namespaces"],
+                         {"connections": {"a": 2, "b": 1}, "rejected": 1})
+        self.assertEqual(metrics["connections"], 5)
+
+        a1.close()
+        a2.close()
+        sleep(0.5)
+        self.assertEqual(service.get_metrics()["namespaces"]["connections"],
+                         {"b": 1})
+        for connection in (default, b):
+            connection.close()
+        service.shutdown()
+
+    def test_namespaces_require_token(self):
+        from neon_messagebus.util.mq_connector import create_mq_connector
+        config = {"websocket": {"host": "0.0.0.0", "port": 8208,
+                                "route": "/core",
+                                "namespaces": {"require_token": True}},
+                  "MQ": {"server": "localhost",
+                         "users": {"neon_chat_api": {"user": "test",
+                                                     "password": "test"}},
+                         "supervisor": {"min_delay": 60}}}
+        service = NeonBusService(config=config, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        with self.assertRaises(WebSocketBadStatusException) as e:
+            create_connection("ws://127.0.0.1:8208/core")
+        self.assertEqual(e.exception.status_code, 401)
+        # The service's own clients connect with the internal token
+        self.assertTrue(service._bus.connected_event.wait(10))
+        connector = create_mq_connector(
+            config, **service._mq_supervisor._create_connector.keywords)
+        try:
+            self.assertTrue(connector.bus.connected_event.wait(10))
+        finally:
+            connector.bus.close()
+        service.shutdown()
+
+    def test_message_validation(self):
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8204, "route": "/core",
+            "validate": "envelope"}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        sender = _get_client(8204)
+        receiver = _get_client(8204)
+        for invalid in ("not json", '{"data": {}}',
+                        '{"type": "test.invalid", "context": []}'):
+            sender.send(invalid)
+        sender.send(Message("test.valid").serialize())
+
+        errors = list()
+        while len(errors) < 3:
+            message = json.loads(sender.recv())
+            if message["type"] == "neon.messagebus.rejected":
+                self.assertEqual(message["data"]["reason"], "invalid")
+                errors.append(message["data"]["error"])
+        self.assertEqual(errors[2], "context is not an object")
+        types = [json.loads(receiver.recv())["type"]]
+        while types[-1] != "test.valid":
+            types.append(json.loads(receiver.recv())["type"])
+        self.assertEqual(types, ["test.valid"])
+        self.assertEqual(service.get_metrics()["validation"],
+                         {"mode": "envelope", "rejected": 3})
+        sender.close()
+        receiver.close()
+        service.shutdown()
+
+    def test_tracing(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from neon_messagebus.util.tracing import parse_traceparent, \
+            start_trace
+        trace_dir = mkdtemp()
+        self.addCleanup(rmtree, trace_dir)
+        path = os.path.join(trace_dir, "traces.jsonl")
+        service = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8196, "route": "/core",
+            "tracing": {"path": path}}}, daemonic=True)
+        service.start()
+        self.assertTrue(service.started.wait(15))
+        client = _get_client(8196, "/core?client_id=tracer")
+        request = Message("neon.check_for_signal",
+                          {"signal_name": "traced"}, start_trace())
+        trace_id, parent_id = parse_traceparent(
+            request.context["traceparent"])
+        client.send(request.serialize())
+        client.send(Message("test.untraced").serialize())
+        routed = None
+        while True:
+            message = Message.deserialize(client.recv())
+            if message.msg_type == "neon.check_for_signal":
+                routed = message
+            if message.msg_type == "neon.check_for_signal.traced":
+                break
+        # Routed messages point at the bus span of the message
+        message_span = parse_traceparent(routed.context["traceparent"])[1]
+        self.assertNotEqual(message_span, parent_id)
+        self.assertEqual(parse_traceparent(
+            message.context["traceparent"])[0], trace_id)
+        sleep(0.5)
+        service.shutdown()
+
+        with open(path) as f:
+            spans = [span for line in f for resource in
+                     json.loads(line)["resourceSpans"]
+                     for scope in resource["scopeSpans"]
+                     for span in scope["spans"]]
+        self.assertTrue(all(s["traceId"] == trace_id for s in spans))
+        request_span = [s for s in spans if s["spanId"] == message_span][0]
+        self.assertEqual(request_span["name"], "neon.check_for_signal")
+        self.assertEqual(request_span["parentSpanId"], parent_id)
+        children = [s["name"] for s in spans
+                    if s["parentSpanId"] == message_span]
+        self.assertIn("receive", children)
+        self.assertIn("route", children)
+        self.assertIn("write", children)
+        # The reply is a child of the request
+        self.assertIn("neon.check_for_signal.traced", children)
+        self.assertFalse([s for s in spans if s["name"] == "test.untraced"])
+
+    def test_federation(self):
+        federation = {"batch_interval": 0.01, "min_delay": 0.1,
+                      "max_delay": 0.5, "token": "secret"}
+        node_a = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8186, "route": "/core",
+            "federation": {**federation, "node_id": "node_a",
+                           "subscribe": ["federated.a.*"]}}}, daemonic=True)
+        node_b = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8187, "route": "/core",
+            "federation": {**federation, "node_id": "node_b",
+                           "subscribe": ["federated.b.*"],
+                           "peers": ["ws://127.0.0.1:8186/federation"]}}},
+            daemonic=True)
+        for node in (node_a, node_b):
+            node.start()
+            self.assertTrue(node.started.wait(15))
+
+        timeout = time() + 10
+        while not node_a.get_metrics()["federation"]["links"] and \
+                time() < timeout:
+            sleep(0.1)
+        self.assertIn("node_b", node_a.get_metrics()["federation"]["links"])
+        client_a = _get_client(8186)
+        client_b = _get_client(8187)
+
+        # Only subscribed types are forwarded
+        client_a.send(Message("federated.a.local").serialize())
+        client_a.send(Message("federated.b.test", {"n": 1}).serialize())
+        message = _receive_type(client_b, "federated.b.test")
+        self.assertEqual(message["data"], {"n": 1})
+        self.assertEqual(message["context"]["federation_path"], ["node_a"])
+        client_b.send(Message("federated.a.test").serialize())
+        message = _receive_type(client_a, "federated.a.test")
+        self.assertEqual(message["context"]["federation_path"], ["node_b"])
+
+        # Messages are not sent back to where they came from
+        client_a.send(Message("federated.b.test", {"n": 2}).serialize())
+        client_a.send(Message("federated.a.marker").serialize())
+        seen = list()
+        while True:
+            message = json.loads(client_a.recv())
+            seen.append(message["type"])
+            if message["type"] == "federated.a.marker":
+                break
+        self.assertEqual(seen.count("federated.b.test"), 1)
+
+        # Subscriptions may be changed at runtime
+        client_b.send(Message("neon.federation.subscribe",
+                              {"types": ["dynamic.*"]}).serialize())
+        sleep(0.5)
+        client_a.send(Message("dynamic.test").serialize())
+        self.assertEqual(_receive_type(client_b, "dynamic.test")["type"],
+                         "dynamic.test")
+
+        metrics = node_b.get_metrics()["federation"]
+        self.assertEqual(metrics["node_id"], "node_b")
+        self.assertEqual(metrics["subscriptions"],
+                         ["federated.b.*", "dynamic.*"])
+        self.assertEqual(metrics["links"]["node_a"]["received"], 3)
+        self.assertEqual(metrics["links"]["node_a"]["sent"], 1)
+        self.assertNotIn("node_b", metrics["links"])
+
+        # Peers need the shared token
+        with patch("neon_messagebus.service.federation.LOG"):
+            intruder = NeonBusService(config={"websocket": {
+                "host": "0.0.0.0", "port": 8188, "route": "/core",
+                "federation": {**federation, "node_id": "intruder",
+                               "token": "wrong",
+                               "peers": ["ws://127.0.0.1:8186/federation"]
+                               }}}, daemonic=True)
+            intruder.start()
+            self.assertTrue(intruder.started.wait(15))
+            sleep(1)
+            self.assertNotIn("intruder",
+                             node_a.get_metrics()["federation"]["links"])
+            intruder.shutdown()
+
+        for client in (client_a, client_b):
+            client.close()
+        node_b.shutdown()
+        node_a.shutdown()
+
+    def test_federation_namespaces(self):
+        federation = {"batch_interval": 0.01, "min_delay": 0.1,
+                      "max_delay": 0.5, "token": "secret",
+                      "subscribe": ["federated.*"]}
+        namespaces = {"tokens": {"token-a": "a"},
+                      "bridge": {"federated.bridged": ["a"]}}
+        node_a = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8206, "route": "/core",
+            "namespaces": namespaces,
+            "federation": {**federation, "node_id": "node_a"}}},
+            daemonic=True)
+        node_b = NeonBusService(config={"websocket": {
+            "host": "0.0.0.0", "port": 8207, "route": "/core",
+            "namespaces": namespaces,
+            "federation": {**federation, "node_id": "node_b",
+                           "peers": ["ws://127.0.0.1:8206/federation"]}}},
+            daemonic=True)
+        for node in (node_a, node_b):
+            node.start()
+            self.assertTrue(node.started.wait(15))
+        timeout = time() + 10
+        while not node_a.get_metrics()["federation"]["links"] and \
+                time() < timeout:
+            sleep(0.1)
+        sender = _get_client(8206)
+        receiver = _get_client(8207)
+        tenant = _get_client(8207, "/core?token=token-a")
+
+        # Federated messages are routed in the default namespace
+        sender.send(Message("federated.private").serialize())
+        sender.send(Message("federated.bridged").serialize())
+        self.assertEqual(_receive_type(receiver, "federated.private")
+                         ["context"]["federation_path"], ["node_a"])
+        _receive_type(receiver, "federated.bridged")
+        tenant.settimeout(5)
+        self.assertEqual(json.loads(tenant.recv())["type"],
+                         "federated.bridged")
+        self.assertEqual(node_b.get_metrics()["federation"]["links"]
+                         ["node_a"]["received"], 2)
+
+        for client in (sender, receiver, tenant):
+            client.close()
+        node_b.shutdown()
+        node_a.shutdown()
+
     def test_service_shutdown(self):
         service = NeonBusService(daemonic=False)
         service.start()
@@ -128,6 +796,654 @@ class TestMessagebusService(unittest.TestCase):
         service.join()
 
 
+class TestSendQueue(unittest.TestCase):
+    def test_coalesce_rules(self):
+        from neon_messagebus.service.send_queue import CoalesceRules
+        rules = CoalesceRules({"test.state": ["name"],
+                               "neon.check_for_signal.*": []})
+        self.assertTrue(rules)
+        self.assertFalse(CoalesceRules())
+        self.assertEqual(rules.get_key({"type": "test.state",
+                                        "data": {"name": "volume"}}),
+                         ("test.state", "volume"))
+        self.assertEqual(rules.get_key({"type": "neon.check_for_signal.test",
+                                        "data": {"is_set": True}}),
+                         ("neon.check_for_signal.test",))
+        self.assertIsNone(rules.get_key({"type": "neon.check_for_signal",
+                                         "data": {}}))
+        self.assertIsNone(rules.get_key({"type": "test", "data": {}}))
+        self.assertIsNone(rules.get_key({"data": {}}))
+
+    def test_client_send_queue(self):
+        from neon_messagebus.service.send_queue import ClientSendQueue
+        queue = ClientSendQueue()
+        self.assertIsNone(queue.put("first"))
+        self.assertIsNone(queue.put("volume_1", ("volume",)))
+        queue.put("second")
+        self.assertEqual(queue.put("volume_2", ("volume",)), "volume_1")
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.coalesced, 1)
+        self.assertEqual(queue.pop(), "first")
+        self.assertEqual(queue.pop(), "volume_2")
+        queue.put("volume_3", ("volume",))
+        self.assertEqual(queue.pop(), "second")
+        self.assertEqual(queue.pop(), "volume_3")
+        self.assertEqual(len(queue), 0)
+        queue.put("volume_4", ("volume",))
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+
+    def test_priority_rules(self):
+        from neon_messagebus.service.send_queue import PriorityRules, \
+            PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+        rules = PriorityRules()
+        self.assertEqual(rules.get_priority("mycroft.stop"), PRIORITY_HIGH)
+        self.assertEqual(rules.get_priority("skill.abort"), PRIORITY_HIGH)
+        self.assertEqual(rules.get_priority("mycroft.binary.file"),
+                         PRIORITY_LOW)
+        self.assertEqual(rules.get_priority("test"), PRIORITY_NORMAL)
+        self.assertEqual(rules.get_priority(None), PRIORITY_NORMAL)
+        self.assertEqual(rules.get_priority("gui.value.set"),
+                         rules.get_priority("gui.page.show"))
+        rules = PriorityRules({"high": ["test"]})
+        self.assertEqual(rules.get_priority("test"), PRIORITY_HIGH)
+        self.assertEqual(rules.get_priority("mycroft.stop"), PRIORITY_NORMAL)
+        self.assertFalse(PriorityRules({}))
+
+    def test_client_send_queue_priority(self):
+        from neon_messagebus.service.send_queue import ClientSendQueue, \
+            PRIORITY_HIGH, PRIORITY_LOW
+        queue = ClientSendQueue()
+        queue.put("bulk", priority=PRIORITY_LOW)
+        queue.put("normal")
+        queue.put("stop", priority=PRIORITY_HIGH)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual(queue.peek(), "stop")
+        self.assertEqual(queue.pop(), "stop")
+        self.assertEqual(queue.pop(), "normal")
+        self.assertEqual(queue.pop(), "bulk")
+        with self.assertRaises(IndexError):
+            queue.pop()
+        with self.assertRaises(IndexError):
+            queue.peek()
+
+    def test_handler_send_coalesced(self):
+        from neon_messagebus.service.event_handler import NeonBusEventHandler
+        handler = Mock()
+        NeonBusEventHandler.initialize(handler)
+        self.assertIsNone(handler._send_queue)
+        handler._writing = True
+        with patch("neon_messagebus.service.event_handler.IOLoop") as loop:
+            NeonBusEventHandler.send(handler, "state_1", ("state",))
+            NeonBusEventHandler.send(handler, "state_2", ("state",))
+            loop.current().add_callback.assert_called_once()
+        handler.write_message.assert_not_called()
+        self.assertEqual(len(handler._send_queue), 1)
+        self.assertEqual(handler._send_queue.pop(), "state_2")
+
+        handler = Mock()
+        NeonBusEventHandler.initialize(handler)
+        handler._writing = False
+        NeonBusEventHandler.send(handler, "first")
+        handler.write_message.assert_called_once_with("first")
+        self.assertIsNone(handler._send_queue)
+        self.assertIsNone(handler._write_future)
+
+    def test_handler_on_message(self):
+        from neon_messagebus.service.event_handler import BusContext, \
+            NeonBusEventHandler
+        scheduler = Mock()
+        handler = NeonBusEventHandler.__new__(NeonBusEventHandler)
+        handler.initialize(BusContext(scheduler, []))
+        message = Message("test.local", {"value": 1}).serialize()
+        # Nothing registered; the message is only scheduled
+        handler.on_message(message)
+        self.assertIsNone(handler._emitter)
+        scheduler.submit.assert_called_once_with(None, message)
+
+        # Unfiltered messages are emitted by their serialized string
+        called = Mock()
+        handler.on(message, called)
+        handler.on_message(message)
+        called.assert_called_once_with()
+
+        # Filtered messages are logged and emitted by type
+        scheduler.reset_mock()
+        handler.initialize(BusContext(scheduler, [], filter=True))
+        received = list()
+        handler.on("test.local", received.append)
+        with patch("neon_messagebus.service.event_handler.LOG") as log:
+            handler.on_message(message)
+            log.debug.assert_called_once()
+            handler.on_message(Message("gui.page.upload").serialize())
+            log.debug.assert_called_once()
+            handler.on_message("not json")
+        self.assertEqual(received[0].data, {"value": 1})
+        self.assertEqual(scheduler.submit.call_count, 2)
+
+
+class TestScheduler(unittest.TestCase):
+    def test_token_bucket(self):
+        from time import monotonic
+        from neon_messagebus.service.scheduler import TokenBucket
+        bucket = TokenBucket(10, 2)
+        now = monotonic()
+        self.assertEqual(bucket.consume(now), 0)
+        self.assertEqual(bucket.consume(now), 0)
+        self.assertAlmostEqual(bucket.consume(now), 0.1, 3)
+        self.assertEqual(bucket.consume(now + 0.11), 0)
+
+    def test_rate_limits(self):
+        from neon_messagebus.service.scheduler import RateLimits, TokenBucket
+        limits = RateLimits({"default": {"rate": 10},
+                             "clients": {"trusted": {"rate": 0}},
+                             "message_types": {"recognizer_loop:utterance":
+                                               {"rate": 0},
+                                               "gui.page.upload":
+                                               {"rate": 1, "burst": 5}}})
+        self.assertIsInstance(limits.get_client_bucket("skills"), TokenBucket)
+        self.assertIsNone(limits.get_client_bucket("trusted"))
+        self.assertIsNone(limits.get_type_bucket("recognizer_loop:utterance"))
+        self.assertEqual(limits.get_type_bucket("gui.page.upload").burst, 5)
+        self.assertIsNone(RateLimits().get_client_bucket("skills"))
+
+    @patch("neon_messagebus.service.scheduler.IOLoop")
+    def test_fair_scheduler(self, _):
+        from neon_messagebus.service.scheduler import FairScheduler, \
+            RateLimits
+        routed = list()
+        scheduler = FairScheduler(lambda h, m, p: routed.append(m),
+                                  RateLimits({"message_types": {
+                                      "limited": {"rate": 1}}}),
+                                  quantum=20, batch=4, max_pending=4)
+        flood = scheduler.register("flood", "flood")
+        quiet = scheduler.register("quiet", "quiet")
+        waiter = None
+        for i in range(8):
+            waiter = scheduler.submit(flood, f'{{"type": "flood{i}"}}')
+        self.assertIsNotNone(waiter)
+        self.assertEqual(len(routed), 4)
+        self.assertIsNone(scheduler.submit(quiet, '{"type": "quiet"}'))
+        scheduler._reset_tick()
+        scheduler._run()
+        self.assertEqual(routed[4:6], ['{"type": "flood4"}',
+                                       '{"type": "quiet"}'])
+        self.assertTrue(waiter.done())
+        scheduler._run()
+        self.assertEqual(len(routed), 9)
+
+        scheduler._reset_tick()
+        self.assertIsNone(scheduler.submit(quiet, '{"type": "limited"}'))
+        scheduler.submit(quiet, '{"type": "limited"}')
+        self.assertEqual(len(routed), 10)
+        self.assertTrue(quiet.parked)
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics["throttled"], 1)
+        self.assertEqual(metrics["clients"]["quiet"]["queued"], 1)
+        self.assertEqual(metrics["clients"]["flood"]["received"], 8)
+
+
+    @patch("neon_messagebus.service.scheduler.IOLoop")
+    def test_scheduler_priority(self, _):
+        from neon_messagebus.service.scheduler import FairScheduler, \
+            RateLimits
+        from neon_messagebus.service.send_queue import PriorityRules, \
+            PRIORITY_HIGH, PRIORITY_NORMAL
+        routed = list()
+        scheduler = FairScheduler(lambda h, m, p: routed.append((m, p)),
+                                  batch=1)
+        bulk = scheduler.register("bulk", "bulk")
+        speech = scheduler.register("speech", "speech")
+        binary = '{"type": "mycroft.binary.data"}'
+        normal = '{"type": "test"}'
+        stop = '{"type": "mycroft.stop"}'
+        scheduler.submit(bulk, binary)
+        scheduler.submit(bulk, binary)
+        scheduler.submit(speech, normal)
+        scheduler.submit(speech, stop)
+        self.assertEqual(routed, [(binary, 2), (stop, PRIORITY_HIGH)])
+        scheduler._run()
+        self.assertEqual(routed[2], (normal, 1))
+        scheduler._run()
+        self.assertEqual(routed[3], (binary, 2))
+
+        # High priority messages are still rate limited
+        scheduler = FairScheduler(lambda h, m, p: routed.append((m, p)),
+                                  RateLimits({"message_types": {
+                                      "mycroft.stop": {"rate": 1}}}))
+        speech = scheduler.register("speech", "speech")
+        routed.clear()
+        scheduler.submit(speech, stop)
+        scheduler.submit(speech, stop)
+        self.assertEqual(routed, [(stop, PRIORITY_HIGH)])
+        self.assertTrue(speech.parked)
+        metrics = scheduler.get_metrics()
+        self.assertEqual(metrics["throttled"], 1)
+        self.assertEqual(metrics["clients"]["speech"]["queued"], 1)
+        # Refill the bucket as if the wait had passed
+        speech.type_buckets["mycroft.stop"]._last -= 1
+        scheduler._unpark(speech)
+        scheduler._run()
+        self.assertEqual(routed[1], (stop, PRIORITY_HIGH))
+
+        # Empty rules disable priorities instead of selecting the defaults
+        scheduler = FairScheduler(Mock(), priority_rules=PriorityRules({}))
+        self.assertEqual(scheduler.priority_rules.get_priority("mycroft.stop"),
+                         PRIORITY_NORMAL)
+
+    def test_get_message_type(self):
+        from neon_messagebus.util.envelope import get_message_type
+        message = Message("test.message", {"type": "data"})
+        self.assertEqual(get_message_type(message.serialize()),
+                         "test.message")
+        self.assertEqual(get_message_type('{"type":"compact"}'), "compact")
+        self.assertEqual(get_message_type('{"data": {}, "type": "test"}'),
+                         "test")
+        self.assertEqual(get_message_type('{"type": "escaped\\"quote"}'),
+                         'escaped"quote')
+        self.assertEqual(get_message_type(b'{"type": "test"}'), "test")
+        self.assertIsNone(get_message_type("not json"))
+        self.assertIsNone(get_message_type('["type"]'))
+
+
+class TestFederationLink(unittest.TestCase):
+    def test_link_batching(self):
+        import asyncio
+        from neon_messagebus.service.event_handler import BusContext, \
+            NeonBusEventHandler
+        from neon_messagebus.service.federation import Federation, \
+            FederationLink
+        from neon_messagebus.service.scheduler import FairScheduler, \
+            RateLimits
+        from neon_messagebus.service.validation import MessageValidator
+
+        frames = list()
+        local = Mock()
+        scheduler = FairScheduler(NeonBusEventHandler.route, RateLimits(
+            {"clients": {"federation:peer": {"rate": 1, "burst": 2}}}))
+        context = BusContext(scheduler, [local], max_message_size=1024,
+                             validator=MessageValidator("strict"))
+        federation = Federation(context, node_id="local", batch_size=3,
+                                batch_interval=0.05, subscribe=["remote.*"],
+                                token="secret")
+        with self.assertRaises(ValueError):
+            Federation(context, node_id="local")
+
+        async def _test():
+            link = FederationLink(federation, frames.append, Mock())
+            link.write_hello()
+            self.assertEqual(json.loads(frames.pop()),
+                             {"federation": "hello", "node_id": "local",
+                              "token": "secret", "subscribe": ["remote.*"]})
+            # Nothing is sent before the peer subscribes
+            link.send(Message("test.one").serialize())
+            self.assertEqual(link.get_metrics()["pending"], 0)
+            # Peers must present the token
+            for token in (None, "wrong", 1):
+                closed = Mock()
+                intruder = FederationLink(federation, frames.append, closed)
+                intruder.on_frame(json.dumps({"federation": "hello",
+                                              "node_id": "intruder",
+                                              "token": token}))
+                closed.assert_called_once()
+                self.assertNotIn(intruder, context.connections)
+            link.on_frame(json.dumps({"federation": "hello",
+                                      "node_id": "peer", "token": "secret",
+                                      "subscribe": ["test.*"]}))
+            self.assertIn(link, context.connections)
+            for i in range(4):
+                link.send(Message("test.batch", {"i": i}).serialize())
+            link.send(Message("other").serialize())
+            self.assertEqual([m["data"]["i"] for m in
+                              json.loads(frames.pop())], [0, 1, 2])
+            await asyncio.sleep(0.1)
+            self.assertEqual([m["data"]["i"] for m in
+                              json.loads(frames.pop())], [3])
+            # Forwarded messages aren't returned or relayed
+            link.send(Message("test.looped", {},
+                              {"federation_path": ["peer"]}).serialize())
+            link.send(Message("test.relayed", {},
+                              {"federation_path": ["other"]}).serialize())
+            link.flush()
+            self.assertEqual(frames, [])
+
+            # Received messages are routed locally with their path
+            link.on_frame(json.dumps([Message("remote.test").as_dict,
+                                      Message("unsubscribed").as_dict]))
+            local.send.assert_called_once()
+            routed = json.loads(local.send.call_args[0][0])
+            self.assertEqual(routed["type"], "remote.test")
+            self.assertEqual(routed["context"]["federation_path"], ["peer"])
+
+            # Oversize and invalid messages are dropped; the rest are rate
+            # limited like a local client's
+            local.send.reset_mock()
+            link.on_frame(json.dumps([
+                Message("remote.large", {"a": "a" * 1024}).as_dict,
+                {"type": "remote.invalid", "data": []},
+                {"type": "remote.invalid", "context": ["peer"]},
+                Message("remote.limited").as_dict]))
+            local.send.assert_called_once()
+            self.assertEqual(json.loads(local.send.call_args[0][0])["type"],
+                             "remote.limited")
+            link.on_frame(json.dumps([Message("remote.limited").as_dict]))
+            local.send.assert_called_once()
+            self.assertEqual(scheduler.get_metrics()["throttled"], 1)
+            link.close()
+            self.assertNotIn(link, context.connections)
+            self.assertNotIn("federation:peer",
+                             scheduler.get_metrics()["clients"])
+            self.assertEqual(link.get_metrics(),
+                             {"sent": 4, "received": 3, "frames": 2,
+                              "dropped": 0, "rejected": 3, "pending": 0})
+
+        asyncio.run(_test())
+
+
+class TestTracer(unittest.TestCase):
+    def test_pending_spans(self):
+        from neon_messagebus.service.tracing import Tracer
+        from neon_messagebus.util.tracing import start_trace
+        tracer = Tracer(path=os.devnull, flush_interval=60)
+        sender = Mock(identity="sender")
+        client = Mock(identity="client")
+        context = start_trace()
+        first = Message("test.first", {}, context).serialize()
+        second = Message("test.second", {}, context).serialize()
+
+        # Messages are matched by traceparent, not by object
+        tracer.receive(first)
+        tracer.receive(second)
+        self.assertIsNone(tracer.start_route(Message("test").serialize(),
+                                             sender))
+        traces = [tracer.start_route("".join(list(message)), sender)
+                  for message in (first, second)]
+        self.assertNotEqual(traces[0].span_id, traces[1].span_id)
+        self.assertLessEqual(traces[0].received, traces[1].received)
+        self.assertEqual(tracer._received, {})
+        tracer.receive(first)
+        tracer.discard(first)
+        self.assertIsNone(tracer.start_route(first, sender))
+
+        # Writes are matched by client and span
+        tracer.queue_write(traces[0], client)
+        tracer.queue_write(traces[1], client)
+        tracer.written(client, "".join(list(traces[0].message)))
+        self.assertEqual(tracer._spans[-1]["name"], "write")
+        self.assertEqual(tracer._spans[-1]["parentSpanId"],
+                         traces[0].span_id)
+        tracer.written(client, traces[0].message)
+        tracer.dropped(client, traces[1].message)
+        self.assertEqual(tracer._writes, {})
+        tracer.queue_write(traces[1], client)
+        tracer.queue_write(traces[1], sender)
+        tracer.remove_client(client)
+        self.assertEqual(list(tracer._writes), [(id(sender),
+                                                 traces[1].span_id)])
+
+    def test_nested_traceparent(self):
+        from neon_messagebus.service.tracing import Tracer
+        from neon_messagebus.util.tracing import parse_traceparent, \
+            start_trace
+        tracer = Tracer(path=os.devnull, flush_interval=60)
+        sender = Mock(identity="sender")
+        nested = start_trace()
+        context = start_trace()
+        message = Message("test", {"traceparent": nested["traceparent"],
+                                   "context": nested}, context).serialize()
+        tracer.receive(message)
+        trace = tracer.start_route(message, sender)
+        # Only the context traceparent is read and rewritten
+        self.assertEqual((trace.trace_id, trace.parent_id),
+                         parse_traceparent(context["traceparent"]))
+        routed = Message.deserialize(trace.message)
+        self.assertEqual(routed.data, {"traceparent": nested["traceparent"],
+                                       "context": nested})
+        self.assertEqual(parse_traceparent(routed.context["traceparent"]),
+                         (trace.trace_id, trace.span_id))
+
+        # A traceparent in data alone doesn't trace a message
+        untraced = Message("test", {"traceparent": nested["traceparent"]})
+        tracer.receive(untraced.serialize())
+        self.assertEqual(tracer._received, {})
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def test_flight_recorder(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from neon_messagebus.service.flight_recorder import FlightRecorder
+        dump_dir = mkdtemp()
+        self.addCleanup(rmtree, dump_dir)
+        sender = Mock(identity="test_client")
+        recorder = FlightRecorder(4, record_bytes=100, dump_dir=dump_dir)
+        self.assertEqual(recorder.get_entries(), [])
+        small = Message("test.small").serialize()
+        large = Message("test.large", {"data": "a" * 100}).serialize()
+        recorder.record(small, sender, 2, 3)
+        entries = recorder.get_entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["type"], "test.small")
+        self.assertEqual(entries[0]["message"], small)
+        self.assertEqual(entries[0]["sender"], "test_client")
+        self.assertEqual(entries[0]["priority"], 2)
+        self.assertEqual(entries[0]["fanout"], 3)
+
+        # Only the newest messages are kept; large messages by type only
+        for i in range(5):
+            recorder.record(Message(f"test.{i}").serialize(), sender, 1, 1)
+        recorder.record(large, sender, 1, 1)
+        entries = recorder.get_entries()
+        self.assertEqual([e["type"] for e in entries],
+                         ["test.2", "test.3", "test.4", "test.large"])
+        self.assertIsNone(entries[-1]["message"])
+        self.assertEqual(entries[-1]["size"], len(large))
+        self.assertEqual(recorder.get_metrics(), {"size": 4, "recorded": 7})
+
+        path = recorder.dump("test")
+        self.assertTrue(path.startswith(dump_dir))
+        with open(path) as f:
+            dump = json.load(f)
+        self.assertEqual(dump["reason"], "test")
+        self.assertEqual(dump["recorded"], 7)
+        self.assertEqual(dump["messages"], entries)
+
+
+class TestRouter(unittest.TestCase):
+    def test_get_router(self):
+        from neon_messagebus.service.router import BatchedRouter, \
+            BroadcastRouter, Router, get_router
+        with self.assertRaises(TypeError):
+            Router()
+        self.assertIsInstance(get_router(), BroadcastRouter)
+        self.assertIsInstance(get_router("batched"), BatchedRouter)
+        with self.assertRaises(ValueError):
+            get_router("invalid")
+
+    def test_encode_frame(self):
+        from neon_messagebus.service.router import encode_frame
+        for size in (10, 125, 126, 65535, 65536):
+            frame = encode_frame(b"a" * size)
+            self.assertEqual(frame[0], 0x81)
+            if size < 126:
+                self.assertEqual(frame[1], size)
+                self.assertEqual(len(frame), size + 2)
+            elif size <= 65535:
+                self.assertEqual(frame[1], 126)
+                self.assertEqual(int.from_bytes(frame[2:4], "big"), size)
+            else:
+                self.assertEqual(frame[1], 127)
+                self.assertEqual(int.from_bytes(frame[2:10], "big"), size)
+
+    def test_broadcast_router(self):
+        from neon_messagebus.service.router import BroadcastRouter
+        clients = [Mock(), Mock()]
+        BroadcastRouter().route("message", clients, "key", 2)
+        for client in clients:
+            client.send.assert_called_once_with("message", "key", 2)
+
+    def test_batched_router_fallback(self):
+        from neon_messagebus.service.event_handler import NeonBusEventHandler
+        from neon_messagebus.service.router import BatchedRouter, \
+            encode_frame
+        idle = Mock(can_write_frames=True)
+        busy = Mock(can_write_frames=False)
+        link = Mock(spec=["send"])
+        connections = [idle, busy, link]
+        router = BatchedRouter()
+        with patch("neon_messagebus.service.router.IOLoop"):
+            router.route("one", connections)
+            router.route("two", connections)
+        router.flush()
+        idle.write_frames.assert_called_once_with(
+            encode_frame(b"one") + encode_frame(b"two"))
+        idle.send.assert_not_called()
+        for client in (busy, link):
+            self.assertEqual(client.send.call_count, 2)
+
+        # Protocols other than the one frames are written for are not used
+        handler = NeonBusEventHandler.__new__(NeonBusEventHandler)
+        handler.initialize()
+        handler.ws_connection = Mock()
+        self.assertFalse(handler.can_write_frames)
+
+
+class TestTrafficProfiler(unittest.TestCase):
+    def test_traffic_profiler(self):
+        from neon_messagebus.service.profiler import TrafficProfiler, \
+            format_report
+        profiler = TrafficProfiler(reply_timeout=1)
+        profiler.add("test.small", 10, "client_a", 2, 100.0)
+        profiler.add("test.large", 1000, "client_b", 2, 100.0)
+        profiler.add("test.small", 10, "client_a", 2, 100.0)
+        # Replies are paired with the oldest request of the longest prefix
+        profiler.add("neon.check_for_signal", 50, "client_a", 1, 100.0)
+        profiler.add("neon.check_for_signal", 50, "client_a", 1, 100.5)
+        profiler.add("neon.check_for_signal.test", 50, "bus", 1, 100.1)
+        profiler.add("neon.check_for_signal.test", 50, "bus", 1, 100.7)
+        # Requests expire after `reply_timeout`
+        profiler.add("test.small.response", 10, "bus", 1, 110.0)
+
+        report = profiler.get_report(2)
+        self.assertEqual(report["messages"], 8)
+        self.assertEqual([t["type"] for t in report["top_count"]],
+                         ["test.small", "neon.check_for_signal"])
+        self.assertEqual(report["top_bytes"][0],
+                         {"type": "test.large", "count": 1, "bytes": 1000,
+                          "fanout_bytes": 2000})
+        self.assertEqual(report["talkers"][0]["client"], "client_b")
+        latency = report["latency"]
+        self.assertEqual(len(latency), 1)
+        self.assertEqual(latency[0]["request"], "neon.check_for_signal")
+        self.assertEqual(latency[0]["replies"], 2)
+        self.assertAlmostEqual(latency[0]["max"], 0.2)
+        self.assertIn("neon.check_for_signal", format_report(report))
+
+        # Sampled counts are scaled
+        sampled = TrafficProfiler(sample_every=2)
+        sender = Mock(identity="client_a")
+        for _ in range(4):
+            sampled.sample(Message("test.sampled").serialize(), sender, 1)
+        self.assertEqual(sampled.get_report()["top_count"][0]["count"], 4)
+
+
+class TestNamespaces(unittest.TestCase):
+    def test_authenticate(self):
+        from neon_messagebus.service.namespaces import Namespaces
+        namespaces = Namespaces({"token": "ns"})
+        self.assertEqual(namespaces.authenticate(None), "")
+        self.assertEqual(namespaces.authenticate("token"), "ns")
+        self.assertIsNone(namespaces.authenticate("invalid"))
+        self.assertEqual(namespaces.rejected, 1)
+
+        namespaces = Namespaces({"token": "ns"}, require_token=True)
+        self.assertIsNone(namespaces.authenticate(None))
+        self.assertEqual(namespaces.authenticate("token"), "ns")
+        self.assertEqual(namespaces.rejected, 1)
+
+    def test_get_targets(self):
+        from neon_messagebus.service.namespaces import Namespaces
+        namespaces = Namespaces(bridge={"test.all": ["*"],
+                                        "test.b.*": ["b", ""]})
+        default = ["default"]
+        namespaces.add("a1", "a")
+        namespaces.add("a2", "a")
+        namespaces.add("b1", "b")
+        self.assertEqual(len(namespaces), 3)
+        self.assertEqual(namespaces.get_all(), ["a1", "a2", "b1"])
+
+        message = Message("test.private").serialize()
+        self.assertEqual(namespaces.get_targets(message, "", default),
+                         (default,))
+        self.assertEqual(namespaces.get_targets(message, "a", default),
+                         (["a1", "a2"],))
+        self.assertEqual(namespaces.get_targets(message, "c", default),
+                         ((),))
+        message = Message("test.all").serialize()
+        self.assertEqual(namespaces.get_targets(message, "a", default),
+                         (default, ["a1", "a2"], ["b1"]))
+        message = Message("test.b.message").serialize()
+        self.assertEqual(namespaces.get_targets(message, "a", default),
+                         (["a1", "a2"], ["b1"], default))
+        self.assertEqual(namespaces.get_targets(message, "b", default),
+                         (["b1"], default))
+
+        namespaces.remove("b1", "b")
+        self.assertEqual(namespaces.get_metrics(),
+                         {"connections": {"a": 2}, "rejected": 0})
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def test_max_connections(self):
+        from neon_messagebus.service.admission import AdmissionControl
+        admission = AdmissionControl(2)
+        self.assertIsNone(admission.admit(0))
+        self.assertIsNone(admission.admit(1))
+        self.assertEqual(admission.admit(2), 1.0)
+        self.assertIsNone(AdmissionControl().admit(10000))
+        self.assertEqual(admission.get_metrics(), {"max_connections": 2,
+                                                   "warming_up": False,
+                                                   "accepted": 2,
+                                                   "rejected": 1})
+
+    def test_handshake_rate(self):
+        from neon_messagebus.service.admission import AdmissionControl
+        admission = AdmissionControl(handshake_rate={"rate": 10, "burst": 2})
+        self.assertIsNone(admission.admit(0))
+        self.assertIsNone(admission.admit(1))
+        retry = admission.admit(2)
+        self.assertGreater(retry, 0)
+        self.assertLessEqual(retry, 0.1)
+        sleep(retry)
+        self.assertIsNone(admission.admit(2))
+
+        # Rejected clients are told to retry at different times
+        admission = AdmissionControl(handshake_rate={"rate": 10, "burst": 1})
+        self.assertIsNone(admission.admit(0))
+        retries = [admission.admit(1) for _ in range(20)]
+        self.assertEqual(retries, sorted(retries))
+        self.assertAlmostEqual(retries[-1] - retries[0], 1.9, 1)
+
+    def test_warmup(self):
+        from time import monotonic
+        from neon_messagebus.service.admission import AdmissionControl
+        admission = AdmissionControl(warmup={"duration": 0.5, "rate": 10,
+                                             "burst": 2})
+        self.assertTrue(admission.warming_up)
+        self.assertIsNone(admission.admit(0))
+        self.assertIsNone(admission.admit(1))
+        self.assertIsNotNone(admission.admit(2))
+        sleep(0.5)
+        self.assertFalse(admission.warming_up)
+        for i in range(100):
+            self.assertIsNone(admission.admit(i))
+
+        # Warm-up is measured from the service start time
+        admission = AdmissionControl(warmup={"duration": 1, "rate": 1},
+                                     start_time=monotonic() - 1)
+        self.assertFalse(admission.warming_up)
+
+
 class TestCLI(unittest.TestCase):
     runner = CliRunner()
 
@@ -139,6 +1455,26 @@ class TestCLI(unittest.TestCase):
         init_config.assert_called_once()
         main.assert_called_once()
 
+    @patch("neon_messagebus.cli.init_config_dir")
+    @patch("neon_messagebus.util.message_utils.get_messagebus")
+    def test_profile(self, get_bus, init_config):
+        from neon_messagebus.cli import profile
+        bus = Mock()
+        bus.wait_for_response.return_value = Message(
+            "neon.messagebus.get_metrics.response",
+            {"connections": 2, "clients": {"client_a": {"received": 1}}})
+        get_bus.return_value = bus
+        result = self.runner.invoke(profile, ["--duration", "0.1",
+                                              "--json", "-"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        init_config.assert_called_once()
+        bus.on.assert_called_once()
+        bus.remove.assert_called_once()
+        report = json.loads(result.output)
+        self.assertEqual(report["talkers"], [{"client": "client_a",
+                                              "count": 0, "bytes": None}])
+        bus.close.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -26,6 +26,7 @@
 # NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE,  EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import json
 import os
 import sys
 import unittest
@@ -65,6 +66,36 @@ class TestMessageUtils(unittest.TestCase):
         self.assertFalse(bus.connected_event.is_set())
         self.assertFalse(bus.started_running)
 
+    def test_reconnect_backoff(self):
+        from websocket import WebSocketBadStatusException
+        from neon_messagebus.util.backoff import get_backoff, get_retry_after
+        from neon_messagebus.util.message_utils import NeonMessageBusClient
+        self.assertEqual(get_retry_after({"Retry-After": "3"}), 3)
+        # Long outages stay capped instead of overflowing
+        self.assertTrue(30 <= get_backoff(10 ** 6, 0.5, 60) <= 60)
+        self.assertEqual(get_retry_after({"retry-after": "soon"}), 0)
+        self.assertEqual(get_retry_after(None), 0)
+
+        bus = NeonMessageBusClient(min_delay=1, max_delay=4)
+        error = WebSocketBadStatusException("busy", 503,
+                                            resp_headers={"retry-after": "2"})
+        delays = list()
+        with mock.patch("neon_messagebus.util.message_utils.sleep") as sleep_:
+            with mock.patch.object(bus, "run_forever") as run_forever:
+                for _ in range(4):
+                    bus.on_error(bus.client, error)
+                    delays.append(sleep_.call_args[0][0])
+                self.assertEqual(run_forever.call_count, 4)
+        # Retry-After plus jittered exponential backoff
+        self.assertTrue(2.5 <= delays[0] <= 3, delays)
+        self.assertTrue(3 <= delays[1] <= 4, delays)
+        self.assertTrue(4 <= delays[3] <= 6, delays)
+
+        # A successful connection resets the backoff
+        with mock.patch.object(bus, "emit"):
+            bus.on_open()
+        self.assertEqual(bus._attempts, 0)
+
     def test_send_message(self):
         from neon_messagebus.util.message_utils import get_messagebus, \
             send_message
@@ -85,6 +116,9 @@ class TestMessageUtils(unittest.TestCase):
         send_message(test_msg)
         received_event.wait()
         self.assertEqual(test_msg.serialize(), received.serialize())
+        # Sent messages start a trace that is kept when resent
+        self.assertIn("traceparent", received.context)
+        traceparent = received.context["traceparent"]
         received_event.clear()
         received = None
 
@@ -97,7 +131,18 @@ class TestMessageUtils(unittest.TestCase):
         send_message(test_msg.msg_type, test_msg.data, test_msg.context)
         received_event.wait()
         self.assertEqual(test_msg.serialize(), received.serialize())
+        self.assertEqual(received.context["traceparent"], traceparent)
         received_event.clear()
+
+        # Strings that are not serialized messages are message types
+        send_message("unit_test_message", bus=client_bus)
+        self.assertTrue(received_event.wait(5))
+        self.assertEqual(received.data, {})
+        with self.assertRaises(ValueError):
+            send_message('{"data": {}}', bus=client_bus)
+        with self.assertRaises(ValueError):
+            send_message('{"type": "unit_test_message", "data": [}',
+                         bus=client_bus)
         client_bus.close()
 
     def test_send_binary_data_message(self):
@@ -128,6 +173,112 @@ class TestMessageUtils(unittest.TestCase):
         self.assertEqual(received.data["binary"], byte_data.hex())
         self.assertEqual(decode_binary_message(received), byte_data)
 
+    def test_send_binary_data_message_shared_memory(self):
+        from neon_messagebus.util.message_utils import get_messagebus, \
+            send_binary_data_message, decode_binary_message, \
+            acknowledge_binary_message
+        from neon_messagebus.util.shared_memory_utils import \
+            SharedMemoryWriter
+        received: Message = None
+        received_event = Event()
+        acked = Event()
+
+        def message_handler(message):
+            nonlocal received
+            received = message
+            received_event.set()
+
+        client_bus = get_messagebus()
+        client_bus.on("unit_test_message", message_handler)
+        writer = SharedMemoryWriter(client_bus, size=4096)
+        client_bus.on("neon.shared_memory.ack", lambda _: acked.set())
+
+        byte_data = os.urandom(1024)
+        send_binary_data_message(byte_data, "unit_test_message",
+                                 bus=client_bus, shared_memory=writer)
+        self.assertTrue(received_event.wait(5))
+        self.assertNotIn("binary", received.data)
+        self.assertEqual(received.data["shm"]["name"], writer.name)
+        view = decode_binary_message(received)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(bytes(view), byte_data)
+        view.release()
+        acknowledge_binary_message(received, client_bus)
+        self.assertTrue(acked.wait(5))
+
+        # Data too large for shared memory is sent in the message
+        received_event.clear()
+        byte_data = os.urandom(8192)
+        send_binary_data_message(byte_data, "unit_test_message",
+                                 bus=client_bus, shared_memory=writer)
+        self.assertTrue(received_event.wait(5))
+        self.assertEqual(received.data["binary"], byte_data.hex())
+        self.assertEqual(decode_binary_message(received), byte_data)
+        acknowledge_binary_message(received, client_bus)
+
+        writer.close()
+        client_bus.close()
+
+    def test_shared_memory_writer(self):
+        from neon_messagebus.util.shared_memory_utils import \
+            SharedMemoryWriter, read_shared_memory
+        bus = FakeBus()
+        writer = SharedMemoryWriter(bus, size=100, subscribers=2)
+
+        def ack(handle):
+            bus.emit(Message("neon.shared_memory.ack",
+                             {"name": handle["name"],
+                              "block": handle["block"]}))
+
+        first = writer.write(b"a" * 40)
+        second = writer.write(b"b" * 40)
+        self.assertEqual(first["offset"], 0)
+        self.assertEqual(second["offset"], 40)
+        self.assertEqual(bytes(read_shared_memory(first)), b"a" * 40)
+        self.assertEqual(bytes(read_shared_memory(second)), b"b" * 40)
+        # Full
+        self.assertIsNone(writer.write(b"c" * 30))
+
+        # Block is reused after all subscribers acknowledge it
+        ack(first)
+        self.assertIsNone(writer.write(b"c" * 30))
+        ack(first)
+        third = writer.write(b"c" * 30)
+        self.assertEqual(third["offset"], 0)
+        self.assertEqual(bytes(read_shared_memory(third)), b"c" * 30)
+        self.assertEqual(bytes(read_shared_memory(second)), b"b" * 40)
+
+        # Wrapped writes don't overwrite unacknowledged blocks
+        self.assertIsNone(writer.write(b"d" * 20))
+        fourth = writer.write(b"d" * 10)
+        self.assertEqual(fourth["offset"], 30)
+
+        # Acknowledgements for other segments are ignored
+        bus.emit(Message("neon.shared_memory.ack",
+                         {"name": "other", "block": second["block"]}))
+        self.assertIsNone(writer.write(b"e" * 20))
+
+        writer.close()
+
+        # Readers detach from the segment of a closed writer once a new
+        # segment is read
+        from neon_messagebus.util.shared_memory_utils import \
+            _attached_segments
+        self.assertIn(first["name"], _attached_segments)
+        new_writer = SharedMemoryWriter(bus, size=100)
+        handle = new_writer.write(b"g" * 10)
+        self.assertEqual(bytes(read_shared_memory(handle)), b"g" * 10)
+        self.assertNotIn(first["name"], _attached_segments)
+        self.assertIn(handle["name"], _attached_segments)
+        new_writer.close()
+
+        # Unacknowledged blocks expire
+        writer = SharedMemoryWriter(bus, size=100, ttl=0)
+        writer.write(b"e" * 60)
+        sleep(0.01)
+        self.assertEqual(writer.write(b"f" * 100)["offset"], 0)
+        writer.close()
+
     def test_send_binary_file_message(self):
         from neon_messagebus.util.message_utils import get_messagebus, \
             send_binary_file_message, decode_binary_message
@@ -156,6 +307,66 @@ class TestMessageUtils(unittest.TestCase):
         self.assertEqual(received.data["binary"], byte_data.hex())
         self.assertEqual(decode_binary_message(received), byte_data)
 
+    def test_stream_binary_file_message(self):
+        from neon_messagebus.util.message_utils import get_messagebus, \
+            stream_binary_file_message, decode_binary_message_into
+        byte_data = os.urandom(300 * 1024)
+        received = bytearray(len(byte_data))
+        chunks = list()
+        progress = list()
+        final = Event()
+
+        def message_handler(message):
+            stream = message.data["stream"]
+            chunks.append(stream["offset"])
+            with memoryview(received) as view:
+                decode_binary_message_into(message, view[stream["offset"]:])
+            if stream["final"]:
+                final.set()
+
+        client_bus = get_messagebus()
+        client_bus.on("unit_test_message", message_handler)
+        test_file = join(dirname(abspath(__file__)), "stream_test_file")
+        with open(test_file, 'wb') as f:
+            f.write(byte_data)
+        try:
+            future = stream_binary_file_message(
+                test_file, "unit_test_message", bus=client_bus,
+                chunk_size=64 * 1024,
+                progress=lambda sent, size: progress.append((sent, size)))
+            self.assertEqual(future.result(30), len(byte_data))
+            self.assertTrue(final.wait(30))
+            self.assertEqual(received, byte_data)
+            self.assertEqual(chunks, list(range(0, len(byte_data),
+                                                64 * 1024)))
+            self.assertEqual(progress[-1], (len(byte_data), len(byte_data)))
+            self.assertEqual(len(progress), len(chunks))
+
+            # Futures are awaitable
+            import asyncio
+
+            async def _send():
+                return await asyncio.wrap_future(stream_binary_file_message(
+                    test_file, "unit_test_message", bus=client_bus))
+            final.clear()
+            self.assertEqual(asyncio.run(_send()), len(byte_data))
+            self.assertTrue(final.wait(30))
+
+            # Empty file
+            final.clear()
+            open(test_file, 'wb').close()
+            future = stream_binary_file_message(test_file,
+                                                "unit_test_message",
+                                                bus=client_bus)
+            self.assertEqual(future.result(30), 0)
+            self.assertTrue(final.wait(30))
+        finally:
+            os.remove(test_file)
+            client_bus.close()
+
+        with self.assertRaises(FileNotFoundError):
+            stream_binary_file_message(test_file)
+
     def test_send_binary_file_method_invalid(self):
         from neon_messagebus.util.message_utils import send_binary_file_message
         test_file = join(dirname(abspath(__file__)), "test_objects")
@@ -180,6 +391,365 @@ class TestMessageUtils(unittest.TestCase):
         self.assertEqual(decode_binary_message(serialized_message), byte_data)
 
 
+    def test_decode_binary_message_modes(self):
+        from neon_messagebus.util.message_utils import \
+            decode_binary_message, decode_binary_message_into
+        byte_data = os.urandom(3 * 1024 * 1024 + 5)
+        message = Message("tester", {"binary": byte_data.hex()})
+
+        decoded = decode_binary_message(message, mutable=False)
+        self.assertIsInstance(decoded, bytes)
+        self.assertEqual(decoded, byte_data)
+        self.assertIsInstance(decode_binary_message(message.data), bytearray)
+
+        buffer = bytearray(len(byte_data) + 10)
+        for msg in (message, message.data, message.serialize(),
+                    byte_data.hex()):
+            buffer[:] = bytes(len(buffer))
+            self.assertEqual(decode_binary_message_into(msg, buffer),
+                             len(byte_data))
+            self.assertEqual(buffer[:len(byte_data)], byte_data)
+        self.assertEqual(bytes(buffer[len(byte_data):]), bytes(10))
+
+        with memoryview(buffer) as view:
+            self.assertEqual(decode_binary_message_into(message, view[5:]),
+                             len(byte_data))
+        self.assertEqual(buffer[5:len(byte_data) + 5], byte_data)
+
+        with self.assertRaises(ValueError):
+            decode_binary_message_into(message, bytearray(10))
+
+        from neon_messagebus.util.shared_memory_utils import \
+            SharedMemoryWriter
+        writer = SharedMemoryWriter(FakeBus(), size=len(byte_data))
+        message = Message("tester", {"shm": writer.write(byte_data)})
+        self.assertEqual(decode_binary_message_into(message, buffer),
+                         len(byte_data))
+        self.assertEqual(buffer[:len(byte_data)], byte_data)
+        writer.close()
+
+
+class TestTracing(unittest.TestCase):
+    def test_traceparent(self):
+        from neon_messagebus.util.tracing import format_traceparent, \
+            get_trace_id, new_span_id, new_trace_id, parse_traceparent, \
+            start_trace
+        trace_id = new_trace_id()
+        span_id = new_span_id()
+        self.assertEqual(len(trace_id), 32)
+        self.assertEqual(len(span_id), 16)
+        traceparent = format_traceparent(trace_id, span_id)
+        self.assertEqual(parse_traceparent(traceparent), (trace_id, span_id))
+        self.assertIsNone(parse_traceparent("01-abc-def-01"))
+        self.assertIsNone(parse_traceparent(None))
+
+        context = start_trace({"session": "test"})
+        self.assertEqual(context["session"], "test")
+        trace_id = get_trace_id(Message("test", context=context))
+        self.assertIsNotNone(trace_id)
+        # An existing trace is kept
+        self.assertEqual(start_trace(context)["traceparent"],
+                         context["traceparent"])
+        self.assertIsNone(get_trace_id(Message("test")))
+
+
+class TestEnvelope(unittest.TestCase):
+    def test_lazy_fields(self):
+        from neon_messagebus.util.envelope import Envelope
+        message = Message("test.envelope", {"key": "value"},
+                          {"session": {"session_id": "test"}})
+        envelope = Envelope(message.serialize())
+        self.assertEqual(envelope.msg_type, "test.envelope")
+        self.assertEqual(envelope.context, message.context)
+        self.assertEqual(envelope.data, message.data)
+        message = envelope.to_message()
+        self.assertIsInstance(message, Message)
+        self.assertEqual(message.data, {"key": "value"})
+
+        # Routing fields are read without decoding `data`
+        envelope = Envelope('{"type": "test", "data": {"invalid": }, '
+                            '"context": {"source": "test"}}')
+        self.assertEqual(envelope.msg_type, "test")
+        self.assertEqual(envelope.context, {"source": "test"})
+        with self.assertRaises(ValueError):
+            envelope.data
+
+        # `data` is decoded without decoding `context`
+        envelope = Envelope('{"type": "test", "data": {"a": 1}, '
+                            '"context": {"invalid": }}')
+        self.assertEqual(envelope.data, {"a": 1})
+        with self.assertRaises(ValueError):
+            envelope.context
+
+    def test_other_layouts(self):
+        from neon_messagebus.util.envelope import Envelope
+        # `context` keys nested in data are not the message context
+        envelope = Envelope('{"type": "test", "context": {"a": 1}, '
+                            '"data": {"context": {"b": 2}}}')
+        self.assertEqual(envelope.context, {"a": 1})
+        self.assertEqual(envelope.data, {"context": {"b": 2}})
+        envelope = Envelope('{"data": {}, "type": "test"}')
+        self.assertEqual(envelope.msg_type, "test")
+        self.assertEqual(envelope.context, {})
+        envelope = Envelope('{"type": "test", "data": null, "context": 1}')
+        self.assertEqual(envelope.data, {})
+        with self.assertRaises(ValueError):
+            envelope.context
+        envelope = Envelope('[1, 2]')
+        self.assertIsNone(envelope.msg_type)
+        with self.assertRaises(ValueError):
+            envelope.data
+        with self.assertRaises(ValueError):
+            envelope.to_message()
+
+    def test_with_context(self):
+        from neon_messagebus.util.envelope import Envelope
+        # `data` is kept as received when `context` is last
+        raw = '{"type": "test", "data": {"context": {"a":  1}}, ' \
+              '"context": {"a": 1}}'
+        replaced = Envelope(raw).with_context({"a": 2})
+        self.assertTrue(replaced.startswith(
+            '{"type": "test", "data": {"context": {"a":  1}}, '))
+        self.assertEqual(Envelope(replaced).context, {"a": 2})
+        replaced = Envelope('{"type": "test", "context": {"a": 1}, '
+                            '"data": {"b": 2}}').with_context({"a": 2})
+        self.assertEqual(json.loads(replaced),
+                         {"type": "test", "context": {"a": 2},
+                          "data": {"b": 2}})
+        with self.assertRaises(ValueError):
+            Envelope("[1, 2]").with_context({})
+
+    def test_validate(self):
+        from neon_messagebus.util.envelope import Envelope
+        valid = Message("test", {"a": 1}, {"b": 2}).serialize()
+        self.assertIsNone(Envelope(valid).validate())
+        self.assertIsNone(Envelope(valid).validate(strict=True))
+        for invalid in ("not json", '{"data": {}}', '{"type": ""}',
+                        '{"type": "test", "context": []}', b'{"type": "t"}'):
+            self.assertIsInstance(Envelope(invalid).validate(), str, invalid)
+            self.assertIsInstance(Envelope(invalid).validate(True), str,
+                                  invalid)
+        # Only strict validation decodes `data`
+        invalid_data = '{"type": "test", "data": {"a": }, "context": {}}'
+        self.assertIsNone(Envelope(invalid_data).validate())
+        self.assertIsInstance(Envelope(invalid_data).validate(True), str)
+
+
+class TestHandlerExecutor(unittest.TestCase):
+    def test_wrap(self):
+        from neon_messagebus.util.executor import HandlerExecutor
+        executor = HandlerExecutor(io_workers=2, cpu_workers=1)
+        release = Event()
+        handled = list()
+
+        def _handler(message):
+            release.wait(5)
+            handled.append(message.msg_type)
+
+        def _failing(message):
+            raise RuntimeError(message.msg_type)
+
+        io_handler = executor.wrap(_handler)
+        cpu_handler = executor.wrap(_handler, cpu=True)
+        for _ in range(3):
+            io_handler(Message("test.io"))
+        cpu_handler(Message("test.cpu"))
+        metrics = executor.get_metrics()
+        self.assertEqual(metrics["io"]["pending"], 3)
+        self.assertEqual(metrics["io"]["workers"], 2)
+        self.assertEqual(metrics["cpu"]["pending"], 1)
+        self.assertEqual(metrics["cpu"]["type"], "thread")
+        release.set()
+        executor.wrap(_failing)(Message("test.fail"))
+        timeout = time() + 5
+        while any(pool["pending"] for pool in
+                  executor.get_metrics().values()) and time() < timeout:
+            sleep(0.05)
+        executor.shutdown(wait=True)
+        self.assertEqual(sorted(handled), ["test.cpu"] + ["test.io"] * 3)
+        metrics = executor.get_metrics()
+        self.assertEqual(metrics["io"], {"type": "thread", "workers": 2,
+                                         "pending": 0, "max_pending": 4,
+                                         "completed": 4, "errors": 1})
+        self.assertEqual(metrics["cpu"]["completed"], 1)
+
+        # Queued calls are cancelled on shutdown
+        executor = HandlerExecutor(io_workers=1)
+        release.clear()
+        running = executor.wrap(_handler)
+        for _ in range(3):
+            running(Message("test.queued"))
+        executor.shutdown()
+        release.set()
+        sleep(0.5)
+        self.assertEqual(handled.count("test.queued"), 1)
+        self.assertEqual(executor.get_metrics()["io"]["pending"], 0)
+
+        with self.assertRaises(ValueError):
+            HandlerExecutor(cpu_pool="invalid")
+
+    def test_process_pool(self):
+        from neon_messagebus.util.executor import HandlerExecutor
+        executor = HandlerExecutor(cpu_workers=2, cpu_pool="process")
+        self.assertEqual(executor.submit_cpu(pow, 2, 10).result(30), 1024)
+        self.assertNotEqual(executor.submit_cpu(os.getpid).result(30),
+                            os.getpid())
+        handled = Event()
+        # Bound handlers run in the I/O pool with a process pool
+        executor.wrap(lambda _: handled.set(), cpu=True)(Message("test"))
+        self.assertTrue(handled.wait(5))
+        executor.shutdown(wait=True)
+        metrics = executor.get_metrics()
+        self.assertEqual(metrics["cpu"]["type"], "process")
+        self.assertEqual(metrics["cpu"]["completed"], 2)
+        self.assertEqual(metrics["io"]["completed"], 1)
+
+
+class TestSharedSignalTable(unittest.TestCase):
+    def test_shared_signal_table(self):
+        from uuid import uuid4
+        from neon_messagebus.util.signal_table import SharedSignalTable, \
+            check_shared_signal
+        name = f"neon_signals_test_{uuid4().hex[:8]}"
+        self.assertIsNone(check_shared_signal("test", name=name))
+        table = SharedSignalTable(name, slots=4, create=True)
+        self.addCleanup(table.close)
+        reader = SharedSignalTable(name)
+        self.assertEqual(reader.slots, 4)
+        self.assertEqual(reader.get("test"), (False, 0.0))
+        self.assertFalse(check_shared_signal("test", name=name))
+
+        now = time()
+        self.assertTrue(table.set("test", True, now))
+        self.assertEqual(reader.get("test"), (True, now))
+        self.assertTrue(check_shared_signal("test", name=name))
+        self.assertTrue(check_shared_signal("test", 60, name=name))
+        # Expired signals are reported cleared; clearing needs the manager
+        table.set("test", True, now - 120)
+        self.assertFalse(check_shared_signal("test", 60, name=name))
+        self.assertIsNone(check_shared_signal("test", 0, name=name))
+        table.set("test", False, now)
+        self.assertFalse(check_shared_signal("test", 0, name=name))
+
+        # Names that don't fit, or don't fit in a full table, use the bus
+        self.assertFalse(table.set("a" * 100, True, now))
+        self.assertIsNone(reader.get("a" * 100))
+        for i in range(3):
+            self.assertTrue(table.set(f"signal_{i}", True, now))
+        self.assertFalse(table.set("overflow", True, now))
+        self.assertIsNone(reader.get("overflow"))
+        self.assertEqual(reader.get("signal_2"), (True, now))
+        reader.close()
+
+        # Readers detach when the writer closes the table
+        table.close()
+        self.assertIsNone(check_shared_signal("test", name=name))
+
+        # Readers of an undersized table see it invalidated when it's replaced
+        table = SharedSignalTable(name, slots=4, create=True)
+        reader = SharedSignalTable(name)
+        self.assertTrue(reader.valid)
+        table = SharedSignalTable(name, slots=8, create=True)
+        self.addCleanup(table.close)
+        self.assertFalse(reader.valid)
+        reader.close()
+        self.assertEqual(SharedSignalTable(name).slots, 8)
+
+    def test_signal_manager_shared_table(self):
+        from uuid import uuid4
+        from neon_messagebus.util.signal_table import SharedSignalTable
+        from neon_messagebus.util.signal_utils import SignalManager
+        bus = FakeBus()
+        bus.connected_event = Event()
+        bus.connected_event.set()
+        table = SharedSignalTable(f"neon_signals_test_{uuid4().hex[:8]}",
+                                  create=True)
+        self.addCleanup(table.close)
+        manager = SignalManager(bus, False, table)
+        manager.create_signal("shared")
+        self.assertTrue(table.get("shared")[0])
+        self.assertTrue(manager.check_for_signal("shared"))
+        self.assertFalse(table.get("shared")[0])
+
+        manager.create_signal("republished")
+        other = SharedSignalTable(f"neon_signals_test_{uuid4().hex[:8]}",
+                                  create=True)
+        self.addCleanup(other.close)
+        manager.set_shared_table(other)
+        self.assertTrue(other.get("republished")[0])
+
+
+class TestSignalSnapshot(unittest.TestCase):
+    def test_snapshot_restore(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from neon_messagebus.util.signal_snapshot import SignalSnapshot
+        snapshot_dir = mkdtemp()
+        self.addCleanup(rmtree, snapshot_dir)
+        path = join(snapshot_dir, "signals.json")
+        now = time()
+        states = {"set": (True, now), "cleared": (False, now - 10)}
+        snapshot = SignalSnapshot(path, interval=60, max_age=60,
+                                  compact_every=2)
+        self.assertEqual(snapshot.restore(), dict())
+        snapshot.start(lambda: states)
+        self.assertTrue(os.path.isfile(path))
+
+        # Changes are appended to the journal until it is compacted
+        states["new"] = (True, now)
+        snapshot.mark("new")
+        snapshot.write()
+        with open(snapshot.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 1)
+        states["old"] = (True, now - 120)
+        snapshot.mark("old")
+        snapshot.write()
+        with open(snapshot.journal_path) as f:
+            self.assertEqual(f.read(), "")
+
+        # Journal entries already in the snapshot and interrupted writes are
+        # ignored; expired signals are restored as cleared
+        states["set"] = (False, now)
+        snapshot.mark("set")
+        snapshot.write()
+        with open(snapshot.journal_path, "a") as f:
+            f.write('[1, {"new": [false, 0]}]\n[9, {"new": [fa')
+        restored = SignalSnapshot(path, max_age=60).restore()
+        self.assertEqual(restored, {"set": (False, now),
+                                    "cleared": (False, now - 10),
+                                    "new": (True, now),
+                                    "old": (False, now - 120)})
+        snapshot.stop()
+
+    def test_signal_manager_restore(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        from neon_messagebus.util.signal_snapshot import SignalSnapshot
+        from neon_messagebus.util.signal_utils import SignalManager
+        snapshot_dir = mkdtemp()
+        self.addCleanup(rmtree, snapshot_dir)
+        path = join(snapshot_dir, "signals.json")
+        bus = FakeBus()
+        bus.connected_event = Event()
+        bus.connected_event.set()
+        manager = SignalManager(bus, False,
+                                snapshot=SignalSnapshot(path, interval=0.1))
+        manager.create_signal("persisted")
+        create_time = manager._signals["persisted"].create_time
+        manager.create_signal("cleared")
+        manager.check_for_signal("cleared")
+        sleep(0.5)
+        # The journal is written without a shutdown
+        restored = SignalManager(bus, False,
+                                 snapshot=SignalSnapshot(path))
+        self.assertTrue(restored.check_for_signal("persisted", -1))
+        self.assertEqual(restored._signals["persisted"].create_time,
+                         create_time)
+        self.assertFalse(restored.check_for_signal("cleared"))
+        restored.shutdown()
+        manager.shutdown()
+
+
 class TestSignalUtils(unittest.TestCase):
     from neon_messagebus.util.signal_utils import SignalManager
     from neon_utils.signal_utils import init_signal_bus
@@ -224,6 +794,27 @@ class TestSignalUtils(unittest.TestCase):
         self.assertFalse(check_for_signal("test_signal", 1))
         self.assertFalse(check_for_signal("test_signal"))
 
+    def test_signal_manager_metrics(self):
+        from neon_utils.signal_utils import check_for_signal
+        handled = self.signal_manager.get_metrics()["handled"]
+        check_for_signal("test_metrics")
+        metrics = self.signal_manager.get_metrics()
+        self.assertEqual(metrics["handled"], handled + 1)
+        self.assertEqual(metrics["active"], 0)
+        self.assertGreaterEqual(metrics["max_active"], 1)
+        self.assertGreater(metrics["busy"], 0)
+
+    def test_signal_reply_trace(self):
+        from neon_messagebus.util.tracing import start_trace
+        replies = list()
+        self.bus.on("neon.check_for_signal.test_traced", replies.append)
+        request = Message("neon.check_for_signal",
+                          {"signal_name": "test_traced"}, start_trace())
+        self.bus.emit(request)
+        self.assertEqual(replies[0].context["traceparent"],
+                         request.context["traceparent"])
+        self.bus.remove("neon.check_for_signal.test_traced", replies.append)
+
     def test_wait_for_signal_create(self):
         from neon_utils.signal_utils import check_for_signal, create_signal, \
             wait_for_signal_create
@@ -254,6 +845,35 @@ class TestSignalUtils(unittest.TestCase):
         self.assertFalse(wait_for_signal_clear("test_signal", 10))
         self.assertFalse(check_for_signal("test_signal"))
 
+    def test_waiters_with_executor(self):
+        from neon_messagebus.util.executor import HandlerExecutor
+        from neon_messagebus.util.signal_utils import SignalManager
+        bus = FakeBus()
+        bus.connected_event = Event()
+        bus.connected_event.set()
+        executor = HandlerExecutor(io_workers=2)
+        SignalManager(bus, False, executor=executor)
+        released = list()
+        all_released = Event()
+
+        def _on_created(message):
+            released.append(message.data["is_set"])
+            if len(released) == 6:
+                all_released.set()
+
+        bus.on("neon.wait_for_signal_create.test_waiters", _on_created)
+        # More waiters than I/O workers do not block the create request
+        for _ in range(6):
+            bus.emit(Message("neon.wait_for_signal_create",
+                             {"signal_name": "test_waiters", "timeout": 30}))
+        sleep(0.5)
+        bus.emit(Message("neon.create_signal",
+                         {"signal_name": "test_waiters"}))
+        self.assertTrue(all_released.wait(5))
+        self.assertTrue(all(released))
+        self.assertEqual(executor.get_metrics()["wait"]["max_pending"], 6)
+        executor.shutdown()
+
     def test_threaded_signal_handling(self):
         from neon_utils.signal_utils import check_for_signal, create_signal
         create_results = []
@@ -285,6 +905,209 @@ class TestSignalUtils(unittest.TestCase):
         self.assertEqual(8, len(create_results), len(check_results))
 
 
+class TestMQBridge(unittest.TestCase):
+    def _get_bridge(self, latency=0.01, **kwargs):
+        from neon_messagebus.util.mq_connector import MQBridge, LocalBroker
+        broker = LocalBroker(latency)
+        bridge = MQBridge(broker, **kwargs)
+        bridge.start()
+        self.addCleanup(bridge.stop, 0)
+        return bridge, broker
+
+    def test_batching(self):
+        bridge, broker = self._get_bridge(batch_size=100,
+                                          batch_interval=0.05)
+        for i in range(250):
+            bridge.publish(str(i).encode(), "test_queue")
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"]),
+                         [str(i).encode() for i in range(250)])
+        self.assertEqual(broker.batches, 3)
+        metrics = bridge.get_metrics()
+        self.assertTrue(metrics["connected"])
+        self.assertEqual(metrics["queued"], 0)
+        self.assertEqual(metrics["in_flight"], 0)
+        self.assertEqual(metrics["published"], 250)
+        self.assertEqual(metrics["confirmed"], 250)
+        self.assertEqual(metrics["batches"], 3)
+        self.assertGreaterEqual(metrics["latency"]["p50"], 0.01)
+        self.assertGreaterEqual(metrics["latency"]["max"],
+                                metrics["latency"]["p99"])
+
+    def test_in_flight_window(self):
+        bridge, broker = self._get_bridge(batch_size=100, max_in_flight=10,
+                                          batch_interval=0)
+        for i in range(100):
+            bridge.publish(b"test", "test_queue")
+        sleep(0.005)
+        self.assertLessEqual(bridge.in_flight, 10)
+        self.assertTrue(bridge.flush(5))
+        self.assertGreaterEqual(broker.batches, 10)
+        self.assertEqual(len(broker.queues["test_queue"]), 100)
+
+    def test_nack_retry(self):
+        bridge, broker = self._get_bridge(max_attempts=2, batch_interval=0)
+        broker.nack_next = 1
+        bridge.publish(b"retried", "test_queue")
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"]), [b"retried"])
+        broker.nack_next = 2
+        bridge.publish(b"dropped", "test_queue")
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"]), [b"retried"])
+        metrics = bridge.get_metrics()
+        self.assertEqual(metrics["confirmed"], 1)
+        self.assertEqual(metrics["nacked"], 3)
+        self.assertEqual(metrics["dropped"], 1)
+
+    def test_reconnect(self):
+        bridge, broker = self._get_bridge(latency=0.5, batch_interval=0)
+        for i in range(10):
+            bridge.publish(str(i).encode(), "test_queue")
+        sleep(0.1)
+        self.assertEqual(bridge.in_flight, 10)
+        broker.disconnect()
+        self.assertFalse(bridge.get_metrics()["connected"])
+        self.assertEqual(bridge.queued, 10)
+        bridge.publish(b"10", "test_queue")
+        sleep(0.2)
+        self.assertEqual(bridge.in_flight, 0)
+        broker.latency = 0.01
+        broker.connect()
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"])[-11:],
+                         [str(i).encode() for i in range(11)])
+
+
+    def test_bounded_buffer(self):
+        bridge, broker = self._get_bridge(max_queued=5, batch_interval=0)
+        broker.disconnect()
+        for i in range(8):
+            bridge.publish(str(i).encode(), "test_queue")
+        metrics = bridge.get_metrics()
+        self.assertEqual(metrics["queued"], 5)
+        self.assertEqual(metrics["overflowed"], 3)
+        self.assertEqual(metrics["dropped"], 3)
+        self.assertTrue(metrics["draining"])
+        broker.connect()
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"]),
+                         [str(i).encode() for i in range(3, 8)])
+        self.assertFalse(bridge.get_metrics()["draining"])
+
+    def test_spilled_buffer(self):
+        from tempfile import mkdtemp
+        from shutil import rmtree
+        spill_dir = mkdtemp()
+        self.addCleanup(rmtree, spill_dir)
+        spill_path = join(spill_dir, "spill", "mq_bridge")
+        bridge, broker = self._get_bridge(max_queued=4, batch_size=2,
+                                          batch_interval=0,
+                                          spill_path=spill_path)
+        broker.disconnect()
+        for i in range(10):
+            bridge.publish(str(i).encode(), "test_queue", expiration=500)
+        self.assertEqual(bridge.queued, 10)
+        self.assertEqual(bridge.spilled, 6)
+        self.assertEqual(bridge.get_metrics()["dropped"], 0)
+
+        # Unpublished messages are kept for the next bridge
+        bridge.stop(0)
+        self.assertEqual(bridge.spilled, 10)
+        with open(spill_path, "ab") as f:
+            # Partially written record
+            f.write(b"\x00\x00")
+        bridge, broker = self._get_bridge(max_queued=4, batch_size=2,
+                                          batch_interval=0,
+                                          spill_path=spill_path)
+        bridge.publish(b"10", "test_queue")
+        self.assertTrue(bridge.flush(5))
+        self.assertEqual(list(broker.queues["test_queue"]),
+                         [str(i).encode() for i in range(11)])
+        self.assertEqual(bridge.spilled, 0)
+
+    def test_drain_rate(self):
+        bridge, broker = self._get_bridge(batch_size=10, batch_interval=0,
+                                          drain_rate=100, latency=0)
+        broker.disconnect()
+        for i in range(50):
+            bridge.publish(b"test", "test_queue")
+        broker.connect()
+        start = time()
+        self.assertTrue(bridge.flush(5))
+        self.assertGreaterEqual(time() - start, 0.35)
+        self.assertEqual(broker.batches, 5)
+
+
+class TestMQConnectorSupervisor(unittest.TestCase):
+    class MockConnector:
+        def __init__(self):
+            self.started = False
+            self.vhost = "/test"
+            self.config = {}
+            self.consumers = dict()
+            self.healthy = True
+            self.stop = mock.Mock()
+            self.restart_consumer = mock.Mock()
+
+        def get_connection_params(self, vhost):
+            return vhost
+
+        def run(self, **_):
+            self.started = True
+
+        def check_health(self):
+            return self.healthy
+
+    @mock.patch("neon_mq_connector.utils.connection_utils."
+                "check_rmq_is_available")
+    def test_supervisor(self, check_available):
+        from neon_messagebus.util.mq_connector import MQConnectorSupervisor
+        available = Event()
+        check_available.side_effect = lambda _: available.is_set()
+        connector = self.MockConnector()
+        supervisor = MQConnectorSupervisor(lambda: connector, min_delay=0.01,
+                                           max_delay=0.02,
+                                           health_interval=0.01)
+        start = time()
+        supervisor.start()
+        self.assertLess(time() - start, 0.5)
+        sleep(0.2)
+        self.assertFalse(connector.started)
+        self.assertGreater(supervisor.failures, 2)
+        check_available.assert_called_with("/test")
+
+        available.set()
+        sleep(0.2)
+        self.assertTrue(connector.started)
+        metrics = supervisor.get_metrics()
+        self.assertTrue(metrics["started"])
+        self.assertEqual(metrics["failures"], 0)
+
+        # Dead consumers are restarted
+        alive = mock.Mock(is_alive=mock.Mock(return_value=True))
+        dead = mock.Mock(is_alive=mock.Mock(return_value=False))
+        connector.consumers = {"alive": alive, "dead": dead}
+        connector.healthy = False
+        sleep(0.1)
+        connector.restart_consumer.assert_called_with("dead")
+        self.assertNotIn(mock.call("alive"),
+                         connector.restart_consumer.call_args_list)
+        self.assertGreater(supervisor.get_metrics()["restarts"], 0)
+        connector.healthy = True
+
+        supervisor.stop()
+        connector.stop.assert_called_once()
+
+    def test_supervisor_not_configured(self):
+        from neon_messagebus.util.mq_connector import MQConnectorSupervisor
+        supervisor = MQConnectorSupervisor(lambda: None)
+        supervisor.start()
+        supervisor.stop()
+        self.assertEqual(supervisor.get_metrics(),
+                         {"started": False, "failures": 0, "restarts": 0})
+
+
 class TestConfig(unittest.TestCase):
     @mock.patch("ovos_config.config.Configuration.load_all_configs")
     def test_load_messagebus_config_default(self, load_config):